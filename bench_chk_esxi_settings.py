@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+
+"""
+#
+# Copyright (c) 2017, 2018, 2019 by Delphix. All rights reserved.
+#
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Program Name : bench_chk_esxi_settings.py
+# Description  : Local vSphere stand-in and benchmark for chk_esxi_settings
+#
+Code    : bench_chk_esxi_settings
+Syntax  :
+Usage   : bench_chk_esxi_settings [-h] [-n VMS] [--hosts HOSTS] [--disks DISKS] [--luns LUNS]
+                                  [--page_size PAGE_SIZE] [--latency LATENCY]
+
+optional arguments:
+  -h, --help                           show this help message and exit
+  -n VMS, --vms VMS                    Comma separated inventory sizes to benchmark (default 10,1000,10000)
+  --hosts HOSTS                        Number of ESXi hosts (default 4)
+  --disks DISKS                        Number of vmdks per VM (default 8)
+  --luns LUNS                          Number of LUNs per ESXi host (default 64)
+  --page_size PAGE_SIZE                Objects per RetrievePropertiesEx page without maxObjects (default 100)
+  --latency LATENCY                    Simulated round trip latency in ms (default 0)
+
+The stand-in serves a synthetic inventory through the pyVmomi stub interface
+(InvokeMethod / InvokeAccessor), so the checker runs unmodified against it:
+
+    import bench_chk_esxi_settings as bench
+    si = bench.make_service_instance(vms=1000)
+    chk_esxi_settings.load_sdk()
+    chk_esxi_settings.SmartConnect = lambda *args, **kwargs: si
+    chk_esxi_settings.Disconnect = lambda si: None
+"""
+
+import argparse
+import datetime
+import sys
+import time
+import tracemalloc
+
+from pyVmomi import vim, vmodl
+
+# Counters of the stand-in's PerformanceManager (group.name.rollup), the ones
+# the contention and storage I/O checks query
+PERF_COUNTERS = ['cpu.ready.summation', 'cpu.costop.summation', 'mem.vmmemctl.average', 'mem.swapped.average',
+                 'cpu.usage.average', 'virtualDisk.totalReadLatency.average', 'virtualDisk.totalWriteLatency.average',
+                 'virtualDisk.numberReadAveraged.average', 'virtualDisk.numberWriteAveraged.average',
+                 'datastore.totalReadLatency.average', 'datastore.totalWriteLatency.average',
+                 'datastore.numberReadAveraged.average', 'datastore.numberWriteAveraged.average']
+
+class fakestub(object):
+    # Answers the calls chk_esxi_settings makes from an in-memory inventory,
+    # props holds moid -> {top level property: value}, instances the perf
+    # instances ("*") of each VM per counter group. Every call counts as one
+    # round trip and optionally sleeps for the simulated latency.
+    def __init__(self, page_size=100, latency=0):
+        self.page_size = page_size
+        self.latency = latency
+        self.props = {}
+        self.types = {}
+        self.views = {}
+        self.results = {}
+        self.instances = {}
+        self.calls = 0
+        self.content = None
+
+    def mo(self, cls, moid, **props):
+        self.props[moid] = props
+        self.types[moid] = cls
+        return cls(moid, self)
+
+    def InvokeAccessor(self, mo, info):
+        self._roundtrip()
+        return self._get(mo._moId, info.name)
+
+    def InvokeMethod(self, mo, info, args):
+        self._roundtrip()
+        return getattr(self, '_' + info.name)(mo, *args)
+
+    def _roundtrip(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _get(self, moid, name):
+        return self.props[moid][name]
+
+    def _path(self, moid, path):
+        top, _, rest = path.partition('.')
+        val = self._get(moid, top)
+        for name in rest.split('.') if rest else []:
+            val = getattr(val, name)
+            if val is None:
+                raise AttributeError(path)
+        if isinstance(val, list) and val:
+            # DynamicProperty only takes typed arrays, use the closest common base
+            for cls in type(val[0]).__mro__:
+                if all(isinstance(x, cls) for x in val):
+                    return cls.Array(val)
+        return val
+
+    def _RetrieveContent(self, mo):
+        return self.content
+
+    def _CurrentTime(self, mo):
+        return datetime.datetime.now()
+
+    def _CreateContainerView(self, mo, container, type, recursive):
+        moid = 'session[bench]view-{}'.format(len(self.views))
+        self.views[moid] = [self.types[x](x, self) for x in self.props
+                            if any(issubclass(self.types[x], t) for t in type)]
+        return self.mo(vim.view.ContainerView, moid)
+
+    def _QueryStats(self, mo, querySpec):
+        # QueryPerf: one value per interval of the window for every metric,
+        # "*" is every instance of the entity in that counter group
+        result = []
+        for spec in querySpec:
+            samples = int((spec.endTime - spec.startTime).total_seconds() // spec.intervalId)
+            value = []
+            for metric in spec.metricId:
+                group = PERF_COUNTERS[metric.counterId - 1].split('.')[0]
+                instances = self.instances.get(spec.entity._moId, {}).get(group, []) if metric.instance == '*' \
+                    else [metric.instance]
+                for instance in instances:
+                    value.append(vim.PerformanceManager.IntSeries(
+                        id=vim.PerformanceManager.MetricId(counterId=metric.counterId, instance=instance),
+                        value=[(metric.counterId * 7 + x) % 50 for x in range(samples)]))
+            result.append(vim.PerformanceManager.EntityMetric(entity=spec.entity, value=value))
+        return result
+
+    def _Destroy(self, mo):
+        self.views.pop(mo._moId, None)
+
+    def _RetrievePropertiesEx(self, mo, specSet, options):
+        objects = []
+        for spec in specSet:
+            for oSpec in spec.objectSet:
+                objs = self.views[oSpec.obj._moId] if oSpec.obj._moId in self.views else [oSpec.obj]
+                for obj in objs:
+                    for pSpec in spec.propSet:
+                        if isinstance(obj, pSpec.type):
+                            objects.append(self._content(obj, pSpec.pathSet))
+        return self._page(objects, options.maxObjects or self.page_size)
+
+    def _ContinueRetrievePropertiesEx(self, mo, token):
+        objects, page_size = self.results.pop(token)
+        return self._page(objects, page_size)
+
+    def _content(self, obj, pathSet):
+        propSet = []
+        for path in pathSet:
+            try:
+                propSet.append(vmodl.DynamicProperty(name=path, val=self._path(obj._moId, path)))
+            except (KeyError, AttributeError):
+                pass
+        return vmodl.query.PropertyCollector.ObjectContent(obj=obj, propSet=propSet)
+
+    def _page(self, objects, page_size):
+        token = None
+        if len(objects) > page_size:
+            token = str(len(self.results) + 1)
+            self.results[token] = (objects[page_size:], page_size)
+        return vmodl.query.PropertyCollector.RetrieveResult(objects=objects[:page_size], token=token)
+
+def make_host(stub, n, luns):
+    scsiLun = [vim.host.ScsiDisk(key='key-vim.host.ScsiDisk-{}'.format(x), lunType='disk',
+                                 canonicalName='naa.6000{:04d}{:08d}'.format(n, x)) for x in range(luns)]
+    multipath = [vim.host.MultipathInfo.LogicalUnit(key='lun-{}'.format(x), id='lun-{}'.format(x),
+                                                    lun='key-vim.host.ScsiDisk-{}'.format(x),
+                                                    path=[vim.host.MultipathInfo.Path(
+                                                        key='path-{}'.format(x), name='vmhba2:C0:T0:L{}'.format(x),
+                                                        pathState='active', adapter='key-vmhba2',
+                                                        lun='lun-{}'.format(x))],
+                                                    policy=vim.host.MultipathInfo.LogicalUnitPolicy(
+                                                        policy='VMW_PSP_RR' if x % 8 else 'VMW_PSP_MRU'))
+                 for x in range(luns)]
+    hardware = vim.host.Summary.HardwareSummary(vendor='Dell Inc.', model='PowerEdge R740',
+                                                cpuModel='Intel(R) Xeon(R) Gold 6140 CPU @ 2.30GHz', cpuMhz=2300,
+                                                numCpuPkgs=2, numCpuCores=36, numCpuThreads=72,
+                                                memorySize=768 * 1024 * 1024 * 1024)
+    return stub.mo(vim.HostSystem, 'host-{}'.format(n), name='esx{:02d}.example.com'.format(n),
+                   summary=vim.host.Summary(hardware=hardware,
+                                            quickStats=vim.host.Summary.QuickStats(overallMemoryUsage=200 * 1024),
+                                            config=vim.host.Summary.ConfigSummary(vmotionEnabled=True)),
+                   hardware=vim.host.HardwareInfo(
+                       cpuPowerManagementInfo=vim.host.CpuPowerManagementInfo(currentPolicy='High Performance'),
+                       systemInfo=vim.host.SystemInfo(vendor='Dell Inc.', model='PowerEdge R740')),
+                   config=vim.host.ConfigInfo(
+                       hyperThread=vim.host.CpuSchedulerSystem.HyperThreadScheduleInfo(available=True, active=True,
+                                                                                       config=True),
+                       storageDevice=vim.host.StorageDeviceInfo(scsiLun=scsiLun,
+                                                                multipathInfo=vim.host.MultipathInfo(lun=multipath))))
+
+def make_datastores(stub, hosts, luns):
+    datastores = []
+    for n in range(hosts):
+        extent = vim.host.ScsiDisk.Partition(diskName='naa.6000{:04d}{:08d}'.format(n, n % luns), partition=1)
+        datastores.append(stub.mo(vim.Datastore, 'datastore-{}'.format(n), name='vmfs{:02d}'.format(n),
+                                  info=vim.host.VmfsDatastoreInfo(name='vmfs{:02d}'.format(n),
+                                                                  url='ds:///vmfs/volumes/vmfs-{}/'.format(n),
+                                                                  vmfs=vim.host.VmfsVolume(extent=[extent]))))
+    datastores.append(stub.mo(vim.Datastore, 'datastore-nfs', name='nfs01',
+                              info=vim.host.NasDatastoreInfo(name='nfs01', url='ds:///vmfs/volumes/nfs-01/',
+                                                             nas=vim.host.NasVolume(
+                                  name='nfs01', remoteHost='filer.example.com', remotePath='/vol/nfs01'))))
+    return datastores
+
+def make_devices(n, disks, datastore):
+    devices = []
+    for c in range(4):
+        devices.append(vim.vm.device.VirtualLsiLogicController(
+            key=1000 + c, busNumber=c, sharedBus='noSharing',
+            deviceInfo=vim.Description(label='SCSI controller {}'.format(c), summary='LSI Logic'),
+            device=[2000 + d for d in range(disks) if d % 4 == c]))
+    for d in range(disks):
+        devices.append(vim.vm.device.VirtualDisk(
+            key=2000 + d, controllerKey=1000 + d % 4, unitNumber=d // 4 + (1 if d % 4 == 0 else 0),
+            capacityInKB=256 * 1024 * 1024,
+            deviceInfo=vim.Description(label='Hard disk {}'.format(d + 1), summary='268,435,456 KB'),
+            backing=vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+                fileName='[{}] engine{}/engine{}_{}.vmdk'.format(datastore._moId, n, n, d), diskMode='persistent',
+                thinProvisioned=False, eagerlyScrub=True, datastore=datastore)))
+    devices.append(vim.vm.device.VirtualVmxnet3(
+        key=4000, macAddress='00:50:56:{:02x}:{:02x}:{:02x}'.format(n >> 16 & 255, n >> 8 & 255, n & 255),
+        deviceInfo=vim.Description(label='Network adapter 1', summary='VM Network')))
+    return devices
+
+def make_vm(stub, n, host, disks, datastore):
+    stub.instances['vm-{}'.format(n)] = {
+        'virtualDisk': ['scsi{}:{}'.format(d % 4, d // 4 + (1 if d % 4 == 0 else 0)) for d in range(disks)],
+        'datastore': [stub.props[datastore._moId]['info'].url.rstrip('/').split('/')[-1]]}
+    return stub.mo(vim.VirtualMachine, 'vm-{}'.format(n), name='engine{}'.format(n),
+                   runtime=vim.vm.RuntimeInfo(powerState='poweredOn', host=host),
+                   config=vim.vm.ConfigInfo(
+                       name='engine{}'.format(n), flags=vim.vm.FlagInfo(htSharing='any'),
+                       hardware=vim.vm.VirtualHardware(numCPU=8, numCoresPerSocket=4, memoryMB=65536,
+                                                       device=make_devices(n, disks, datastore))),
+                   resourceConfig=vim.ResourceConfigSpec(
+                       cpuAllocation=vim.ResourceAllocationInfo(limit=-1, reservation=8 * 2300),
+                       memoryAllocation=vim.ResourceAllocationInfo(limit=-1, reservation=65536)),
+                   guest=vim.vm.GuestInfo(ipAddress='10.{}.{}.{}'.format(n >> 16 & 255, n >> 8 & 255, n & 255)))
+
+def make_service_instance(vms=10, hosts=4, disks=8, luns=64, page_size=100, latency=0):
+    # Synthetic inventory: vms VMs named engine<n> spread over hosts ESXi
+    # hosts, each with disks vmdks on a per-host VMFS datastore or NFS.
+    stub = fakestub(page_size, latency)
+    hostmos = [make_host(stub, n, luns) for n in range(hosts)]
+    datastores = make_datastores(stub, hosts, luns)
+    for n in range(vms):
+        datastore = datastores[-1] if n % 5 == 4 else datastores[n % hosts]
+        make_vm(stub, n, hostmos[n % hosts], disks, datastore)
+    stub.content = vim.ServiceInstanceContent(
+        rootFolder=stub.mo(vim.Folder, 'group-d1'),
+        propertyCollector=stub.mo(vmodl.query.PropertyCollector, 'propertyCollector'),
+        viewManager=stub.mo(vim.view.ViewManager, 'ViewManager'),
+        perfManager=stub.mo(vim.PerformanceManager, 'PerfMgr', perfCounter=[
+            vim.PerformanceManager.CounterInfo(key=n + 1, groupInfo=vim.ElementDescription(key=x.split('.')[0]),
+                                               nameInfo=vim.ElementDescription(key=x.split('.')[1]),
+                                               rollupType=x.split('.')[2])
+            for n, x in enumerate(PERF_COUNTERS)]),
+        about=vim.AboutInfo(name='VMware vCenter Server', version='6.7.0', build='15132721'))
+    return vim.ServiceInstance('ServiceInstance', stub)
+
+def measure(stub, func):
+    # Wall time, round trips and peak traced memory of one phase
+    tracemalloc.start()
+    calls = stub.calls
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {'wall': elapsed, 'calls': stub.calls - calls, 'peak': peak}
+
+def bench(chk, args, vms):
+    si = make_service_instance(vms, args.hosts, args.disks, args.luns, args.page_size, args.latency / 1000.0)
+    stub = si._stub
+    content = si.RetrieveContent()
+    chk.host_storage_cache.clear()
+    chk.datastore_cache.clear()
+    phases = []
+
+    def vm_lookup():
+        # check_host() reads the VMs once for the allocation totals and the
+        # target lookup
+        retProps = chk.GetProperties(content, [vim.VirtualMachine], chk.VM_ALLOC_PROPS, vim.VirtualMachine)
+        vmlist = [chk.vm_facts(x) for x in retProps]
+        return retProps, vmlist, chk.vm_name_index(vmlist)
+    (retProps, vmlist, index), stats = measure(stub, vm_lookup)
+    phases.append(('VM lookup', stats))
+
+    def esxi_info():
+        hosts = chk.collect_host_facts(content)
+        return hosts, chk.esxi_info(hosts, vmlist)
+    (hosts, esxiinfo), stats = measure(stub, esxi_info)
+    phases.append(('esxi_info', stats))
+
+    inventory = chk.new_inventory('bench', content)
+    inventory['hosts'] = hosts
+    esxiinfo['esxi_version'] = inventory['about']['version']
+    esxiinfo['connected_host'] = 'bench'
+    moid = index['engine{}'.format(vms // 2)][0]['moid']
+    target = [x['moref'] for x in retProps if x['moref']._moId == moid][0]
+
+    def print_vm_info():
+        chk.PrintVmInfo(args, chk.collect_vm_facts(content, inventory, target), inventory, esxiinfo, 1)
+    dummy, stats = measure(stub, lambda: reported(chk, print_vm_info))
+    phases.append(('PrintVmInfo', stats))
+
+    # check_host() end to end for a few engines on different ESXi hosts: the
+    # inventory read, the concurrent facts of the targets, the perf query and
+    # every check, with the storage caches empty as at the start of a run
+    vmnames = ['engine{}'.format(x) for x in range(vms // 2, min(vms, vms // 2 + args.hosts))]
+    chkargs = chk.parser.parse_args(['-s', 'bench', '-u', 'bench', '-e', ','.join(vmnames)])
+    chkargs.disk_type = args.disk_type
+    chk.host_storage_cache.clear()
+    chk.datastore_cache.clear()
+    rc, stats = measure(stub, lambda: reported(chk, lambda: chk.check_host(chkargs, si, 'bench', vmnames)))
+    if rc != 0:
+        raise RuntimeError("check_host returned {}".format(rc))
+    phases.append(('check_host', stats))
+    return phases
+
+def reported(chk, func):
+    # Runs func with its report output captured and dropped
+    stdout = sys.stdout
+    sys.stdout = chk.report
+    chk.report.capture()
+    try:
+        return func()
+    finally:
+        chk.report.release()
+        sys.stdout = stdout
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark chk_esxi_settings against a local vSphere stand-in')
+    parser.add_argument('-n', '--vms', default='10,1000,10000', action='store', help='Comma separated inventory sizes to benchmark (default 10,1000,10000)')
+    parser.add_argument('--hosts', type=int, default=4, action='store', help='Number of ESXi hosts (default 4)')
+    parser.add_argument('--disks', type=int, default=8, action='store', help='Number of vmdks per VM (default 8)')
+    parser.add_argument('--luns', type=int, default=64, action='store', help='Number of LUNs per ESXi host (default 64)')
+    parser.add_argument('--page_size', type=int, default=100, action='store', help='Objects per RetrievePropertiesEx page when no maxObjects is asked for (default 100)')
+    parser.add_argument('--latency', type=float, default=0, action='store', help='Simulated round trip latency in ms (default 0)')
+    args = parser.parse_args()
+    sizes = [int(x) for x in args.vms.split(",")]
+
+    # chk_esxi_settings parses its arguments, sets up logs/ and imports
+    # pyVmomi in main() only
+    stdout = sys.stdout
+    import chk_esxi_settings as chk
+    chk.load_sdk()
+    chk.dx_rules = chk.ruleset()
+    args.disk_type = 'non_ssd'
+
+    sep = "="
+    stdout.write("{0:10} {1:20} {2:>12} {3:>12} {4:>14}\n".format("VMs", "Phase", "Wall (s)", "Round trips", "Peak mem (KB)"))
+    stdout.write("{0:10} {1:20} {2:>12} {3:>12} {4:>14}\n".format(sep * 10, sep * 20, sep * 12, sep * 12, sep * 14))
+    for vms in sizes:
+        for phase, stats in bench(chk, args, vms):
+            stdout.write("{0:<10} {1:20} {2:>12.3f} {3:>12} {4:>14.0f}\n".format(vms, phase, stats['wall'], stats['calls'],
+                                                                                stats['peak'] / 1024.0))
+        stdout.flush()
+    return 0
+
+# Start program
+if __name__ == "__main__":
+    sys.exit(main())
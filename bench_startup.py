@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+#
+# Copyright (c) 2017, 2018, 2019 by Delphix. All rights reserved.
+#
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Program Name : bench_startup.py
+# Description  : Cold start time of the IRR scripts and their frozen builds
+#
+Code    : bench_startup
+Syntax  :
+Usage   : bench_startup [-h] [-n RUNS] [--dist DIST]
+
+optional arguments:
+  -h, --help                           show this help message and exit
+  -n RUNS, --runs RUNS                 Number of runs per command (default 10)
+  --dist DIST                          Folder with frozen executables (default dist)
+
+Every command is run with --help from an empty scratch folder, which also
+shows a script writing files (logs/, *.log) before its arguments are parsed.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPTS = ['chk_esxi_settings.py', 'exec_network_test.py']
+
+def commands(dist):
+    here = os.path.dirname(os.path.abspath(__file__))
+    for script in SCRIPTS:
+        yield script, [sys.executable, os.path.join(here, script), '--help']
+    # frozen builds (pyinstaller and friends) live in dist/<name>[.exe] or
+    # dist/<name>/<name>[.exe]
+    for script in SCRIPTS:
+        name = os.path.splitext(script)[0]
+        for exe in [os.path.join(dist, name), os.path.join(dist, name, name)]:
+            for candidate in [exe, exe + '.exe']:
+                if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                    yield candidate, [os.path.abspath(candidate), '--help']
+
+def run(cmd, runs):
+    times = []
+    dirty = []
+    for n in range(runs):
+        scratch = tempfile.mkdtemp()
+        try:
+            start = time.time()
+            subprocess.call(cmd, cwd=scratch, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append(time.time() - start)
+            dirty = os.listdir(scratch) or dirty
+        finally:
+            shutil.rmtree(scratch)
+    times.sort()
+    return times, dirty
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start time of the IRR scripts and their frozen builds')
+    parser.add_argument('-n', '--runs', type=int, default=10, action='store', help='Number of runs per command (default 10)')
+    parser.add_argument('--dist', default='dist', action='store', help='Folder with frozen executables (default dist)')
+    args = parser.parse_args()
+
+    sep = "="
+    print("{0:40} {1:>10} {2:>10} {3:>10}  {4}".format("Command", "Min (s)", "Median (s)", "Max (s)", "Files written"))
+    print("{0:40} {1:>10} {2:>10} {3:>10}  {4}".format(sep * 40, sep * 10, sep * 10, sep * 10, sep * 13))
+    for name, cmd in commands(args.dist):
+        times, dirty = run(cmd, args.runs)
+        print("{0:40} {1:>10.3f} {2:>10.3f} {3:>10.3f}  {4}".format(name, times[0], times[len(times) // 2], times[-1],
+                                                                   ", ".join(sorted(dirty)) or "-"))
+        sys.stdout.flush()
+    return 0
+
+# Start program
+if __name__ == "__main__":
+    sys.exit(main())
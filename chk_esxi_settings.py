@@ -28,6 +28,9 @@ Code    : chk_esxi_settings
 Syntax  :
 Script Version : 3.0
 Usage   : chk_esxi_settings [-h] -s HOST [-o PORT] -u USER [-p PASSWORD] -e VM -t DISK_TYPE [-d]
+          chk_esxi_settings [-h] -s HOST [-o PORT] -u USER [-p PASSWORD] --capture FILE
+          chk_esxi_settings [-h] --replay FILE -e VM -t DISK_TYPE
+          chk_esxi_settings [-h] -i INVENTORY [-w WORKERS] [-o PORT] -u USER [-p PASSWORD] -t DISK_TYPE [-d]
 
 Process args for retrieving all the Virtual Machines.
 
@@ -38,6 +41,15 @@ optional arguments:
   -u USER, --user USER                 User name to use when connecting to host
   -p PASSWORD, --password PASSWORD     Password to use when connecting to host
   -e VM, --vm VM                       One or more Virtual Machines to report on
+  -i INVENTORY, --inventory INVENTORY  Fleet mode: file with one <host>,<vm> pair per line
+  -w WORKERS, --workers WORKERS        Fleet mode: number of hosts checked concurrently (default 8)
+  --capture FILE                       Write a snapshot of everything the checks need to FILE
+  --replay FILE                        Run the checks against a snapshot written by --capture
+  --watch                              After the report keep watching the Virtual Machines for changed check results
+  --report_format REPORT_FORMAT        Comma separated report formats written to logs/: text, csv, jsonl, html (default text)
+  --profile                            Record every vSphere call and write a per-phase profile to logs/
+  -r RULES, --rules RULES              File with additional or overriding rules (ini format, see DEFAULT_RULES)
+  --vm_workers VM_WORKERS              Number of Virtual Machines checked concurrently per host (default 4)
   -t DISK_TYPE, --disk_type DISK_TYPE  Disk Storage Type (non_ssd (default) | ssd
   -c, --cert_check_skip                skip ssl certificate check
   -d, --debug                          generate debug info
@@ -62,35 +74,60 @@ Comments: The code is a fork from py-vminfo.py
           Infrastructure checklist script.
 """
 import argparse
+import ast
 import atexit
+import datetime
+import configparser
+import csv
 import getpass
-import logging.handlers
+import gzip
+import html
+import json
+import logging
 import math
 import os
 import os.path
 import re
-import ssl
+import string
 import sys
-from collections import defaultdict
-from operator import itemgetter
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os import path
 
 # from __future__ import print_function
-# from pyVim.connect import SmartConnect, Disconnect
-from pyVim.connect import SmartConnect, Disconnect
-from pyVmomi import vmodl, vim
+
+# pyVmomi (and the ssl/requests/urllib3 stack it pulls in) is the bulk of the
+# start up time, it is imported by load_sdk() once the arguments are valid.
+# So is asyncio, only vsphereclient (talking to vCenter) needs it.
+SmartConnect = Disconnect = vmodl = vim = ssl = asyncio = None
 
 # from ConfigParser import SafeConfigParser
 
 parser = argparse.ArgumentParser(description='Please use the name of delphix VM as vm name used in esxi host. IP address will not be recognized')
-parser.add_argument('-s', '--host', required=True, action='store', help='Remote host to connect to')
+parser.add_argument('-s', '--host', required=False, action='store', help='Remote host to connect to')
 parser.add_argument('-o', '--port', type=int, default=443, action='store', help='Port to connect on')
-parser.add_argument('-u', '--user', required=True, action='store', help='User name to use when connecting to host')
+parser.add_argument('-u', '--user', required=False, action='store', help='User name to use when connecting to host')
 parser.add_argument('-p', '--password', required=False, action='store', help='Password to use when connecting to host')
-parser.add_argument('-e', '--vm', required=True, action='store', help='One or more Virtual Machines to report on')
+parser.add_argument('-e', '--vm', required=False, action='store', help='One or more Virtual Machines to report on')
+parser.add_argument('-i', '--inventory', required=False, action='store', help='Fleet mode: file with one <host>,<vm> pair per line (replaces -s/-e)')
+parser.add_argument('-w', '--workers', type=int, default=8, action='store', help='Fleet mode: number of hosts checked concurrently (default 8)')
+parser.add_argument('--capture', required=False, action='store', help='Write a snapshot of everything the checks need to this file instead of checking')
+parser.add_argument('--replay', required=False, action='store', help='Run the checks against a snapshot written by --capture (no -s/-u needed)')
+parser.add_argument('--watch', default=False, required=False, action='store_true', help='After the report keep watching the Virtual Machines and report every check that changes result')
+parser.add_argument('--report_format', default='text', action='store', help='Comma separated report formats written to logs/chk_esxi_settings.<ext>: text, csv, jsonl, html (default text)')
+parser.add_argument('--history', required=False, action='store', help='Also store the check results of this run in this SQLite file (see irr_history.py)')
+parser.add_argument('--profile', default=False, required=False, action='store_true', help='Record every vSphere call and write a per-phase profile to logs/chk_esxi_settings_profile.txt')
+parser.add_argument('-r', '--rules', required=False, action='store', help='File with additional or overriding rules (ini format, see DEFAULT_RULES)')
+parser.add_argument('--perf_window', type=int, default=30, action='store', help='Minutes of performance samples the contention section reports on (default 30, more than 60 uses 5 minute samples)')
+parser.add_argument('--vm_workers', type=int, default=4, action='store', help='Number of vSphere requests (Virtual Machines collected) in flight per host to start with (default 4)')
+parser.add_argument('--max_inflight', type=int, default=16, action='store', help='Hard cap of vSphere requests in flight per host / vCenter (default 16)')
+parser.add_argument('--sessions', type=int, default=1, action='store', help='Number of vSphere sessions per host the requests are spread over (default 1)')
 parser.add_argument('-c', '--cert_check_skip', default=True, required=False, action='store_true', help='skip ssl certificate check')
 parser.add_argument('-t', '--disk_type', default='non_ssd', action='store', help='Disk Storage Type (non_ssd (default) | ssd')
 parser.add_argument('-d', '--debug', default=False, required=False, action='store_true', help='debug info')
+parser.add_argument('--debug_size', type=int, default=64, action='store', help='With -d: MB of raw vSphere properties written to logs/chk_esxi_settings_debug.json.gz (default 64)')
 parser.add_argument('-v', '--verbose', action="store", help="verbose level... repeat up to three times.")
 
 logger = logging.getLogger('Global')
@@ -100,25 +137,33 @@ debug_logfile = "logs/chk_esxi_settings_debug.log"
 output_file = "logs/chk_esxi_settings_debug.txt"
 vm_stats_output = "logs/vm_stats.csv"
 esx_global_output = "logs/esx_global.csv"
-if not os.path.exists('logs'): os.mkdir('logs')
-if path.exists(debug_logfile): os.remove(debug_logfile) 
-if path.exists(output_file): os.remove(output_file) 
-if path.exists(vm_stats_output): os.remove(vm_stats_output) 
-if path.exists(esx_global_output): os.remove(esx_global_output) 
-
-f = open(esx_global_output, "w")
-f.write("{}, {}, {}, {}, {}, {}, {}, {}, {}\n".format("esx_version", "esx_build", "esx_update", "cpus", "cores", "core_threads", "ht_active", "ht_enabled", "ht_best_practice"))
-f.close()
-
-f = open(vm_stats_output, "w")
-f.write("{}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}\n".format("guest_name", "cpus", "cpu_cores", "cpu_reserved", "cpu_best_practice", "memoryGB", "memory_reserved", "memory_best_practice", "memory_reserved_needed", "ht_sharing", "ht_best_practice", "controller / LUN count", "storage_best_practice"))
-f.close()
-
-
-log_file_handler = logging.handlers.TimedRotatingFileHandler('logs/chk_esxi_settings_debug.log', when='M', interval=1440)
-log_file_handler.setFormatter( logging.Formatter('%(asctime)s [%(levelname)s](%(name)s:%(funcName)s:%(lineno)d): %(message)s') )
-log_file_handler.setLevel(logging.DEBUG)
-logger.addHandler(log_file_handler)
+debug_capture_output = "logs/chk_esxi_settings_debug.json.gz"
+log_file_handler = None
+
+def setup_logs(debug=False):
+    # Nothing is written to logs/ before the arguments are parsed, so --help
+    # and usage errors leave the current folder alone. DEBUG records are
+    # only kept with -d.
+    global log_file_handler
+    import logging.handlers
+    if not os.path.exists('logs'): os.mkdir('logs')
+    if path.exists(debug_logfile): os.remove(debug_logfile) 
+    if path.exists(output_file): os.remove(output_file) 
+
+    log_file_handler = logging.handlers.TimedRotatingFileHandler('logs/chk_esxi_settings_debug.log', when='M', interval=1440)
+    log_file_handler.setFormatter( logging.Formatter('%(asctime)s [%(levelname)s](%(name)s:%(funcName)s:%(lineno)d): %(message)s') )
+    log_file_handler.setLevel(logging.DEBUG if debug else logging.INFO)
+    logger.addHandler(log_file_handler)
+    logger.setLevel(logging.DEBUG if debug else logging.INFO)
+
+def load_sdk():
+    global SmartConnect, Disconnect, vmodl, vim, ssl, asyncio, BUSY_FAULTS
+    import asyncio
+    import ssl
+    from pyVim.connect import SmartConnect, Disconnect
+    from pyVmomi import vmodl, vim
+    BUSY_FAULTS = (vmodl.fault.RequestCanceled, vim.fault.Timedout,
+                   vmodl.fault.HostCommunication, vmodl.fault.SystemError)
 
 ## also log to the console at a level determined by the --verbose flag
 #console_handler = logging.StreamHandler() # sys.stderr
@@ -126,59 +171,801 @@ logger.addHandler(log_file_handler)
 #console_handler.setFormatter( logging.Formatter('[%(levelname)s](%(name)s): %(message)s') )
 #logger.addHandler(console_handler)
 
-class multifile(object):
-    def __init__(self, files):
-        self._files = files
-    def __getattr__(self, attr, *args):
-        return self._wrap(attr, *args)
-    def _wrap(self, attr, *args):
-        def g(*a, **kw):
-            for f in self._files:
-                res = getattr(f, attr, *args)(*a, **kw)
-            return res
-        return g
-
-# for a tee-like behavior, use like this:
-sys.stdout = multifile([ sys.stdout, open('logs/chk_esxi_settings.txt', 'w') ])
-
-def GetParserInfo():
-    dx_setting = {}
-    # parser = SafeConfigParser()
-    # parser.read("delphix_recommended.ini")
-    # section_name = "dx_settings"
-    # for name, value in parser.items(section_name):
-    #   dx_setting[name] = value
-    dx_setting['esxi_version'] = '5.0'
-    dx_setting['esxi_hyperthreading'] = 'false'
-    dx_setting['esxi_ha'] = 'enabled'
-    dx_setting['esxi_drs'] = 'disabled'
-    dx_setting['cpu_reservation'] = 'enabled'
-    dx_setting['memory_reservation'] = 'enabled'
-    dx_setting['minimum_memory'] = '64'
-    dx_setting['minimum_cpu'] = '8'
-    dx_setting['ht_sharing'] = 'none'
-    dx_setting['nic_driver'] = 'vmxnet3'
-    dx_setting['non_ssd_disk_provision_type'] = 'Thick'
-    dx_setting['non_ssd_disk_provision_format'] = 'Eager-Zero'
-    dx_setting['ssd_disk_provision_type'] = 'Thick'
-    dx_setting['ssd_disk_provision_format'] = 'Lazy-Zero'
-    dx_setting['disk_controllers'] = 'Evenly Distribute VMDKs'
-    dx_setting['disk_controllers'] = 'Balance All 4 Controllers'
-    dx_setting['scsi_controller_type'] = 'LSI Logic'
-    dx_setting['vnic'] = 'vmxnet3'
-    dx_setting['vm_htsharing'] = 'none'
-    dx_setting['esxi_powermgmt'] = 'High Performance'
-    dx_setting['vm_storagepathpolicy'] = 'VMW_PSP_RR'
-    return (dx_setting)
-
-def get_lun(scsiLun, key):
-    return [x for x in scsiLun if x.key == key]
-
-def get_disk_lun(scsiLun, lun_key, names):
-    lun = get_lun(scsiLun, lun_key)
-    if len(lun) == 0:
-        return False
-    return lun[0].lunType == "disk" and lun[0].canonicalName in names
+# Report outputs, see reportsink. Every format is written to
+# logs/chk_esxi_settings.<extension>; the csv tables are always written.
+report_output = "logs/chk_esxi_settings"
+REPORT_FORMATS = OrderedDict([('text', '.txt'), ('csv', '.csv'), ('jsonl', '.jsonl'), ('html', '.html')])
+REPORT_FIELDS = ['host', 'vm', 'scope', 'rule', 'label', 'value', 'recommended', 'result']
+REPORT_TABLES = OrderedDict([
+    ('esx_global', (esx_global_output, ["esx_version", "esx_build", "esx_update", "cpus", "cores", "core_threads",
+                                        "ht_active", "ht_enabled", "ht_best_practice", "esx_host", "cluster",
+                                        "allocated_cpus", "allocated_memoryMB"])),
+    ('vm_stats', (vm_stats_output, ["guest_name", "cpus", "cpu_cores", "cpu_reserved", "cpu_best_practice",
+                                    "memoryGB", "memory_reserved", "memory_best_practice", "memory_reserved_needed",
+                                    "ht_sharing", "ht_best_practice", "controller / LUN count",
+                                    "storage_best_practice"])),
+])
+REPORT_BUFFER = 1 << 16
+
+def report_row(record):
+    return "{0:50} {1:<70} {2:30} {3:10}".format(record['label'], str(record['value']), str(record['recommended']),
+                                                 record['result'])
+
+class textreport(object):
+    def __init__(self, f):
+        self.f = f
+    def text(self, data):
+        self.f.write(data)
+    def result(self, record):
+        self.f.write(report_row(record) + "\n")
+    def close(self):
+        self.f.close()
+
+class csvreport(object):
+    def __init__(self, f):
+        self.f = f
+        self.writer = csv.writer(f)
+        self.writer.writerow(REPORT_FIELDS)
+    def text(self, data):
+        pass
+    def result(self, record):
+        self.writer.writerow([record.get(x, "") for x in REPORT_FIELDS])
+    def close(self):
+        self.f.close()
+
+class jsonlreport(object):
+    def __init__(self, f):
+        self.f = f
+    def text(self, data):
+        pass
+    def result(self, record):
+        self.f.write(json.dumps(dict((x, record.get(x)) for x in REPORT_FIELDS), default=str) + "\n")
+    def close(self):
+        self.f.close()
+
+class htmlreport(object):
+    # Rows are written as they come, the table is closed in close()
+    def __init__(self, f):
+        self.f = f
+        self.f.write("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>chk_esxi_settings</title>\n"
+                     "<style>td,th{padding:2px 8px;text-align:left}.Pass{color:green}.Fail,.Error{color:red}</style>"
+                     "</head><body>\n<table>\n<tr>" + "".join("<th>{}</th>".format(x) for x in REPORT_FIELDS) + "</tr>\n")
+    def text(self, data):
+        pass
+    def result(self, record):
+        self.f.write("<tr class=\"{}\">".format(html.escape(str(record['result']))) +
+                     "".join("<td>{}</td>".format(html.escape(str(record.get(x, "")))) for x in REPORT_FIELDS) + "</tr>\n")
+    def close(self):
+        self.f.write("</table>\n</body></html>\n")
+        self.f.close()
+
+REPORT_WRITERS = {'text': textreport, 'csv': csvreport, 'jsonl': jsonlreport, 'html': htmlreport}
+
+class reportsink(object):
+    # The one place report output goes through. print() reaches it as
+    # sys.stdout (text), check results come in through result() and the csv
+    # tables through row(). Each record is written to the console and every
+    # open format via buffered files. Worker threads capture() their records
+    # and hand them to replay(), so concurrent checks never interleave.
+    # Check results also go to the --history store if one is open.
+    def __init__(self, console):
+        self.console = console
+        self._history = None
+        self._writers = []
+        self._tables = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def open(self, formats, history=None):
+        self._history = history
+        for fmt in formats:
+            self._writers.append(REPORT_WRITERS[fmt](open(report_output + REPORT_FORMATS[fmt], "w", REPORT_BUFFER)))
+        for table, (filename, header) in REPORT_TABLES.items():
+            f = open(filename, "w", REPORT_BUFFER)
+            f.write(", ".join(header) + "\n")
+            self._tables[table] = f
+
+    def close(self):
+        with self._lock:
+            for writer in self._writers:
+                writer.close()
+            for f in self._tables.values():
+                f.close()
+            if self._history:
+                self._history.close()
+            self._history = None
+            self._writers = []
+            self._tables = {}
+            self.console.flush()
+
+    def capture(self):
+        self._local.records = []
+
+    def release(self):
+        records = self._local.records
+        self._local.records = None
+        return records
+
+    def replay(self, records):
+        with self._lock:
+            for kind, data in records:
+                self._emit(kind, data)
+            self.console.flush()
+
+    def write(self, data):
+        self._record('text', data)
+
+    def result(self, record):
+        self._record('result', record)
+
+    def row(self, table, values):
+        self._record(table, values)
+
+    def flush(self):
+        with self._lock:
+            for writer in self._writers:
+                writer.f.flush()
+            for f in self._tables.values():
+                f.flush()
+            if self._history:
+                self._history.flush()
+            self.console.flush()
+
+    def __getattr__(self, attr):
+        return getattr(self.console, attr)
+
+    def _record(self, kind, data):
+        records = getattr(self._local, 'records', None)
+        if records is not None:
+            records.append((kind, data))
+            return
+        with self._lock:
+            self._emit(kind, data)
+
+    def _emit(self, kind, data):
+        if kind == 'text':
+            self.console.write(data)
+            for writer in self._writers:
+                writer.text(data)
+        elif kind == 'result':
+            self.console.write(report_row(data) + "\n")
+            for writer in self._writers:
+                writer.result(data)
+            if self._history:
+                self._history.add_result(data)
+        elif kind in self._tables:
+            self._tables[kind].write(", ".join("{}".format(x) for x in data) + "\n")
+
+report = reportsink(sys.stdout)
+
+# Per ESXi host storage device info and datastore info, see get_host_storage()
+host_storage_cache = {}
+datastore_cache = {}
+host_storage_lock = threading.Lock()
+
+# Compiled rules, loaded by main() (see ruleset)
+dx_rules = None
+
+# SOAP call profiler, only set with --profile (see profiler)
+profile = None
+profile_output = "logs/chk_esxi_settings_profile"
+
+# Raw property capture, only set with -d (see debugcapture)
+debug_capture = None
+
+class debugcapture(object):
+    # Writes raw vSphere payloads as gzip'ed json lines, each key (a host,
+    # datastore or VM) once, until limit bytes (before compression) are
+    # written. Records past the limit are counted, not written.
+    def __init__(self, filename, limit):
+        self.limit = limit
+        self.size = 0
+        self.dropped = 0
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._f = gzip.open(filename, 'wt')
+
+    def record(self, key, payload):
+        with self._lock:
+            if key in self._seen or self._f is None:
+                return
+            self._seen.add(key)
+            if self.size >= self.limit:
+                self.dropped += 1
+                return
+        line = json.dumps({'key': key, 'payload': payload()}, default=repr) + "\n"
+        with self._lock:
+            if self._f is None or self.size + len(line) > self.limit:
+                self.dropped += 1
+                return
+            self.size += len(line)
+            self._f.write(line)
+
+    def close(self):
+        with self._lock:
+            if self._f is None:
+                return
+            if self.dropped:
+                self._f.write(json.dumps({'key': 'truncated', 'payload': {'limit': self.limit, 'dropped': self.dropped}}) + "\n")
+            self._f.close()
+            self._f = None
+
+def debug_record(key, payload):
+    # payload is a callable, so without -d nothing is fetched or formatted
+    if debug_capture is not None:
+        debug_capture.record(key, payload)
+
+# Properties read for the checks, see vm_facts(), host_facts() and datastore_facts()
+VM_PROPS = ['name', 'runtime.powerState', 'runtime.host', 'config.hardware.numCPU', 'config.hardware.memoryMB',
+            'config.hardware.numCoresPerSocket', 'config.hardware.device', 'config.flags.htSharing',
+            'resourceConfig.cpuAllocation.limit', 'resourceConfig.cpuAllocation.reservation',
+            'resourceConfig.memoryAllocation.limit', 'resourceConfig.memoryAllocation.reservation',
+            'guest.ipAddress']
+VM_ALLOC_PROPS = ['name', 'runtime.powerState', 'runtime.host', 'config.hardware.numCPU', 'config.hardware.memoryMB']
+HOST_PROPS = ['name', 'summary.hardware', 'summary.quickStats.overallMemoryUsage', 'summary.config.vmotionEnabled',
+              'hardware.cpuPowerManagementInfo.currentPolicy', 'hardware.systemInfo.vendor',
+              'hardware.systemInfo.model', 'config.hyperThread', 'parent']
+HOST_STORAGE_PROPS = ['config.storageDevice.scsiLun', 'config.storageDevice.multipathInfo.lun']
+DATASTORE_PROPS = ['name', 'info']
+SNAPSHOT_VERSION = 1
+# Objects asked for per RetrievePropertiesEx page, so an inventory is read in
+# one pass instead of pages of the server default. vCenter may still answer
+# with smaller pages, the rest then follows with ContinueRetrievePropertiesEx.
+RETRIEVE_MAX_OBJECTS = 100000
+
+# Longest a --watch WaitForUpdatesEx() call blocks before it is reissued
+WATCH_WAIT_SECONDS = 60
+# PerformanceManager counters of the contention section, see query_perf()
+PERF_VM_COUNTERS = ['cpu.ready.summation', 'cpu.costop.summation', 'mem.vmmemctl.average', 'mem.swapped.average']
+PERF_HOST_COUNTERS = ['cpu.usage.average']
+# Sampled per vmdk (instance scsi<bus>:<unit>) and per datastore (instance
+# datastore uuid) of the engine VMs, see storage_io_rows()
+PERF_DISK_COUNTERS = ['virtualDisk.totalReadLatency.average', 'virtualDisk.totalWriteLatency.average',
+                      'virtualDisk.numberReadAveraged.average', 'virtualDisk.numberWriteAveraged.average',
+                      'datastore.totalReadLatency.average', 'datastore.totalWriteLatency.average',
+                      'datastore.numberReadAveraged.average', 'datastore.numberWriteAveraged.average']
+
+# Built-in recommended settings and checks. A --rules file uses the same
+# format: [dx_settings] overrides individual settings, a section named after
+# a built-in rule overrides individual keys of that rule and any other
+# section adds a new rule. Per rule:
+#   scope       = fact table the rule runs on and where it is printed
+#   label       = row label, a format string over the facts
+#   value       = expression, printed as Current Value
+#   recommended = expression, printed as Recommended Value (N/A if absent)
+#   check       = expression, Pass if true, Fail if false (N/A if absent)
+#   enabled     = false drops the rule
+# Expressions see the facts of the row (see RULE_SCOPES) and the dx_settings
+# values (as strings, like any ini value).
+DEFAULT_RULES = """
+[dx_settings]
+esxi_version = 5.0
+esxi_hyperthreading = false
+esxi_ha = enabled
+esxi_drs = disabled
+esxi_free_cpu = 4
+cpu_reservation = enabled
+memory_reservation = enabled
+minimum_memory = 64
+minimum_cpu = 8
+ht_sharing = none
+nic_driver = vmxnet3
+non_ssd_disk_provision_type = Thick
+non_ssd_disk_provision_format = Eager-Zero
+ssd_disk_provision_type = Thick
+ssd_disk_provision_format = Lazy-Zero
+disk_controllers = Balance All 4 Controllers
+scsi_controller_type = LSI Logic
+vnic = vmxnet3
+vm_htsharing = none
+esxi_powermgmt = High Performance
+vm_storagepathpolicy = VMW_PSP_RR
+cpu_ready_pct = 5
+cpu_costop_pct = 3
+mem_balloon_mb = 0
+mem_swapped_mb = 0
+host_cpu_usage_pct = 80
+disk_latency_ms = 20
+
+[esxi_hardware]
+scope = host
+label = ESXI Hardware
+value = hardware
+
+[esxi_hostname]
+scope = host
+label = ESXI Hostname
+value = name + '(' + connected_host + ')'
+
+[esxi_version]
+scope = host
+label = ESXI Version
+value = version
+recommended = 'ESXi ' + esxi_version + ' and Higher'
+check = version >= esxi_version
+
+[esxi_cpu_type]
+scope = host
+label = ESXI CPU Type
+value = cpu_type
+
+[esxi_cpu_sockets]
+scope = host
+label = ESXI CPU Sockets
+value = numCpuPkgs
+
+[esxi_cores_per_socket]
+scope = host
+label = ESXI Cores Per Socket
+value = numCpuCores / numCpuPkgs
+
+[esxi_total_cpu]
+scope = host
+label = ESXi Total CPU
+value = numCpuCores
+
+[esxi_alloc_cpu]
+scope = host
+label = ESXI Total Allocated CPU
+value = allocCPU
+recommended = 'Atleast ' + esxi_free_cpu + ' ESX CPU free'
+check = numCpuCores - allocCPU >= int(esxi_free_cpu)
+
+[esxi_hyperthreading]
+scope = host
+label = ESXI Hyperthreading Enabled
+value = htConfig
+recommended = esxi_hyperthreading
+check = htConfig.lower() == esxi_hyperthreading.lower()
+
+[esxi_powermgmt]
+scope = host
+label = ESXi BIOS Power Management
+value = powerMgmt
+recommended = esxi_powermgmt
+check = powerMgmt == esxi_powermgmt
+
+[esxi_memory]
+scope = host
+label = ESXI Physical Memory
+value = str(memoryGB) + ' GB'
+
+[esxi_alloc_mem]
+scope = host
+label = ESXI Total Allocated Memory to all VMs
+value = str(allocMEM / 1024) + ' GB'
+recommended = '<=' + str(memoryGB * 0.9) + ' [ 10% free for ESXI ]'
+check = allocMEM / 1024 <= memoryGB * 0.9
+
+[esxi_cluster]
+scope = host
+label = ESXI Cluster
+value = cluster + ' (' + str(clusterHosts) + ' hosts)'
+
+[esxi_cluster_alloc_cpu]
+scope = host
+label = ESXI Cluster Total Allocated CPU
+value = str(clusterAllocCPU) + ' of ' + str(clusterCpuCores) + ' cores'
+recommended = 'Atleast ' + esxi_free_cpu + ' CPU free per host'
+check = clusterCpuCores - clusterAllocCPU >= int(esxi_free_cpu) * clusterHosts
+
+[esxi_cluster_alloc_mem]
+scope = host
+label = ESXI Cluster Total Allocated Memory
+value = str(clusterAllocMEM / 1024) + ' of ' + str(clusterMemoryGB) + ' GB'
+recommended = '<=' + str(clusterMemoryGB * 0.9) + ' [ 10% free for ESXI ]'
+check = clusterAllocMEM / 1024 <= clusterMemoryGB * 0.9
+
+[esxi_ha]
+scope = host
+label = ESXI HA
+value = '[ Verify Manually on ESXi Host ]'
+recommended = esxi_ha
+
+[esxi_drs]
+scope = host
+label = ESXI DRS
+value = '[ Verify Manually on ESXi Host ]'
+recommended = esxi_drs
+
+[vm_cpu]
+scope = cpu
+label = [{vm}] Total vCPUs
+value = numCpu
+recommended = str(max(int(minimum_cpu), numCpu))
+check = numCpu >= float(minimum_cpu)
+
+[vm_cpu_reservation]
+scope = cpu
+label = [{vm}] CPU Reservation
+value = cpuReservationText
+recommended = str(cpuMhz * numCpu) + ' Mhz'
+check = cpuReservation != 0 and cpuReservation >= cpuMhz * numCpu
+
+[vm_htsharing]
+scope = cpu
+label = [{vm}] HT Sharing
+value = htSharing
+recommended = vm_htsharing
+check = htSharing == vm_htsharing
+
+[vm_memory]
+scope = memory
+label = [{vm}] Total Memory
+value = memoryGB + ' GB'
+recommended = '>=' + minimum_memory + ' GB'
+check = memoryMB / 1024 >= float(minimum_memory)
+
+[vm_memory_reservation]
+scope = memory
+label = [{vm}] Memory Reservation
+value = str(memReservationGB) + ' GB'
+recommended = memoryGB + ' GB'
+check = float(memReservationGB) >= float(memoryGB)
+
+[vm_vnic]
+scope = nic
+label = [{vm}] NIC
+value = nic
+recommended = vnic
+check = vnic in nic.lower()
+
+[vm_scsi_controller_type]
+scope = scsi
+label = [{vm}] SCSI Controllers Type
+value = controller
+recommended = scsi_controller_type
+check = controllerType == scsi_controller_type
+
+[vm_disk_controllers]
+scope = controllers
+label = [{vm}] [<Controller>:<tot_disks>]
+value = controllerDisks
+recommended = disk_controllers
+check = balanced
+
+[vm_storage_io]
+scope = storage_io
+label = [{vm}] {target} I/O
+value = text
+recommended = 'p95 <= ' + disk_latency_ms + ' ms'
+check = max(readLatency, writeLatency) <= float(disk_latency_ms) if samples else None
+
+[vm_disk_provisioning]
+scope = disk
+label = [{vm}] {disk} ({disk_type})
+value = ('Thick Provisioned' if thick else 'Thin Provisioned ') + '| Ctrl: ' + controller_unit + ' | Size: ' + str(sizeGB) + ' GB'
+recommended = setting(disk_type + '_disk_provision_type')
+check = thick and setting(disk_type + '_disk_provision_type') == 'Thick'
+
+[vm_storagepathpolicy]
+scope = path
+label = [{vm}] StoragePathPolicy( HDD {hdd} )
+value = ('NAS - ' if nas else '') + policy + (' (Round Robin)' if policy == 'VMW_PSP_RR' else '')
+recommended = vm_storagepathpolicy
+check = policy == vm_storagepathpolicy
+
+[contention]
+scope = contention
+label = [{entity}] {metric}
+value = text
+recommended = 'p95 <= ' + setting(counter) + ' ' + unit
+check = p95 <= float(setting(counter)) if samples else None
+"""
+
+# Facts available to the rules of each scope, see PrintVmInfo()
+VM_RULE_FACTS = ('vm', 'numCpu', 'numCoresPerSocket', 'cpuMhz', 'cpuReservation', 'cpuReservationText', 'htSharing',
+                 'memoryMB', 'memoryGB', 'memReservation', 'memReservationGB', 'controllerDisks', 'controllerLuns',
+                 'balanced')
+RULE_SCOPES = OrderedDict([
+    ('host', ('name', 'connected_host', 'hardware', 'version', 'cpu_type', 'cpuMhz', 'numCpuPkgs', 'numCpuCores',
+              'allocCPU', 'allocMEM', 'htConfig', 'powerMgmt', 'memoryGB', 'memoryUsedGB', 'cluster', 'clusterHosts',
+              'clusterCpuCores', 'clusterAllocCPU', 'clusterMemoryGB', 'clusterAllocMEM')),
+    ('cpu', VM_RULE_FACTS),
+    ('memory', VM_RULE_FACTS),
+    ('nic', ('vm', 'nic')),
+    ('scsi', ('vm', 'controller', 'controllerType')),
+    ('controllers', VM_RULE_FACTS),
+    ('disk', ('vm', 'disk', 'disk_type', 'thick', 'controller_unit', 'sizeGB')),
+    ('storage_io', ('vm', 'target', 'disks', 'samples', 'readLatency', 'writeLatency', 'iops', 'text')),
+    ('path', ('vm', 'hdd', 'policy', 'nas')),
+    ('contention', ('entity', 'metric', 'counter', 'unit', 'samples', 'p50', 'p95', 'max', 'text')),
+])
+RULE_FUNCTIONS = {'str': str, 'int': int, 'float': float, 'max': max, 'min': min, 'abs': abs, 'len': len, 'round': round}
+RULE_METHODS = ('lower', 'upper', 'strip', 'startswith', 'endswith')
+RULE_NODES = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.BinOp, ast.Add,
+              ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+              ast.In, ast.NotIn, ast.IfExp, ast.Call, ast.Name, ast.Attribute, ast.Constant, ast.Load)
+
+class rule(object):
+    def __init__(self, name, scope, label, value, recommended, check):
+        self.name = name
+        self.scope = scope
+        self.label = label
+        self.value = value
+        self.recommended = recommended
+        self.check = check
+
+class ruleset(object):
+    # Rules are parsed and compiled once; evaluate() then only runs the
+    # compiled expressions over a table of fact rows.
+    def __init__(self, filename=None):
+        config = configparser.ConfigParser(interpolation=None)
+        config.optionxform = str
+        config.read_string(DEFAULT_RULES)
+        if filename:
+            with open(filename) as f:
+                config.read_file(f)
+        self.settings = dict(config.items('dx_settings')) if config.has_section('dx_settings') else {}
+        self.rules = OrderedDict((x, []) for x in RULE_SCOPES)
+        for name in config.sections():
+            if name == 'dx_settings':
+                continue
+            section = config[name]
+            if not section.getboolean('enabled', True):
+                continue
+            scope = section.get('scope')
+            if scope not in RULE_SCOPES:
+                raise ValueError("rule [{}]: scope must be one of {}".format(name, ", ".join(RULE_SCOPES)))
+            if not section.get('label') or not section.get('value'):
+                raise ValueError("rule [{}]: label and value are required".format(name))
+            names = set(RULE_SCOPES[scope]) | set(self.settings) | set(RULE_FUNCTIONS) | set(['setting'])
+            self._check_label(name, section['label'], RULE_SCOPES[scope])
+            self.rules[scope].append(rule(name, scope, section['label'],
+                                          self._compile(name, 'value', section['value'], names),
+                                          self._compile(name, 'recommended', section.get('recommended'), names),
+                                          self._compile(name, 'check', section.get('check'), names)))
+        self._globals = dict(RULE_FUNCTIONS, __builtins__={}, setting=self.settings.get)
+
+    def _check_label(self, name, label, facts):
+        # A label may only name facts of its scope, as {fact} with an optional
+        # format spec; no positional, attribute or index fields
+        try:
+            fields = list(string.Formatter().parse(label))
+        except ValueError as e:
+            raise ValueError("rule [{}] label: {}".format(name, e))
+        for literal, field, spec, conversion in fields:
+            if field is None:
+                continue
+            if field not in facts:
+                raise ValueError("rule [{}] label: unknown fact {{{}}}".format(name, field))
+            if spec and '{' in spec:
+                raise ValueError("rule [{}] label: nested fields are not allowed in {{{}}}".format(name, field))
+
+    def _compile(self, name, key, text, names):
+        if text is None:
+            return None
+        try:
+            tree = ast.parse(text.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ValueError("rule [{}] {}: {}".format(name, key, e))
+        for node in ast.walk(tree):
+            if not isinstance(node, RULE_NODES):
+                raise ValueError("rule [{}] {}: {} is not allowed".format(name, key, type(node).__name__))
+            if isinstance(node, ast.Name) and node.id not in names:
+                raise ValueError("rule [{}] {}: unknown name {}".format(name, key, node.id))
+            if isinstance(node, ast.Attribute) and node.attr not in RULE_METHODS:
+                raise ValueError("rule [{}] {}: .{} is not allowed".format(name, key, node.attr))
+        return compile(tree, "<rule {} {}>".format(name, key), 'eval')
+
+    def evaluate(self, scope, rows):
+        # One result per row and rule of the scope, rows first
+        results = []
+        for row in rows:
+            names = dict(self.settings)
+            names.update(row)
+            for r in self.rules[scope]:
+                result = {'scope': scope, 'rule': r.name, 'label': r.label, 'recommended': "N/A",
+                          'result': "N/A"}
+                try:
+                    result['label'] = r.label.format(**row)
+                    result['value'] = eval(r.value, self._globals, names)
+                    if r.recommended is not None:
+                        result['recommended'] = eval(r.recommended, self._globals, names)
+                    if r.check is not None:
+                        # a check returning None does not apply to the row
+                        check = eval(r.check, self._globals, names)
+                        result['result'] = "N/A" if check is None else "Pass" if check else "Fail"
+                except Exception as e:
+                    logger.error("rule [{}] failed on {}: {}".format(r.name, row, e))
+                    result.setdefault('value', "")
+                    result['result'] = "Error"
+                results.append(result)
+        return results
+
+def print_rule_results(results, host, vm):
+    for result in results:
+        report.result(dict(result, host=host, vm=vm))
+
+def rule_result(results, name):
+    for result in results:
+        if result['rule'] == name:
+            return result['result']
+    return "N/A"
+
+def host_storage_facts(scsiLun, luns):
+    # LUNs are indexed by key and canonical name so the per-disk path policy
+    # check is a dict lookup. Only the resolved policies are kept.
+    lun_by_key = dict((x.key, x) for x in scsiLun)
+    policy_by_name = {}
+    for x in luns:
+        lun = lun_by_key.get(x.lun)
+        if lun is not None and lun.lunType == "disk":
+            policy_by_name[lun.canonicalName] = x.policy.policy
+    return {'policies': [x.policy.policy for x in luns], 'policy_by_name': policy_by_name}
+
+def get_host_storage(content, vcenter, host):
+    # Storage device info of an ESXi host, fetched once per run and shared by
+    # every VM and disk on that host.
+    with host_storage_lock:
+        storage = host_storage_cache.setdefault((vcenter, host._moId), {'lock': threading.Lock()})
+    with storage['lock']:
+        if 'facts' not in storage:
+            props = GetObjectProperties(content, [host], HOST_STORAGE_PROPS, vim.HostSystem)[0]
+            debug_record("storage:{}:{}".format(vcenter, host._moId), lambda: props)
+            storage['facts'] = host_storage_facts(props.get('config.storageDevice.scsiLun', []),
+                                                  props.get('config.storageDevice.multipathInfo.lun', []))
+    return storage['facts']
+
+def get_datastores(content, vcenter, datastores):
+    # Datastore info for the given datastores, cached per run like host
+    # storage. Entries this call is the first to ask for are reserved (locked)
+    # under host_storage_lock and fetched in one request outside of it, so
+    # callers only wait for the datastores they share.
+    mine = []
+    entries = []
+    with host_storage_lock:
+        for x in datastores:
+            key = (vcenter, x._moId)
+            if key not in datastore_cache:
+                datastore_cache[key] = {'lock': threading.Lock()}
+                datastore_cache[key]['lock'].acquire()
+                mine.append(x)
+            entries.append((x, datastore_cache[key]))
+    try:
+        if mine:
+            for props in GetObjectProperties(content, mine, DATASTORE_PROPS, vim.Datastore):
+                debug_record("datastore:{}:{}".format(vcenter, props['moref']._moId), lambda: props)
+                datastore_cache[(vcenter, props['moref']._moId)]['facts'] = datastore_facts(props)
+    finally:
+        for x in mine:
+            datastore_cache[(vcenter, x._moId)]['lock'].release()
+    facts = {}
+    for x, entry in entries:
+        with entry['lock']:
+            if 'facts' not in entry:
+                # the request that reserved it failed, fetch it on its own
+                props = GetObjectProperties(content, [x], DATASTORE_PROPS, vim.Datastore)[0]
+                entry['facts'] = datastore_facts(props)
+        facts[x._moId] = entry['facts']
+    return facts
+
+def vm_facts(props):
+    # Reduces the properties of one VM (an entry of GetProperties()) to plain
+    # values. The checks only read these dicts, so they run the same way on a
+    # live host and on a snapshot file.
+    host = props.get('runtime.host')
+    vm = {
+        'moid': props['moref']._moId,
+        'name': props.get('name'),
+        'powerState': str(props.get('runtime.powerState')),
+        'host': host._moId if host is not None else None,
+        'numCpu': props.get('config.hardware.numCPU', 0),
+        'memoryMB': props.get('config.hardware.memoryMB', 0),
+        'numCoresPerSocket': props.get('config.hardware.numCoresPerSocket'),
+        'htSharing': str(props.get('config.flags.htSharing')),
+        'cpuLimit': props.get('resourceConfig.cpuAllocation.limit'),
+        'cpuReservation': props.get('resourceConfig.cpuAllocation.reservation'),
+        'memLimit': props.get('resourceConfig.memoryAllocation.limit'),
+        'memReservation': props.get('resourceConfig.memoryAllocation.reservation'),
+        'ipAddress': props.get('guest.ipAddress'),
+        'devices': [],
+    }
+    for dev in props.get('config.hardware.device', []):
+        if (dev.key >= 1000) and (dev.key < 2000):
+            vm['devices'].append({'key': dev.key, 'label': dev.deviceInfo.label, 'summary': dev.deviceInfo.summary,
+                                  'busNumber': dev.busNumber, 'device': list(dev.device),
+                                  'lsilogic': isinstance(dev, vim.vm.device.VirtualLsiLogicController)})
+        elif (dev.key >= 2000) and (dev.key < 3000):
+            datastore = getattr(dev.backing, 'datastore', None)
+            vm['devices'].append({'key': dev.key, 'label': dev.deviceInfo.label, 'controllerKey': dev.controllerKey,
+                                  'unitNumber': dev.unitNumber, 'capacityInKB': dev.capacityInKB,
+                                  'thinProvisioned': getattr(dev.backing, 'thinProvisioned', None),
+                                  'eagerlyScrub': getattr(dev.backing, 'eagerlyScrub', None),
+                                  'fileName': dev.backing.fileName,
+                                  'datastore': datastore._moId if datastore is not None else None})
+        elif (dev.key >= 4000) and (dev.key < 5000):
+            vm['devices'].append({'key': dev.key, 'label': dev.deviceInfo.label,
+                                  'macAddress': getattr(dev, 'macAddress', None),
+                                  'type': type(dev).__name__.split(".")[-1]})
+    return vm
+
+def host_facts(props, clusters={}):
+    # clusters maps cluster moid -> name, see GetHostProperties()
+    hardware = props['summary.hardware']
+    hyperThread = props.get('config.hyperThread')
+    parent = props.get('parent')
+    return {
+        'moid': props['moref']._moId,
+        'name': props.get('name'),
+        'cpuModel': hardware.cpuModel,
+        'cpuMhz': hardware.cpuMhz,
+        'numCpuPkgs': hardware.numCpuPkgs,
+        'numCpuCores': hardware.numCpuCores,
+        'numCpuThreads': hardware.numCpuThreads,
+        'memorySize': hardware.memorySize,
+        'overallMemoryUsage': props.get('summary.quickStats.overallMemoryUsage', 0),
+        'vMotionEnabled': props.get('summary.config.vmotionEnabled'),
+        'PowerMgmtPolicy': props.get('hardware.cpuPowerManagementInfo.currentPolicy'),
+        'CPUhyperThreadingConfig': hyperThread.config if hyperThread else None,
+        'CPUhyperThreadingAvailable': hyperThread.available if hyperThread else None,
+        'CPUhyperThreadingActive': hyperThread.active if hyperThread else None,
+        'Hardware': "{} {}".format(props.get('hardware.systemInfo.vendor'), props.get('hardware.systemInfo.model')),
+        'cluster': clusters.get(parent._moId) if parent is not None else None,
+        # the (cluster) ComputeResource of the host; cluster names are only
+        # unique within a datacenter, so the rollups are keyed by this
+        'parent': parent._moId if parent is not None else None,
+    }
+
+def datastore_facts(props):
+    info = props.get('info')
+    ds = {'moid': props['moref']._moId, 'name': props.get('name'), 'type': None}
+    # ds:///vmfs/volumes/<uuid>/, the instance of the datastore perf counters
+    url = getattr(info, 'url', None)
+    ds['uuid'] = url.rstrip('/').split('/')[-1] if url else None
+    if hasattr(info, 'vmfs'):
+        ds['type'] = 'vmfs'
+        ds['extents'] = [x.diskName for x in info.vmfs.extent]
+    elif hasattr(info, 'nas'):
+        ds['type'] = 'nas'
+        ds['nas_name'] = info.nas.name
+    return ds
+
+def new_inventory(host, content):
+    # Everything the checks read, keyed by managed object id. A live run fills
+    # it as VMs are checked; --capture fills it in one pass and writes it out.
+    return {
+        'format': 'chk_esxi_settings-snapshot',
+        'version': SNAPSHOT_VERSION,
+        'connected_host': host,
+        'about': {'version': content.about.version, 'build': content.about.build},
+        'hosts': OrderedDict(),
+        'storage': {},
+        'datastores': {},
+        'vms': [],
+    }
+
+def collect_vm_facts(content, inventory, vm, name=None):
+    with profile_phase("device walk " + (name or vm._moId)):
+        props = GetObjectProperties(content, [vm], VM_PROPS, vim.VirtualMachine)[0]
+    with profile_phase("storage path check"):
+        update_storage_facts(content, inventory, props)
+    return vm_facts(props)
+
+def update_storage_facts(content, inventory, props, host_storage=True):
+    # Adds the host storage and datastore info the disks of a VM refer to.
+    # --watch keeps the host storage up to date itself (host_storage=False).
+    vcenter = inventory['connected_host']
+    host = props.get('runtime.host')
+    if host is not None and host_storage:
+        inventory['storage'][host._moId] = get_host_storage(content, vcenter, host)
+    datastores = {}
+    for dev in props.get('config.hardware.device', []):
+        datastore = getattr(getattr(dev, 'backing', None), 'datastore', None)
+        if isinstance(dev, vim.vm.device.VirtualDisk) and datastore is not None:
+            datastores[datastore._moId] = datastore
+    inventory['datastores'].update(get_datastores(content, vcenter, list(datastores.values())))
+
+def write_snapshot(filename, snapshot):
+    with gzip.open(filename, 'wt') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+
+def read_snapshot(filename):
+    with gzip.open(filename, 'rt') as f:
+        snapshot = json.load(f, object_pairs_hook=OrderedDict)
+    if snapshot.get('format') != 'chk_esxi_settings-snapshot' or snapshot.get('version') != SNAPSHOT_VERSION:
+        raise ValueError("{} is not a chk_esxi_settings snapshot (version {})".format(filename, SNAPSHOT_VERSION))
+    return snapshot
 
 def find_scsictrl_balanced(scsi_hdd_cnt):
     prevVal = 0
@@ -200,183 +987,185 @@ def find_scsictrl_balanced(scsi_hdd_cnt):
         break
     return ctrl_balanced        
 
-def PrintVmInfo(args, vm, content, vchtime, esxiinfo):
-    tbd = "[ Verify Manually on ESXi Host ]"
-    nav = "N/A"
-    sep = "="
-    disk_list = []
-    network_list = []
-    scsi_contr_list = []
-    controller_units = []
-
-    dx_setting = GetParserInfo()
-    logger.info("dx_setting: \n{}".format(dx_setting))
-
-    summary = vm.summary
-    myconfig = vm.config
-    vm_hardware = vm.config.hardware
-    logger.info("summary: \n{}".format(summary))
-
-    dict_tree = lambda: defaultdict(dict_tree)
-    vm_info = dict_tree()
-    hdd = dict_tree()
-    logger.info("dict_tree: {}".format(dict_tree))
+class scsicontroller(object):
+    __slots__ = ('key', 'label', 'summary', 'busNumber', 'lsilogic', 'disks')
+
+    def __init__(self, dev):
+        self.key = dev['key']
+        self.label = dev['label']
+        self.summary = dev['summary']
+        self.busNumber = dev['busNumber']
+        self.lsilogic = dev.get('lsilogic', False)
+        self.disks = 0
+
+class virtualdisk(object):
+    __slots__ = ('key', 'label', 'controllerKey', 'busNumber', 'unitNumber', 'sizeGB', 'thick', 'datastore')
+
+    def __init__(self, dev):
+        self.key = dev['key']
+        self.label = dev['label']
+        self.controllerKey = dev['controllerKey']
+        self.busNumber = None
+        self.unitNumber = dev['unitNumber']
+        self.sizeGB = dev['capacityInKB'] / 1024 / 1024
+        self.thick = dev['thinProvisioned'] is False
+        self.datastore = dev['datastore']
+
+    @property
+    def controller_unit(self):
+        # <bus>:<unit>, scsi<bus>:<unit> is the virtualDisk counter instance
+        return "{}:{}".format(self.busNumber, self.unitNumber)
+
+class virtualnic(object):
+    __slots__ = ('label', 'macAddress', 'type')
+
+    def __init__(self, dev):
+        self.label = dev['label']
+        self.macAddress = dev['macAddress']
+        self.type = dev['type']
+
+class vmdevices(object):
+    # SCSI controllers, virtual disks and NICs of a vm_facts() dict, built
+    # in one walk of its devices and shared by all device checks
+    __slots__ = ('controllers', 'disks', 'nics')
+
+    def __init__(self, devices):
+        self.controllers = []
+        self.disks = []
+        self.nics = []
+        for dev in devices:
+            if (dev['key'] >= 1000) and (dev['key'] < 2000):
+                self.controllers.append(scsicontroller(dev))
+            elif (dev['key'] >= 2000) and (dev['key'] < 3000):
+                self.disks.append(virtualdisk(dev))
+            elif (dev['key'] >= 4000) and (dev['key'] < 5000):
+                self.nics.append(virtualnic(dev))
+        controllers = dict((x.key, x) for x in self.controllers)
+        for disk in self.disks:
+            controller = controllers.get(disk.controllerKey)
+            if controller is not None:
+                disk.busNumber = controller.busNumber
+                controller.disks += 1
+        self.disks.sort(key=lambda x: x.label)
+
+def vm_check_results(args, vm, inventory, esxiinfo, with_host, perf=None):
+    # Builds the fact tables of one VM (and of its ESXi host if with_host) and
+    # runs the rules over them. Returns the results per scope and the VM row.
+    # perf holds the query_perf() samples of a live run.
+    disk_type = args.disk_type
+
+    # vm is the dict built by vm_facts(); its ESXi host, datastores and host
+    # storage info are looked up in inventory (see new_inventory()).
+    esxihost = inventory['hosts'][vm['host']]
+    debug_record("vm:{}:{}".format(inventory['connected_host'], vm['moid']), lambda: vm)
+    devices = vmdevices(vm['devices'])
 
     # Convert limit and reservation values from -1 to None
-    if vm.resourceConfig.cpuAllocation.limit == -1:
-        vmcpulimit = "None"
+    if vm['cpuReservation'] == 0:
+        vmcpures = "None"
     else:
-        vmcpulimit = "{} Mhz".format(vm.resourceConfig.cpuAllocation.limit)
+        vmcpures = "{} Mhz".format(vm['cpuReservation'])
 
-    if vm.resourceConfig.memoryAllocation.limit == -1:
-        vmmemlimit = "None"
-    else:
-        vmmemlimit = "{} MB".format(vm.resourceConfig.cpuAllocation.limit)
+    vm_name = vm['name'].lower()
 
-    if vm.resourceConfig.cpuAllocation.reservation == 0:
-        vmcpures = "None"
-    else:
-        vmcpures = "{} Mhz".format(vm.resourceConfig.cpuAllocation.reservation)
+    # Disks per LSI Logic controller, controllers 0 - 3 are always listed
+    scsi_hdd_cnt = dict(('SCSI controller {}'.format(x), 0) for x in range(4))
+    for controller in devices.controllers:
+        if controller.lsilogic:
+            scsi_hdd_cnt[controller.label] = controller.disks
 
-    if vm.resourceConfig.memoryAllocation.reservation == 0:
-        vmmemres = "None"
-    else:
-        vmmemres = "{} MB".format(vm.resourceConfig.memoryAllocation.reservation)
+    #controller0=4 controller1=0 controller2=0 controller3=0
+    ctrl_string = " ".join("{}={}".format(x.replace("SCSI ", "").replace(" ", ""), scsi_hdd_cnt[x])
+                           for x in sorted(scsi_hdd_cnt, reverse=True))
+    ctrl_balanced = find_scsictrl_balanced(scsi_hdd_cnt)
 
-    
-    logger.info("vm_hardware: {}".format(vm_hardware))
-
-    for each_vm_hardware in vm_hardware.device:
-        if (each_vm_hardware.key >= 1000) and (each_vm_hardware.key < 2000):
-            vm_info['scsi'][each_vm_hardware.key]['label'] = each_vm_hardware.deviceInfo.label
-            vm_info['scsi'][each_vm_hardware.key]['summary'] = each_vm_hardware.deviceInfo.summary
-            scsi_contr_list.append('{} | {}'.format(each_vm_hardware.deviceInfo.label,
-                                                    each_vm_hardware.deviceInfo.summary))
-            for device_key in each_vm_hardware.device:
-                vm_info['disks'][device_key]['busNumber'] = each_vm_hardware.busNumber
-
-        elif (each_vm_hardware.key >= 2000) and (each_vm_hardware.key < 3000):
-            vm_info['disks'][each_vm_hardware.key]['label'] = each_vm_hardware.deviceInfo.label
-            vm_info['disks'][each_vm_hardware.key]['unitNumber'] = each_vm_hardware.unitNumber
-            vm_info['disks'][each_vm_hardware.key]['capacity'] = each_vm_hardware.capacityInKB / 1024 / 1024
-            vm_info['disks'][each_vm_hardware.key]['thinProvisioned'] = each_vm_hardware.backing.thinProvisioned
-            vm_info['disks'][each_vm_hardware.key]['fileName'] = each_vm_hardware.backing.fileName
-
-            thickProvisioned = ""
-            eagerZero = ""
-
-            if (each_vm_hardware.backing.thinProvisioned is False):
-                thickProvisioned = 'true'
-                if (each_vm_hardware.backing.eagerlyScrub is True):
-                    eagerZero = 'true'
-                else:
-                    eagerZero = 'true'
-            else:
-                thickProvisioned = 'false'
-                eagerZero = 'NA'
-
-            hdd[each_vm_hardware.deviceInfo.label]['eagerZero'] = eagerZero
-            hdd[each_vm_hardware.deviceInfo.label]['thickProvisioned'] = thickProvisioned
-            hdd[each_vm_hardware.deviceInfo.label]['controller_unit'] = str(
-                vm_info['disks'][each_vm_hardware.key]['busNumber']) + ':' + str(each_vm_hardware.unitNumber)
-            controller_units.append(
-                str(vm_info['disks'][each_vm_hardware.key]['busNumber']) + ':' + str(each_vm_hardware.unitNumber))
-
-            hdd[each_vm_hardware.deviceInfo.label]['controller'] = str(
-                vm_info['disks'][each_vm_hardware.key]['busNumber'])
-
-            hdd[each_vm_hardware.deviceInfo.label]['sizeGB'] = each_vm_hardware.capacityInKB / 1024 / 1024
-
-            disk_list.append(
-                '{} | {:.1f}GB | Thin: {} | {} | Controller: {}:{}'.format(each_vm_hardware.deviceInfo.label,
-                                                                           each_vm_hardware.capacityInKB / 1024 / 1024,
-                                                                           each_vm_hardware.backing.thinProvisioned,
-                                                                           each_vm_hardware.backing.fileName,
-                                                                           vm_info['disks'][each_vm_hardware.key][
-                                                                               'busNumber'],
-                                                                           each_vm_hardware.unitNumber))
-        elif (each_vm_hardware.key >= 4000) and (each_vm_hardware.key < 5000):
-            device_name = type(each_vm_hardware).__name__.split(".")[-1]
-            # network_list.append('{} | {} | {}'.format(each_vm_hardware.deviceInfo.label, each_vm_hardware.deviceInfo.summary, device_name))
-            network_list.append(
-                '{} | {} | {}'.format(each_vm_hardware.deviceInfo.label, each_vm_hardware.macAddress, device_name))
+    # Controller balance information
+    ctrl = [0, 0, 0, 0]
+    for disk in devices.disks:
+        if disk.busNumber in (0, 1, 2, 3):
+            ctrl[disk.busNumber] += 1
+    scsiCtrlCnt = "[ SCSI0:{} | SCSI1:{} | SCSI2:{} | SCSI3:{} ]".format(*ctrl)
+
+    vm_memory = "{:.0f}".format((float(vm['memoryMB']) / 1024))
+    if vm['memReservation'] == 0:
+        vm_memres = 0
+    else:
+        vm_memres = "{:.1f}".format(float(vm['memReservation']) / 1024)
+
+    # Fact tables the rules run on, one row per host / VM / device
+    vm_row = {'vm': vm_name, 'numCpu': vm['numCpu'], 'numCoresPerSocket': vm['numCoresPerSocket'],
+              'cpuMhz': esxihost['cpuMhz'], 'cpuReservation': vm['cpuReservation'], 'cpuReservationText': vmcpures,
+              'htSharing': vm['htSharing'], 'memoryMB': vm['memoryMB'], 'memoryGB': vm_memory,
+              'memReservation': vm['memReservation'], 'memReservationGB': vm_memres,
+              'controllerDisks': scsiCtrlCnt, 'controllerLuns': ctrl_string, 'balanced': ctrl_balanced == 'Pass'}
+    nic_rows = [{'vm': vm_name, 'nic': '{} | {} | {}'.format(x.label, x.macAddress, x.type)} for x in devices.nics]
+    scsi_rows = [{'vm': vm_name, 'controller': '{} | {}'.format(x.label, x.summary), 'controllerType': x.summary}
+                 for x in devices.controllers]
+    disk_rows = [{'vm': vm_name, 'disk': x.label, 'disk_type': disk_type, 'thick': x.thick,
+                  'controller_unit': x.controller_unit, 'sizeGB': x.sizeGB} for x in devices.disks]
+
+    path_rows = []
+    storage = inventory['storage'].get(vm['host'])
+    for disk in devices.disks:
+        ds = inventory['datastores'].get(disk.datastore, {'type': None})
+        if ds['type'] == 'vmfs':
+            policies = [storage['policy_by_name'][x] for x in ds['extents'] if x in storage['policy_by_name']]
+            for policy in policies:
+                path_rows.append({'vm': vm_name, 'hdd': disk.label.split(" ")[-1], 'policy': policy, 'nas': False})
+        elif ds['type'] == 'nas':
+            policies = storage['policies']
+            # This is incomplete temporary solution
+            path_rows.append({'vm': vm_name, 'hdd': disk.label.split(" ")[-1],
+                              'policy': str(policies).strip('[]').replace("'",""), 'nas': True})
+        else:
+            logger.debug("{} {} : datastore not VMFS/NAS".format(vm_name, disk.label))
+
+    io_rows = []
+    if perf:
+        io_rows = storage_io_rows(perf, vm, devices.disks, inventory['datastores'])
+
+    host_rows = []
+    if with_host:
+        hostinfo = esxiinfo['hosts'][vm['host']]
+        cluster = esxiinfo['clusters'][hostinfo['rollup']]
+        host_rows.append({'name': esxihost['name'], 'connected_host': esxiinfo['connected_host'],
+                          'hardware': hostinfo['Hardware'], 'version': esxiinfo['esxi_version'],
+                          'cpu_type': re.sub('\s+', ' ', esxihost['cpuModel']), 'cpuMhz': esxihost['cpuMhz'],
+                          'numCpuPkgs': esxihost['numCpuPkgs'], 'numCpuCores': esxihost['numCpuCores'],
+                          'allocCPU': int(hostinfo['totallocatedCPU']), 'allocMEM': int(hostinfo['totallocatedMEM']),
+                          'htConfig': str(hostinfo['CPUhyperThreadingConfig']),
+                          'powerMgmt': hostinfo['PowerMgmtPolicy'],
+                          'memoryGB': int("%.0f" % (float(esxihost['memorySize']) / 1024 / 1024 / 1024)),
+                          'memoryUsedGB': int("{:.0f}".format(float(esxihost['overallMemoryUsage']) / 1024)),
+                          'cluster': hostinfo['cluster'] or 'Standalone', 'clusterHosts': cluster['hosts'],
+                          'clusterCpuCores': cluster['numCpuCores'], 'clusterAllocCPU': cluster['totallocatedCPU'],
+                          'clusterMemoryGB': cluster['memoryGB'], 'clusterAllocMEM': cluster['totallocatedMEM']})
+
+    results = dict((scope, dx_rules.evaluate(scope, rows)) for scope, rows in
+                   [('host', host_rows), ('cpu', [vm_row]), ('memory', [vm_row]), ('nic', nic_rows),
+                    ('scsi', scsi_rows), ('controllers', [vm_row]), ('storage_io', io_rows), ('disk', disk_rows),
+                    ('path', path_rows)])
+    return results, vm_row
+
+def PrintVmInfo(args, vm, inventory, esxiinfo, esxi_info_stat, perf=None):
+    sep = "="
+    esxihost = inventory['hosts'][vm['host']]
+    results, vm_row = vm_check_results(args, vm, inventory, esxiinfo, esxi_info_stat == 1, perf)
+    vm_name = vm_row['vm']
 
     if (esxi_info_stat == 1):
         print("")
         print(
             "+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
-        print("SECTION - I : ESXi Host = " + summary.runtime.host.name)
+        print("SECTION - I : ESXi Host = " + esxihost['name'])
         print(
             "+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
         print("")
         print("{0:50} {1:70} {2:30} {3:10}".format("Settings/Parameters/Version", "Current Value", "Recommended Value",
                                                    "Result"))
         print("{0:50} {1:70} {2:30} {3:10}".format(sep * 50, sep * 70, sep * 30, sep * 10))
-        print("{0:50} {1:70} {2:30} {3:10}".format("ESXI Hardware", esxiinfo['Hardware'] , nav, nav))
-        print("{0:50} {1:70} {2:30} {3:10}".format("ESXI Hostname", summary.runtime.host.name + '(' + args.host + ')',
-                                                   nav, nav))
-        esxi_version_result = "Pass" if esxi_version >= dx_setting['esxi_version'] else "Fail"
-        print("{0:50} {1:70} {2:30} {3:10}".format("ESXI Version", esxi_version,
-                                                   'ESXi ' + dx_setting['esxi_version'] + ' and Higher',
-                                                   esxi_version_result))
-
-        cpu_type = re.sub('\s+', ' ', summary.runtime.host.summary.hardware.cpuModel)
-        print("{0:50} {1:70} {2:30} {3:10}".format("ESXI CPU Type", cpu_type, nav, nav))
-        print(
-            "{0:50} {1:<70} {2:30} {3:10}".format("ESXI CPU Sockets", summary.runtime.host.summary.hardware.numCpuPkgs,
-                                                  nav, nav))
-        print("{0:50} {1:<70} {2:30} {3:10}".format("ESXI Cores Per Socket", (
-                summary.runtime.host.summary.hardware.numCpuCores / summary.runtime.host.summary.hardware.numCpuPkgs),
-                                                    nav, nav))
-        print("{0:50} {1:<70} {2:30} {3:10}".format("ESXi Total CPU", summary.runtime.host.summary.hardware.numCpuCores,
-                                                    nav, nav))
-        # print("{0:50} {1:70} {2:30} {3:10}".format("ESXI Hyperthreading Active",tbd, dx_setting['hyperthreading'], nav))
-
-        esxiAllocCPU = int(esxiinfo['totallocatedCPU'])
-        esxiAllocCPU_fmt = "ESXI Total Allocated CPU"
-        esxiAllocCPU_result = "Pass" if (int(summary.runtime.host.summary.hardware.numCpuCores) - int(
-            esxiAllocCPU)) >= 4 else "Fail"
-        print("{0:50} {1:<70} {2:30} {3:10}".format(esxiAllocCPU_fmt, esxiAllocCPU, "Atleast 4 ESX CPU free",
-                                                    esxiAllocCPU_result))
-
-        esxiHTConfig = str(esxiinfo['CPUhyperThreadingConfig'])
-        esxiHTConfig_fmt = "ESXI Hyperthreading Enabled"
-        esxiHTConfig_result = "Pass" if esxiHTConfig.lower() == dx_setting['esxi_hyperthreading'].lower() else "Fail"
-        print("{0:50} {1:<70} {2:30} {3:10}".format(esxiHTConfig_fmt, esxiHTConfig, dx_setting['esxi_hyperthreading'],
-                                                    esxiHTConfig_result))
-
-        esxiPowerMgmtPolicy = esxiinfo['PowerMgmtPolicy']
-        esxiPowerMgmtPolicy_fmt = "ESXi BIOS Power Management"
-        esxiPowerMgmtPolicy_result = "Pass" if esxiPowerMgmtPolicy == dx_setting['esxi_powermgmt'] else "Fail"
-        print("{0:50} {1:<70} {2:30} {3:10}".format(esxiPowerMgmtPolicy_fmt, esxiPowerMgmtPolicy,
-                                                    dx_setting['esxi_powermgmt'], esxiPowerMgmtPolicy_result))
-
-        # esxi_memory = "{:.0f}".format(float((summary.runtime.host.summary.hardware.memorySize) / 1024 / 1024 / 1024))
-        esxi_memory = "%.0f" % (float(summary.runtime.host.summary.hardware.memorySize) / 1024 / 1024 / 1024)
-        esxi_memory_used = "{:.0f}".format(float(summary.runtime.host.summary.quickStats.overallMemoryUsage) / 1024)
-        print("{0:50} {1:<70} {2:30} {3:10}".format("ESXI Physical Memory", str(esxi_memory) + " GB", nav, nav))
-
-        esxiAllocMEM = int(esxiinfo['totallocatedMEM'])
-        esxiAllocMEM_fmt = "ESXI Total Allocated Memory to all VMs"
-        esxiAllocMEM_result = "Pass" if (int(esxiAllocMEM) / 1024) <= (int(esxi_memory) * 0.9) else "Fail"
-        print("{0:50} {1:<70} {2:30} {3:10}".format(esxiAllocMEM_fmt, str(int(esxiAllocMEM) / 1024) + " GB",
-                                                    "<=" + str((int(esxi_memory) * 0.9)) + " [ 10% free for ESXI ]",
-                                                    esxiAllocMEM_result))
-
-        esxi_memory_free = float(esxi_memory) - float(esxi_memory_used)
-        esxi_memory_reserved = "{:.0f}".format(float(esxi_memory) * 0.10)
-        esxi_memory_reserved_result = "Pass" if float(esxi_memory_reserved) >= float(esxi_memory_free) else "Fail"
-        # print("{0:50} {1:<70} {2:30} {3:10}".format("ESXI Memory Reservation ",str(esxi_memory_used) + " GB (Usage)", str(esxi_memory_reserved) + " GB (10% Reserved)", esxi_memory_reserved_result))
-
-        print("{0:50} {1:<70} {2:30} {3:10}".format("ESXI HA", tbd, dx_setting['esxi_ha'], "N/A"))
-        print("{0:50} {1:<70} {2:30} {3:10}".format("ESXI DRS", tbd, dx_setting['esxi_drs'], "N/A"))
-
-    # if (esxi_info_stat >= 2 ):
-    #    print("")
-    #    print("{0:140}".format('-' * 160))
-
-    vm_name = summary.config.name.lower()
-    vm_ip_addr = summary.guest.ipAddress
+        print_rule_results(results['host'], esxihost['name'], vm_name)
+
     print("")
     print(
         "+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
@@ -384,262 +1173,60 @@ def PrintVmInfo(args, vm, content, vchtime, esxiinfo):
     print(
         "+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
     print("")
-    vm_name_fmt = "[" + vm_name + "]" + " Total vCPUs"
-    vm_min_cpu_result = "Pass" if summary.config.numCpu >= float(dx_setting['minimum_cpu']) else "Fail"
-    print("{0:50} {1:<70} {2:30} {3:10}".format(vm_name_fmt, summary.config.numCpu, str(max(int(dx_setting['minimum_cpu']),summary.config.numCpu)),
-                                                vm_min_cpu_result))
-
-    cpuMhz = summary.runtime.host.summary.hardware.cpuMhz
-    numCpu = summary.config.numCpu
-    vm_vcpu_cores = vm_hardware.numCoresPerSocket
-
-    vmcpu_rec = cpuMhz * numCpu
-
-    if vmcpures != "None":
-        cpures, filler1 = vmcpures.split(" ")
-        if int(cpures) >= int(vmcpu_rec):
-            vmcpures_result = "Pass"
-        else:
-            vmcpures_result = "Fail"
-    else:
-        vmcpures_result = "Fail"
-
-    vm_cpu_res_fmt = "[" + vm_name + "]" + " CPU Reservation"
-    print("{0:50} {1:<70} {2:30} {3:10}".format(vm_cpu_res_fmt, vmcpures, str(vmcpu_rec) + " Mhz", vmcpures_result))
-
-    vm_cpuhtsharing = vm.config.flags.htSharing
-    vm_cpuhtsharing_fmt = "[" + vm_name + "]" + " HT Sharing"
-    vm_cpuhtsharing_result = "Pass" if vm_cpuhtsharing == dx_setting['vm_htsharing'] else "Fail"
-    print("{0:50} {1:<70} {2:30} {3:10}".format(vm_cpuhtsharing_fmt, vm_cpuhtsharing, dx_setting['vm_htsharing'],
-                                                vm_cpuhtsharing_result))
-
+    print_rule_results(results['cpu'], esxihost['name'], vm_name)
     print("")
-
-    vm_memory = "{:.0f}".format((float(summary.config.memorySizeMB) / 1024))
-    vm_memory_fmt = "[" + vm_name + "]" + " Total Memory"
-    vm_memory_result = "Pass" if float(summary.config.memorySizeMB / 1024) >= float(
-        dx_setting['minimum_memory']) else "Fail"
-    print("{0:50} {1:<70} {2:30} {3:10}".format(vm_memory_fmt, str(vm_memory) + " GB",
-                                                ">=" + dx_setting['minimum_memory'] + " GB", vm_memory_result))
-
-    vm_memres = "{:.0f}".format((float(summary.config.memoryReservation) / 1024))
-    vm_memres = 0 if vmmemres == "None" else vmmemres.split(" ")[-1]
-    if vmmemres == "None":
-        vm_memres = 0
-    else:
-        vm_memres, filler1 = str(vmmemres).split(" ")
-        if (filler1 == "MB"):
-            vm_memres = "{:.1f}".format(float(vm_memres) / 1024)
-            # vm_memres = int(vm_memres)/1024
-    vm_memory_res_fmt = "[" + vm_name + "]" + " Memory Reservation"
-    vm_memory_res_result = "Pass" if float(vm_memres) >= float(vm_memory) else "Fail"
-    print("{0:50} {1:<70} {2:30} {3:10}".format(vm_memory_res_fmt, str(vm_memres) + " GB", str(vm_memory) + " GB",
-                                                vm_memory_res_result))
-
+    print_rule_results(results['memory'], esxihost['name'], vm_name)
     print("")
-
-    vm_vnic_fmt = "[" + vm_name + "]" + " NIC"
-    if len(network_list) > 0:
-        for each_vnic in network_list:
-            vnic_result = "Pass" if dx_setting['vnic'] in each_vnic.lower() else "Fail"
-            print("{0:50} {1:70} {2:30} {3:10}".format(vm_vnic_fmt, each_vnic, dx_setting['vnic'], vnic_result))
-
+    print_rule_results(results['nic'], esxihost['name'], vm_name)
     print("")
-
-    vm_scsi_ctrl_fmt = "[" + vm_name + "]" + " SCSI Controllers Type"
-    if len(scsi_contr_list) > 0:
-        for each_scsi in scsi_contr_list:
-            (ctrlName, ctrlType) = each_scsi.split("|")
-            vm_scsi_ctrl_result = "Pass" if ctrlType.strip() == dx_setting['scsi_controller_type'] else "Fail"
-            print("{0:50} {1:70} {2:30} {3:10}".format(vm_scsi_ctrl_fmt, each_scsi, dx_setting['scsi_controller_type'],
-                                                       vm_scsi_ctrl_result))
-
-    scsi_ctrl_dict = {}
-    vmdk_dict = {}
-    scsi_hdd_dict = {}
-    scsi_hdd_cnt = {}
-    scsi_hdd_cnt_base = {'SCSI controller 0': 0, 'SCSI controller 1': 0, 'SCSI controller 2': 0, 'SCSI controller 3': 0}
-    for dev in vm.config.hardware.device:
-      if isinstance(dev, vim.vm.device.VirtualLsiLogicController):
-        scsi_ctrl_dict[dev.key] = dev.deviceInfo.label
-      elif isinstance(dev, vim.vm.device.VirtualDisk):
-        vmdk_dict[dev.deviceInfo.label] = dev.controllerKey
-      else:
-        continue
-
-    #for key, value in sorted(vmdk_dict.iteritems()): #python 2.7
-    for key, value in sorted(vmdk_dict.items()):
-      scsi_hdd_dict.setdefault(value, []).append(key)
-
-    for key in scsi_hdd_dict:
-      scsi_hdd_cnt[scsi_ctrl_dict[key]] = len(scsi_hdd_dict[key])
-
-    for scsi_ctrlr in scsi_hdd_cnt_base:
-        if scsi_ctrlr not in scsi_hdd_cnt:
-            scsi_hdd_cnt[scsi_ctrlr] = 0
-
-    # Sort dict by controller name
-    scsi_hdd_cnt = dict( sorted(scsi_hdd_cnt.items(), key=itemgetter(0),reverse=False))
-
-    #controller0=4 controller1=0 controller2=0 controller3=0
-    ctrl_string = ""
-    for i in scsi_hdd_cnt:
-      ctrl_string = (i.replace("SCSI ","")).replace(" ","") + "=" + str(scsi_hdd_cnt[i]) + " " + ctrl_string
-
-    ctrl_string = ctrl_string.strip()
-    ctrl_balanced = find_scsictrl_balanced(scsi_hdd_cnt)
+    print_rule_results(results['scsi'], esxihost['name'], vm_name)
     print (" ")
 
-    f = open(vm_stats_output, "a")
-    f.write("{}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}\n".format(vm_name, numCpu, vm_vcpu_cores, vmcpures, 'yes' if vmcpures_result == "Pass" else "no", int(math.ceil(float(summary.config.memorySizeMB) / 1024)), int(math.ceil(float(vm_memres))), 'yes' if vm_memory_res_result == "Pass" else "no", vm_memory, vm_cpuhtsharing, 'yes' if vm_cpuhtsharing_result == "Pass" else "no", ctrl_string, 'yes' if ctrl_balanced == "Pass" else "no"))
-    f.close()
-
-    # Controller balance information
-    vm_disk_ctrl_fmt = "[" + vm_name + "]" + " [<Controller>:<tot_disks>]"
-    ctrl = {}
-    ctrl0 = ctrl1 = ctrl2 = ctrl3 = 0
-    for c in controller_units:
-        (ctrl_no, unit) = c.split(":")
-        ctrl[ctrl_no] = int(ctrl_no)
-        if (int(ctrl_no) == 0):
-            ctrl0 += 1
-        elif (int(ctrl_no) == 1):
-            ctrl1 += 1
-        elif (int(ctrl_no) == 2):
-            ctrl2 += 1
-        elif (int(ctrl_no) == 3):
-            ctrl3 += 1
-
-    scsiCtrlCnt = "[ SCSI0:" + str(ctrl0) + " | SCSI1:" + str(ctrl1) + " | SCSI2:" + str(ctrl2) + " | SCSI3:" + str(ctrl3) + " ]"
-    #ctrl_result = "Pass" if (0 in ctrl.values()) and (1 in ctrl.values()) and (2 in ctrl.values()) and (3 in ctrl.values()) else "Fail"
-    ctrl_result = ctrl_balanced
-    print("{0:50} {1:<70} {2:30} {3:10}".format(vm_disk_ctrl_fmt, scsiCtrlCnt, dx_setting['disk_controllers'], ctrl_result))
-
-
-    # display disks properties
-    # print("")
-    vm_hdd_rec_res = ""
-    hdd_labellist = []
-    for hdd_label in hdd.keys():
-        hdd_labellist.append(hdd_label)
-
-    hdd_labellist.sort()
-    for hdd_label in hdd_labellist:
-        vm_hdd_fmt = "[" + vm_name + "] " + hdd_label + " (" + disk_type + ")"
-        if hdd[hdd_label]['thickProvisioned'] == 'true':
-            #vm_hdd_cur_value = "Thick Prov:" + "{0:5}".format(hdd[hdd_label]['thickProvisioned']) + "| Ctrl: " + hdd[hdd_label]['controller_unit'] + " | Size: " + str(hdd[hdd_label]['sizeGB']) + " GB"
-            vm_hdd_cur_value = "Thick Provisioned" + "| Ctrl: " + hdd[hdd_label]['controller_unit'] + " | Size: " + str(hdd[hdd_label]['sizeGB']) + " GB"
-        else:
-            #vm_hdd_cur_value = "Thick Prov:" + "{0:5}".format(hdd[hdd_label]['thickProvisioned']) + "| Ctrl: " + hdd[hdd_label]['controller_unit'] + " | Size: " + str(hdd[hdd_label]['sizeGB']) + " GB"
-            vm_hdd_cur_value = "Thin Provisioned " + "| Ctrl: " + hdd[hdd_label]['controller_unit'] + " | Size: " + str(hdd[hdd_label]['sizeGB']) + " GB"
-
-        disk_provision_format = disk_type + '_disk_provision_format'
-        disk_provision_type = disk_type + '_disk_provision_type'
-        #vm_hdd_rec_value = dx_setting[disk_provision_type] + "," + dx_setting[disk_provision_format]
-        vm_hdd_rec_value = dx_setting[disk_provision_type]
-
-        if hdd[hdd_label]['thickProvisioned'] == 'true' and dx_setting[disk_provision_type] == 'Thick':
-                vm_hdd_rec_res = 'Pass'
-        else:
-            vm_hdd_rec_res = 'Fail'
-
-        print("{0:50} {1:70} {2:30} {3:10}".format(vm_hdd_fmt, vm_hdd_cur_value, vm_hdd_rec_value, vm_hdd_rec_res))
+    report.row('vm_stats', [vm_name, vm['numCpu'], vm['numCoresPerSocket'], vm_row['cpuReservationText'], 'yes' if rule_result(results['cpu'], 'vm_cpu_reservation') == "Pass" else "no", int(math.ceil(float(vm['memoryMB']) / 1024)), int(math.ceil(float(vm_row['memReservationGB']))), 'yes' if rule_result(results['memory'], 'vm_memory_reservation') == "Pass" else "no", vm_row['memoryGB'], vm['htSharing'], 'yes' if rule_result(results['cpu'], 'vm_htsharing') == "Pass" else "no", vm_row['controllerLuns'], 'yes' if vm_row['balanced'] else "no"])
 
+    print_rule_results(results['controllers'], esxihost['name'], vm_name)
+    print_rule_results(results['storage_io'], esxihost['name'], vm_name)
+    print_rule_results(results['disk'], esxihost['name'], vm_name)
     print("")
-    # PrintStoragePolicy(vm, content, vchtime, vm_name)
-    #logger.info("myconfig:")
-    #logger.info(myconfig)
-    for dev in myconfig.hardware.device:
-        # if not isinstance(dev, vim.vm.device.VirtualDisk) or not isinstance(dev.backing, vim.vm.device.VirtualFileBacking):
-        if not isinstance(dev, vim.vm.device.VirtualDisk):
-            continue  # If it isn't a file backing, then it likely isn't on a datastore we can reference
-        ds = dev.backing.datastore
-        logger.info("ds = \n {}".format(ds))
-        logger.info("ds.info = \n {}".format(ds.info))
-        if hasattr(ds.info, 'vmfs'):
-            logger.info("Datastore Type : VMFS")
-            naa = naa = [x.diskName for x in ds.info.vmfs.extent]
-            host = vm.runtime.host
-            storageDeviceInfo = host.configManager.storageSystem.storageDeviceInfo
-            luns = storageDeviceInfo.multipathInfo.lun
-            logger.info("============================================================")
-            logger.info("ds.info.vmfs:")
-            logger.info(ds.info.vmfs)
-            logger.info("============================================================")
-            logger.info("luns:")
-            logger.info(luns)
-            scsiLun = storageDeviceInfo.scsiLun
-            logger.info("============================================================")
-            logger.info("scsiLun:")
-            logger.info(scsiLun)
-            policies = [x.policy for x in luns if get_disk_lun(scsiLun, x.lun, naa)]
-            logger.info("============================================================")
-            logger.info("policies:")
-            logger.info(policies)
-            for policy in policies:
-                # print(dev.deviceInfo.label)
-                # print("Disk %s, policy %s" % (dev.backing.fileName, policy.policy))
-                vm_storagepathpolicy_fmt = "[" + vm_name + "] " + "StoragePathPolicy" + "( HDD " + \
-                                           (dev.deviceInfo.label).split(" ")[-1] + " )"
-                vm_storagepathpolicy = policy.policy
-                vm_storagepathpolicy_result = "Pass" if vm_storagepathpolicy == dx_setting[
-                    'vm_storagepathpolicy'] else "Fail"
-                vm_storagepathpolicy = policy.policy + " (Round Robin)" if policy.policy == "VMW_PSP_RR" else policy.policy
-                print("{0:50} {1:<70} {2:30} {3:10}".format(vm_storagepathpolicy_fmt, vm_storagepathpolicy,
-                                                            dx_setting['vm_storagepathpolicy'],
-                                                            vm_storagepathpolicy_result))
-        elif hasattr(ds.info, 'nas'):
-            logger.info("Datastore Type : NFS")
-            #naa = naa = [x.diskName for x in ds.info.vmfs.extent]
-            naa = ds.info.nas.name
-            host = vm.runtime.host
-            storageDeviceInfo = host.configManager.storageSystem.storageDeviceInfo
-            luns = storageDeviceInfo.multipathInfo.lun
-            logger.info("============================================================")
-            logger.info("ds.info.nas:")
-            logger.info(ds.info.nas)
-            logger.info("ds.info.nas.dynamicProperty:")
-            logger.info(ds.info.nas.dynamicProperty)
-            logger.info("============================================================")
-            logger.info("luns:")
-            logger.info(luns)
-            scsiLun = storageDeviceInfo.scsiLun
-            logger.info("============================================================")
-            logger.info("scsiLun:")
-            logger.info(scsiLun)
-            #policies = [x.policy for x in luns if get_disk_lun(scsiLun, x.lun, naa)]
-            policiesOuter = [x.policy for x in luns ]
-            policies = [x.policy for x in policiesOuter]
-            logger.info("============================================================")
-            logger.info("policies:")
-            logger.info(policies)
-            # This is incomplete temporary solution
-            vm_storagepathpolicy_fmt = "[" + vm_name + "] " + "StoragePathPolicy" + "( HDD " + (dev.deviceInfo.label).split(" ")[-1] + " )"
-            vm_storagepathpolicy = str(policies).strip('[]').replace("'","")
-            vm_storagepathpolicy_result = "Pass" if vm_storagepathpolicy == dx_setting['vm_storagepathpolicy'] else "Fail"
-            vm_storagepathpolicy = "NAS - " + vm_storagepathpolicy + " (Round Robin)" if vm_storagepathpolicy == "VMW_PSP_RR" else "NAS - " + vm_storagepathpolicy
-            print("{0:50} {1:<70} {2:30} {3:10}".format(vm_storagepathpolicy_fmt, vm_storagepathpolicy,
-                                                        dx_setting['vm_storagepathpolicy'],
-                                                        vm_storagepathpolicy_result))
-        else:
-            logger.info("Datastore Type : not VMFS/NAS")
+    print_rule_results(results['path'], esxihost['name'], vm_name)
 
 def GetProperties(content, viewType, props, specType):
     # Build a view and get basic properties for all Virtual Machines
+    objView, pfSpec = ViewFilterSpec(content, viewType, [(specType, props)])
+    gpOutput = RetrieveProperties(content, pfSpec)
+    objView.Destroy()
+    return gpOutput
+
+def ViewFilterSpec(content, viewType, propSets):
+    # FilterSpec over a ContainerView of all objects of viewType, with one
+    # (specType, props) pair per type. The caller destroys the view.
     recursive = True
     objView = content.viewManager.CreateContainerView(content.rootFolder, viewType, recursive)
     tSpec = vim.PropertyCollector.TraversalSpec(name='tSpecName', path='view', skip=False, type=vim.view.ContainerView)
-    pSpec = vim.PropertyCollector.PropertySpec(all=False, pathSet=props, type=specType)
+    pSpecs = [vim.PropertyCollector.PropertySpec(all=False, pathSet=props, type=specType) for specType, props in propSets]
     oSpec = vim.PropertyCollector.ObjectSpec(obj=objView, selectSet=[tSpec], skip=False)
-    pfSpec = vim.PropertyCollector.FilterSpec(objectSet=[oSpec], propSet=[pSpec], reportMissingObjectsInResults=False)
-    retOptions = vim.PropertyCollector.RetrieveOptions()
+    pfSpec = vim.PropertyCollector.FilterSpec(objectSet=[oSpec], propSet=pSpecs, reportMissingObjectsInResults=False)
+    return objView, pfSpec
+
+def GetObjectProperties(content, objs, props, specType):
+    # Same as GetProperties() for a given list of managed objects
+    pSpec = vim.PropertyCollector.PropertySpec(all=False, pathSet=props, type=specType)
+    oSpecs = [vim.PropertyCollector.ObjectSpec(obj=obj, skip=False) for obj in objs]
+    pfSpec = vim.PropertyCollector.FilterSpec(objectSet=oSpecs, propSet=[pSpec], reportMissingObjectsInResults=False)
+    return RetrieveProperties(content, pfSpec)
+
+def RetrieveProperties(content, pfSpec):
+    retOptions = vim.PropertyCollector.RetrieveOptions(maxObjects=RETRIEVE_MAX_OBJECTS)
     totalProps = []
-    retProps = content.propertyCollector.RetrievePropertiesEx(specSet=[pfSpec], options=retOptions)
+    # round trips are told apart by the object types they ask for
+    kind = ",".join(sorted(x.type.__name__ for x in pfSpec.propSet))
+    retProps = roundtrip("RetrievePropertiesEx " + kind, content.propertyCollector.RetrievePropertiesEx,
+                         specSet=[pfSpec], options=retOptions)
     totalProps += retProps.objects
     while retProps.token:
-        retProps = content.propertyCollector.ContinueRetrievePropertiesEx(token=retProps.token)
+        retProps = roundtrip("ContinueRetrievePropertiesEx " + kind,
+                             content.propertyCollector.ContinueRetrievePropertiesEx, token=retProps.token)
         totalProps += retProps.objects
-    objView.Destroy()
     # Turn the output in retProps into a usable dictionary of values
     gpOutput = []
     for eachProp in totalProps:
@@ -650,53 +1237,204 @@ def GetProperties(content, viewType, props, specType):
         gpOutput.append(propDic)
     return gpOutput
 
-def esxi_info(content, viewType, props, vchtime):
-    object_view = content.viewManager.CreateContainerView(content.rootFolder, viewType, True)
-    logger.info(content.rootFolder)
-    logger.info(viewType)
-    logger.debug(object_view)
-    propESXIDic = {}
-
-    totallocatedCPU = 0
-    totallocatedMEM = 0
-    retProps = GetProperties(content, [vim.VirtualMachine], ['name', 'runtime.powerState'], vim.VirtualMachine)
-    logger.debug(retProps)
-    for vm in retProps:
-        retval = PrintAllocCPUMEM(vm['moref'], content, vchtime)
-        totallocatedCPU = int(retval.split(':')[0]) + totallocatedCPU
-        totallocatedMEM = int(retval.split(':')[1]) + totallocatedMEM
-    for obj in object_view.view:
+# Latencies of the round trips of the vsphereclient call running on this
+# thread, see roundtrip() and vsphereclient._run()
+roundtrips = threading.local()
+
+def roundtrip(kind, method, **kwargs):
+    # One SOAP request. Only its own time is recorded, not the lock waits or
+    # cache lookups of the call around it.
+    start = time.time()
+    result = method(**kwargs)
+    samples = getattr(roundtrips, 'samples', None)
+    if samples is not None:
+        samples.append((kind, time.time() - start))
+    return result
+
+def GetHostProperties(content, props):
+    # GetProperties() of all hosts plus cluster moid -> name, in one pass
+    objView, pfSpec = ViewFilterSpec(content, [vim.HostSystem, vim.ClusterComputeResource],
+                                     [(vim.HostSystem, props), (vim.ClusterComputeResource, ['name'])])
+    retProps = RetrieveProperties(content, pfSpec)
+    objView.Destroy()
+    clusters = dict((x['moref']._moId, x['name']) for x in retProps
+                    if isinstance(x['moref'], vim.ClusterComputeResource))
+    return [x for x in retProps if isinstance(x['moref'], vim.HostSystem)], clusters
+
+# Faults vCenter answers with when it is overloaded. The request is retried
+# up to BUSY_RETRIES times after BUSY_BACKOFF, 2 * BUSY_BACKOFF, ... seconds.
+# The fault classes (and their subclasses) are set by load_sdk().
+BUSY_FAULTS = ()
+BUSY_RETRIES = 3
+BUSY_BACKOFF = 1.0
+# A round trip slower than LATENCY_FACTOR times the fastest one of the same
+# kind (see RetrieveProperties()) counts as a sign of load
+LATENCY_FACTOR = 2.0
+
+class aimdlimit(object):
+    # In-flight limit of one vCenter (additive increase, multiplicative
+    # decrease): it grows by one per limit round trips within LATENCY_FACTOR of
+    # the fastest one of the same kind, shrinks by a quarter (at most once per
+    # limit round trips) on slower ones and by half on a busy fault. It stays
+    # within 1 .. cap.
+    def __init__(self, start, cap):
+        self.cap = max(1, cap)
+        self.limit = float(min(max(1, start), self.cap))
+        self.peak = self.limit
+        self.inflight = 0
+        self.baseline = {}
+        self._since = 0
+        self._cond = None
+
+    def reset(self):
+        # asyncio primitives belong to one loop, see vsphereclient.run()
+        self._cond = None
+        self.inflight = 0
+
+    async def acquire(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.inflight < int(self.limit))
+            self.inflight += 1
+
+    async def release(self, samples=(), busy=False):
+        # samples are the (kind, latency) round trips of the request
+        if busy:
+            self.limit = max(1.0, self.limit / 2)
+            self._since = 0
+        for kind, latency in samples:
+            self._since += 1
+            baseline = self.baseline[kind] = min(self.baseline.get(kind, latency), latency)
+            if latency <= LATENCY_FACTOR * baseline:
+                self.limit = min(float(self.cap), self.limit + 1.0 / self.limit)
+            elif self._since >= self.limit:
+                self.limit = max(1.0, self.limit * 0.75)
+                self._since = 0
+        self.peak = max(self.peak, self.limit)
+        async with self._cond:
+            self.inflight -= 1
+            self._cond.notify_all()
+
+def busy_fault(e):
+    return isinstance(e, BUSY_FAULTS)
+
+class vsphereclient(object):
+    # asyncio front end of the sessions (their ServiceContent) of one
+    # vCenter. pyVmomi calls block, so every request runs on an executor
+    # thread against the next session (round robin, each with its own
+    # connection pool). The number of requests in flight follows an
+    # aimdlimit, however many are gathered at once.
+    def __init__(self, contents, inflight, cap):
+        self.contents = contents
+        self.limit = aimdlimit(inflight, cap)
+        self._next = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.limit.cap)
+
+    def _run(self, phase, func, content, args):
+        # result and the round trips it took, see roundtrip()
+        roundtrips.samples = []
+        try:
+            with profile_phase(phase) if phase else nullphase():
+                return func(content, *args), roundtrips.samples
+        finally:
+            roundtrips.samples = None
+
+    async def call(self, phase, func, *args):
+        # func(content, *args) on the next session, e.g. GetProperties
+        loop = asyncio.get_running_loop()
+        for attempt in range(BUSY_RETRIES + 1):
+            content = self.contents[self._next % len(self.contents)]
+            self._next += 1
+            await self.limit.acquire()
+            try:
+                result, samples = await loop.run_in_executor(self._executor, self._run, phase, func, content, args)
+            except vmodl.MethodFault as e:
+                busy = busy_fault(e)
+                await self.limit.release(busy=busy)
+                if not busy or attempt == BUSY_RETRIES:
+                    raise
+                logger.warning("{} : vCenter busy ({}), retry in {}s with {} requests in flight".format(
+                    func.__name__, type(e).__name__, BUSY_BACKOFF * 2 ** attempt, int(self.limit.limit)))
+                await asyncio.sleep(BUSY_BACKOFF * 2 ** attempt)
+                continue
+            except BaseException:
+                await self.limit.release()
+                raise
+            await self.limit.release(samples)
+            return result
+
+    async def gather(self, calls):
+        # calls are (phase, func, args...) tuples, results in the same order
+        return await asyncio.gather(*[self.call(*x) for x in calls])
+
+    def run(self, calls):
+        self.limit.reset()
+        return asyncio.run(self.gather(calls))
+
+    def close(self):
+        self._executor.shutdown()
+        logger.info("in-flight limit : {:.1f} (peak {:.1f}, cap {})".format(self.limit.limit, self.limit.peak, self.limit.cap))
+
+def collect_host_facts(content, props=HOST_PROPS):
+    hosts = OrderedDict()
+    hostProps, clusters = GetHostProperties(content, props)
+    for x in hostProps:
+        hosts[x['moref']._moId] = host_facts(x, clusters)
+    return hosts
+
+def esxi_info(hosts, vms):
+    # hosts are host_facts() by moid, vms the vm_facts() used for the
+    # allocation totals. Every VM counts for the host in its runtime.host,
+    # clusters are keyed by ComputeResource moid and hosts outside a cluster
+    # are rolled up as a cluster of their own.
+    allocated = dict((x, [0, 0]) for x in hosts)
+    for vm in vms:
+        if vm['host'] not in allocated:
+            continue
+        retval = PrintAllocCPUMEM(vm)
+        allocated[vm['host']][0] += int(retval.split(':')[0])
+        allocated[vm['host']][1] += int(retval.split(':')[1])
+
+    propESXIDic = OrderedDict()
+    clusters = OrderedDict()
+    for moid, obj in hosts.items():
+        # rollup per parent ComputeResource, the name is only for display.
+        # Snapshots taken before hosts had a parent roll up by name as before.
+        rollup = obj.get('parent') or ("cluster:" + obj['cluster'] if obj.get('cluster') else moid)
         # Turn the output in retProps into a usable dictionary of values
-        propESXIDic = {
-            'PowerMgmtPolicy': obj.hardware.cpuPowerManagementInfo.currentPolicy,
-            'CPUhyperThreadingConfig': obj.config.hyperThread.config,
-            'CPUhyperThreadingAvailable': obj.config.hyperThread.available,
-            'CPUhyperThreadingActive': obj.config.hyperThread.active,
-            'vMotionEnabled': obj.summary.config.vmotionEnabled,
-            'totallocatedCPU': totallocatedCPU,
-            'totallocatedMEM': totallocatedMEM,
-            'Hardware': obj.hardware.systemInfo.vendor + " " + obj.hardware.systemInfo.model,
-            'esxi_cpus': obj.summary.hardware.numCpuPkgs,
-            'esxi_cores': obj.summary.hardware.numCpuCores,
-            'esxi_threads': obj.summary.hardware.numCpuThreads
+        propESXIDic[moid] = {
+            'name': obj['name'],
+            'cluster': obj.get('cluster'),
+            'rollup': rollup,
+            'PowerMgmtPolicy': obj['PowerMgmtPolicy'],
+            'CPUhyperThreadingConfig': obj['CPUhyperThreadingConfig'],
+            'CPUhyperThreadingAvailable': obj['CPUhyperThreadingAvailable'],
+            'CPUhyperThreadingActive': obj['CPUhyperThreadingActive'],
+            'vMotionEnabled': obj['vMotionEnabled'],
+            'totallocatedCPU': allocated[moid][0],
+            'totallocatedMEM': allocated[moid][1],
+            'Hardware': obj['Hardware'],
+            'esxi_cpus': obj['numCpuPkgs'],
+            'esxi_cores': obj['numCpuCores'],
+            'esxi_threads': obj['numCpuThreads']
         }
-        logger.info("propESXIDic = {}".format(propESXIDic))
-    object_view.Destroy()
-    return propESXIDic
-
-def PrintAllocCPUMEM(vm, content, vchtime):
+        cluster = clusters.setdefault(rollup, {'name': obj.get('cluster') or obj['name'], 'hosts': 0, 'numCpuCores': 0,
+                                               'memoryGB': 0, 'totallocatedCPU': 0, 'totallocatedMEM': 0})
+        cluster['hosts'] += 1
+        cluster['numCpuCores'] += obj['numCpuCores']
+        cluster['memoryGB'] += int("%.0f" % (float(obj['memorySize']) / 1024 / 1024 / 1024))
+        cluster['totallocatedCPU'] += allocated[moid][0]
+        cluster['totallocatedMEM'] += allocated[moid][1]
+    return {'hosts': propESXIDic, 'clusters': clusters}
+
+def PrintAllocCPUMEM(vm):
+    # vm is a vm_facts() dict, so no further round trips are made here.
     allocatedCPU = 0
     allocatedMEM = 0
-    # print("-" * 70)
-    # print("Name:                    {0}".format(vm.name))
-    # print("CPUs:                    {0}".format(vm.config.hardware.numCPU))
-    # print("MemoryMB:                {0}".format(vm.config.hardware.memoryMB))
-    # print("Guest PowerState:        {0}".format(vm.guest.guestState))
-    # print("Guest PowerState:        {0}".format(vm.summary.runtime.powerState))
-    # if vm.guest.guestState == "running" :
-    if vm.summary.runtime.powerState == "poweredOn":
-        allocatedCPU = allocatedCPU + vm.config.hardware.numCPU
-        allocatedMEM = allocatedMEM + vm.config.hardware.memoryMB
+    if vm['powerState'] == "poweredOn":
+        allocatedCPU = allocatedCPU + vm['numCpu']
+        allocatedMEM = allocatedMEM + vm['memoryMB']
         return str(allocatedCPU) + ":" + str(allocatedMEM)
     else:
         return "0:0"
@@ -730,14 +1468,674 @@ def set_log_level_from_verbose(args):
     else:
         logger.critical("UNEXPLAINED NEGATIVE COUNT!")
 
-def main():
-    global disk_type
-    global esxi_version
-    global esxi_build
-    global esxi_info_stat
+def read_inventory(inventory_file):
+    # Inventory lines are "<esxi/vcenter host>,<vm name>"; blank lines and lines
+    # starting with '#' are ignored. VMs are grouped per host so that each
+    # vCenter is only logged into once.
+    inventory = OrderedDict()
+    with open(inventory_file) as inv:
+        for lineno, line in enumerate(inv, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = [x.strip() for x in line.split(',')]
+            if len(fields) != 2 or not fields[0] or not fields[1]:
+                raise ValueError("{}:{}: expected '<host>,<vm>' but got '{}'".format(inventory_file, lineno, line))
+            inventory.setdefault(fields[0], []).append(fields[1].lower())
+    return inventory
+
+def connect_host(args, host, password, quiet=False):
+    try:
+        #logger.info("cert_check_skip : {}".format(args.cert_check_skip))
+        if args.cert_check_skip:
+            context = ssl._create_unverified_context()
+            si = SmartConnect(host=host, user=args.user, pwd=password, port=int(args.port), sslContext=context)
 
-    print("Script Version : 3.0")
-    logger.info("Script Version : 3.0")
+        else:
+            si = SmartConnect(host=host, user=args.user, pwd=password, port=int(args.port))
+
+        debug_record("si:{}".format(host), lambda: si.__dict__)
+    except IOError as e:
+        print("IOError.")
+        print(str(e))
+        logger.error("IOError.")
+        logger.error(str(e))
+        return None
+    except Exception as e:
+        e = sys.exc_info()
+        print(str(e))
+        print("Other Exceptions:")
+        logger.error(str(e))
+        return None
+
+    if not si:
+        print('Could not connect to the specified host using specified username and password')
+        logger.error('Could not connect to the specified host using specified username and password')
+        return None
+
+    if not quiet:
+        print("Connected.")
+    logger.info("Connected.")
+    return si
+
+def check_host(args, si, host, vmnames, sessions=[]):
+    # sessions are the extra logins of --sessions, the property requests are
+    # spread over them and si by a vsphereclient
+    content = si.RetrieveContent()
+    debug_record("content:{}".format(host), lambda: content)
+
+    # Get vCenter date and time for use as baseline when querying for counters
+    vchtime = si.CurrentTime()
+    logger.info("vchtime: {}".format(vchtime))
+
+    client = vsphereclient([content] + [x.RetrieveContent() for x in sessions], args.vm_workers, args.max_inflight)
+    try:
+        return check_host_inventory(args, client, content, vchtime, host, vmnames)
+    finally:
+        client.close()
+
+def check_host_inventory(args, client, content, vchtime, host, vmnames):
+    # The host facts and the VMs are read concurrently, and the VMs only
+    # once; the same list gives the allocation totals and, through
+    # vm_name_index(), the target VMs.
+    inventory = new_inventory(host, content)
+    inventory['hosts'], retProps = client.run([
+        ("esxi_info", collect_host_facts),
+        ("VM lookup", GetProperties, [vim.VirtualMachine], VM_ALLOC_PROPS, vim.VirtualMachine)])
+    debug_record("vms:{}".format(host), lambda: retProps)
+    morefs = dict((x['moref']._moId, x['moref']) for x in retProps)
+    morefs.update((x['runtime.host']._moId, x['runtime.host']) for x in retProps if x.get('runtime.host') is not None)
+    vmlist = [vm_facts(x) for x in retProps]
+
+    def get_perf(targets):
+        # One QueryPerf for the target VMs, their vmdks and datastores and
+        # their ESXi hosts
+        vm_metrics = [(x, "") for x in PERF_VM_COUNTERS] + [(x, "*") for x in PERF_DISK_COUNTERS]
+        entities = [(morefs[x['moid']], vm_metrics) for x in targets]
+        entities += [(morefs[x], [(y, "") for y in PERF_HOST_COUNTERS]) for x in sorted(set(x['host'] for x in targets))]
+        with profile_phase("QueryPerf"):
+            perf = query_perf(content, entities, vchtime, args.perf_window)
+        debug_record("perf:{}".format(host), lambda: perf)
+        return perf
+
+    def get_vm_facts(targets):
+        # The device walks of all targets are in flight at the same time
+        return client.run([(None, collect_vm_facts, inventory, morefs[x['moid']], x['name']) for x in targets])
+
+    return check_inventory(args, inventory, vmlist, vmnames, get_vm_facts, get_perf)
+
+def vm_name_index(vms):
+    # lower case name -> every VM (vm_facts() or GetProperties() entry) with
+    # that name, so looking up the targets does not grow with the vCenter
+    index = {}
+    for vm in vms:
+        index.setdefault(vm['name'].lower(), []).append(vm)
+    return index
+
+def check_inventory(args, inventory, vmlist, vmnames, get_vm_facts, get_perf=None):
+    # Shared by live runs and --replay: vmlist holds at least the
+    # VM_ALLOC_PROPS of every VM and get_vm_facts() returns the full
+    # vm_facts() of a list of targets. get_perf() returns the query_perf()
+    # samples of the targets (live only).
+    host = inventory['connected_host']
+    retESXIProps = esxi_info(inventory['hosts'], vmlist)
+    debug_record("esxi_info:{}".format(host), lambda: retESXIProps)
+
+    #esx_global.csv
+    esxi_info_stat = {}
+    esxi_version   = inventory['about']['version']
+    esxi_build     = inventory['about']['build']
+    esxi_update    = "."
+    esxi_ht_bp     = "False"
+    retESXIProps['esxi_version'] = esxi_version
+    retESXIProps['connected_host'] = host
+
+    for hostinfo in retESXIProps['hosts'].values():
+        report.row('esx_global', [esxi_version,esxi_build,esxi_update,hostinfo['esxi_cpus'],hostinfo['esxi_cores'],hostinfo['esxi_threads'],hostinfo['CPUhyperThreadingActive'],hostinfo['CPUhyperThreadingConfig'],esxi_ht_bp,hostinfo['name'],hostinfo['cluster'] or '',hostinfo['totallocatedCPU'],hostinfo['totallocatedMEM']])
+
+    # Find VM supplied as arg and use Managed Object Reference (moref) for the PrintVmInfo
+    index = vm_name_index(vmlist)
+    vmcount = 0
+    targets = []
+    poweredoff_vm = None
+    for currvm in vmnames:
+        for vm in index.get(currvm, []):
+            vmcount = vmcount + 1
+            if vm['powerState'] == "poweredOn":
+                logger.info ("VM {} found in {} and powered on".format(vm['name'],host ))
+                targets.append(vm)
+            else:
+                logger.info("VM {} found in {} and powered off".format(vm['name'],host ))
+                poweredoff_vm = vm
+                break
+        if poweredoff_vm:
+            break
+
+    perf = None
+    if get_perf and targets:
+        # the contention section is optional, whatever fails there must not
+        # cost the rest of the report
+        try:
+            perf = get_perf(targets)
+        except Exception as e:
+            msg = e.msg if isinstance(e, vmodl.MethodFault) else "{}: {}".format(type(e).__name__, e)
+            logger.error("QueryPerf failed: {}".format(msg))
+            print("Could not query performance counters : {}".format(msg))
+
+    # The facts of all targets are collected concurrently, the checks then
+    # run in inventory order. Section I is printed with the first engine on
+    # each ESXi host.
+    for vm in get_vm_facts(targets):
+        esxi_info_stat[vm['host']] = esxi_info_stat.get(vm['host'], 0) + 1
+        PrintVmInfo(args, vm, inventory, retESXIProps, esxi_info_stat[vm['host']], perf)
+
+    if perf:
+        PrintContention(args, perf, targets, inventory)
+
+    if poweredoff_vm:
+        print('ERROR: Problem connecting to Virtual Machine. {} is likely powered off or suspended'.format(poweredoff_vm['name']))
+        logger.error('ERROR: Problem connecting to Virtual Machine. {} is likely powered off or suspended'.format(poweredoff_vm['name']))
+        return -1
+
+    for currvm in vmnames:
+        if currvm.lower() not in index:
+            logger.error('vm : {} not found on vmware host {}'.format(currvm,host))
+            print('vm : {} not found on vmware host {}'.format(currvm,host))
+            return -1
+    if vmcount == 0:
+        logger.error('vm : {} not found on vmware host {}. Please check vm name. VM Name is case sensitive'.format(currvm,host))
+        print('vm : {} not found on vmware host {}. Please check vm name. VM Name is case sensitive'.format(currvm,host))
+        return -1
+    return 0
+
+def query_perf(content, entities, end, window):
+    # Samples the (counter, instance) metrics of every entity with a single
+    # QueryPerf call, instance "" is the aggregate and "*" every instance.
+    # vCenter keeps the last hour in 20 second samples and older data in
+    # 5 minute samples (5 minute samples of level 2 counters such as costop
+    # need statistics level 2). Returns samples[moid][counter][instance],
+    # one value per sample, None where the host did not collect it.
+    perfManager = content.perfManager
+    counters = dict(("{}.{}.{}".format(x.groupInfo.key, x.nameInfo.key, x.rollupType), x.key)
+                    for x in perfManager.perfCounter)
+    names = dict((v, k) for k, v in counters.items())
+    interval = 20 if window <= 60 else 300
+    start = end - datetime.timedelta(minutes=window)
+    specs = []
+    for entity, wanted in entities:
+        metricId = [vim.PerformanceManager.MetricId(counterId=counters[x], instance=instance)
+                    for x, instance in wanted if x in counters]
+        if not metricId:
+            # an empty metricId would ask for every metric of the entity
+            continue
+        specs.append(vim.PerformanceManager.QuerySpec(entity=entity, metricId=metricId, intervalId=interval,
+                                                      startTime=start, endTime=end, format='normal'))
+    samples = dict((entity._moId, {}) for entity, wanted in entities)
+    for metrics in perfManager.QueryPerf(querySpec=specs) if specs else []:
+        for series in metrics.value:
+            values = [x if x >= 0 else None for x in series.value]
+            samples[metrics.entity._moId].setdefault(names[series.id.counterId], {})[series.id.instance] = values
+    return {'interval': interval, 'window': window, 'samples': samples}
+
+def percentile(values, pct):
+    # Nearest rank percentile of a non empty list
+    values = sorted(values)
+    return values[max(0, int(math.ceil(pct / 100.0 * len(values))) - 1)]
+
+def contention_rows(perf, moid, entity, counters, numCpu=1):
+    # Fact rows of the contention rules. cpu ready/costop are ms per sample,
+    # reported as % of the sample per vCPU; memory is KB, reported as MB;
+    # host cpu usage is in 1/100 %.
+    sample_ms = perf['interval'] * 1000.0
+    metrics = [('cpu.ready.summation', 'cpu_ready_pct', 'CPU Ready per vCPU', '%',
+                lambda x: x * 100.0 / sample_ms / numCpu),
+               ('cpu.costop.summation', 'cpu_costop_pct', 'CPU Co-Stop per vCPU', '%',
+                lambda x: x * 100.0 / sample_ms / numCpu),
+               ('mem.vmmemctl.average', 'mem_balloon_mb', 'Ballooned Memory', 'MB', lambda x: x / 1024.0),
+               ('mem.swapped.average', 'mem_swapped_mb', 'Swapped Memory', 'MB', lambda x: x / 1024.0),
+               ('cpu.usage.average', 'host_cpu_usage_pct', 'ESXi CPU Usage', '%', lambda x: x / 100.0)]
+    samples = perf['samples'].get(moid, {})
+    rows = []
+    for name, counter, metric, unit, convert in metrics:
+        if name not in counters:
+            continue
+        values = [convert(x) for x in samples.get(name, {}).get("", []) if x is not None]
+        row = {'entity': entity, 'metric': metric, 'counter': counter, 'unit': unit, 'samples': len(values),
+               'p50': 0, 'p95': 0, 'max': 0, 'text': 'No samples'}
+        if values:
+            row.update(p50=percentile(values, 50), p95=percentile(values, 95), max=max(values))
+            row['text'] = 'p50 {:.2f} | p95 {:.2f} | max {:.2f} {}'.format(row['p50'], row['p95'], row['max'], unit)
+        rows.append(row)
+    return rows
+
+def combine_series(samples, counter, instances, combine):
+    # Combines the series of several instances sample by sample
+    series = [samples.get(counter, {}).get(x) for x in instances]
+    values = []
+    for sample in zip(*[x for x in series if x]):
+        sample = [x for x in sample if x is not None]
+        if sample:
+            values.append(combine(sample))
+    return values
+
+def storage_io_rows(perf, vm, disks, datastores):
+    # Fact rows of the storage_io rules: one per SCSI controller (its vmdks
+    # are the virtualDisk instances scsi<bus>:<unit>, see virtualdisk) and
+    # one per datastore of the VM. Per sample the slowest instance's
+    # latency (ms) and the summed read + write IOPS, reported as p95.
+    samples = perf['samples'].get(vm['moid'], {})
+    groups = OrderedDict()
+    for disk in sorted(disks, key=lambda x: (str(x.busNumber), x.unitNumber)):
+        groups.setdefault(('virtualDisk', 'SCSI{}'.format(disk.busNumber)), []).append('scsi' + disk.controller_unit)
+    names = dict((x['uuid'], x['name']) for x in datastores.values() if x.get('uuid'))
+    for instance in sorted(samples.get('datastore.totalReadLatency.average', {})):
+        groups[('datastore', 'Datastore ' + names.get(instance, instance))] = [instance]
+
+    rows = []
+    for (group, target), instances in groups.items():
+        read = combine_series(samples, group + '.totalReadLatency.average', instances, max)
+        write = combine_series(samples, group + '.totalWriteLatency.average', instances, max)
+        iops = [r + w for r, w in zip(combine_series(samples, group + '.numberReadAveraged.average', instances, sum),
+                                      combine_series(samples, group + '.numberWriteAveraged.average', instances, sum))]
+        row = {'vm': vm['name'].lower(), 'target': target, 'disks': len(instances), 'samples': max(len(read), len(write)),
+               'readLatency': percentile(read, 95) if read else 0, 'writeLatency': percentile(write, 95) if write else 0,
+               'iops': percentile(iops, 95) if iops else 0, 'text': 'No samples'}
+        if group == 'virtualDisk':
+            row['target'] = '{} ({} disk(s))'.format(target, len(instances))
+        if row['samples']:
+            row['text'] = 'p95 read {} ms | write {} ms | {} IOPS'.format(row['readLatency'], row['writeLatency'],
+                                                                          row['iops'])
+        rows.append(row)
+    return rows
+
+def PrintContention(args, perf, targets, inventory):
+    sep = "="
+    print("")
+    print(
+        "+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
+    print("SECTION - III : Contention = last {} minutes ({} second samples)".format(perf['window'], perf['interval']))
+    print(
+        "+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
+    print("")
+    print("{0:50} {1:70} {2:30} {3:10}".format("Settings/Parameters/Version", "Current Value", "Recommended Value",
+                                               "Result"))
+    print("{0:50} {1:70} {2:30} {3:10}".format(sep * 50, sep * 70, sep * 30, sep * 10))
+    for vm in targets:
+        rows = contention_rows(perf, vm['moid'], vm['name'].lower(), PERF_VM_COUNTERS, vm['numCpu'] or 1)
+        print_rule_results(dx_rules.evaluate('contention', rows), inventory['hosts'][vm['host']]['name'],
+                           vm['name'].lower())
+    for moid in sorted(set(x['host'] for x in targets)):
+        hostname = inventory['hosts'][moid]['name']
+        rows = contention_rows(perf, moid, hostname, PERF_HOST_COUNTERS)
+        print_rule_results(dx_rules.evaluate('contention', rows), hostname, "")
+
+def capture_host(args, si, host, filename):
+    # Collects everything the checks read for every host, VM and datastore in
+    # one bulk pass (one PropertyCollector request per object type) and writes
+    # it to a gzip compressed json snapshot for --replay.
+    content = si.RetrieveContent()
+    vchtime = si.CurrentTime()
+    snapshot = new_inventory(host, content)
+    snapshot['captured'] = vchtime.isoformat()
+    allHostProps, clusters = GetHostProperties(content, HOST_PROPS + HOST_STORAGE_PROPS)
+    for hostProps in allHostProps:
+        moid = hostProps['moref']._moId
+        snapshot['hosts'][moid] = host_facts(hostProps, clusters)
+        snapshot['storage'][moid] = host_storage_facts(hostProps.get('config.storageDevice.scsiLun', []),
+                                                       hostProps.get('config.storageDevice.multipathInfo.lun', []))
+    for dsProps in GetProperties(content, [vim.Datastore], DATASTORE_PROPS, vim.Datastore):
+        snapshot['datastores'][dsProps['moref']._moId] = datastore_facts(dsProps)
+    snapshot['vms'] = [vm_facts(x) for x in GetProperties(content, [vim.VirtualMachine], VM_PROPS, vim.VirtualMachine)]
+    write_snapshot(filename, snapshot)
+    print("Snapshot of {} ESXi hosts, {} VMs and {} datastores written to {}".format(
+        len(snapshot['hosts']), len(snapshot['vms']), len(snapshot['datastores']), filename))
+    logger.info("Snapshot written to {}".format(filename))
+    return 0
+
+def replay_snapshot(args, vmnames):
+    # Runs all checks against a --capture snapshot without any network access
+    snapshot = read_snapshot(args.replay)
+    print("Replaying snapshot of {} captured {}".format(snapshot['connected_host'], snapshot.get('captured')))
+    logger.info("Replaying snapshot {}".format(args.replay))
+    return check_inventory(args, snapshot, snapshot['vms'], vmnames, lambda targets: targets)
+
+class nullphase(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+class profilephase(object):
+    def __init__(self, prof, name):
+        self.prof = prof
+        self.name = name
+    def __enter__(self):
+        self.start = time.time()
+        self.prof._stack().append(self.name)
+        return self
+    def __exit__(self, *exc):
+        self.prof._stack().pop()
+        self.prof._add(self.prof.phases, self.name, wall=time.time() - self.start)
+        return False
+
+class countingresponse(object):
+    # Counts the (compressed) bytes pyVmomi reads of a SOAP response
+    def __init__(self, resp, prof):
+        self._resp = resp
+        self._prof = prof
+    def read(self, *args):
+        data = self._resp.read(*args)
+        self._prof._local.bytes = getattr(self._prof._local, 'bytes', 0) + len(data)
+        return data
+    def __getattr__(self, attr):
+        return getattr(self._resp, attr)
+
+class countingconnection(object):
+    def __init__(self, conn, prof):
+        self._conn = conn
+        self._prof = prof
+    def getresponse(self, *args, **kwargs):
+        return countingresponse(self._conn.getresponse(*args, **kwargs), self._prof)
+    def __getattr__(self, attr):
+        return getattr(self._conn, attr)
+
+class profiler(object):
+    # Records every SOAP call made through pyVmomi's SoapStubAdapter (method,
+    # managed object type, latency and response size) against the innermost
+    # profile_phase() of the calling thread. Only installed with --profile.
+    def __init__(self, filename):
+        self.filename = filename
+        self.phases = OrderedDict()
+        self.methods = OrderedDict()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._calls = open(filename + ".csv", "w")
+        self._calls.write("{}, {}, {}, {}, {}, {}, {}\n".format("time", "thread", "phase", "method", "mo_type", "latency_ms", "bytes"))
+        self._install()
+
+    def _install(self):
+        from pyVmomi import SoapAdapter
+        stub = SoapAdapter.SoapStubAdapter
+        invokeMethod = stub.InvokeMethod
+        invokeAccessor = stub.InvokeAccessor
+        getConnection = stub.GetConnection
+        prof = self
+        def InvokeMethod(self, mo, info, args, outerStub=None):
+            return prof._call(info.name, mo, invokeMethod, self, mo, info, args, outerStub)
+        def InvokeAccessor(self, mo, info):
+            return prof._call("get " + info.name, mo, invokeAccessor, self, mo, info)
+        def GetConnection(self):
+            conn = getConnection(self)
+            return conn if isinstance(conn, countingconnection) else countingconnection(conn, prof)
+        stub.InvokeMethod = InvokeMethod
+        stub.InvokeAccessor = InvokeAccessor
+        stub.GetConnection = GetConnection
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def phase(self, name):
+        return profilephase(self, name)
+
+    def _call(self, method, mo, func, *args):
+        # A property accessor is itself a RetrievePropertiesEx call, only the
+        # outermost call is recorded.
+        if getattr(self._local, 'depth', 0):
+            return func(*args)
+        self._local.depth = 1
+        self._local.bytes = 0
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            latency = time.time() - start
+            self._local.depth = 0
+            stack = self._stack()
+            phase = stack[-1] if stack else "(none)"
+            self._add(self.phases, phase, calls=1, latency=latency, bytes=self._local.bytes)
+            self._add(self.methods, method, calls=1, latency=latency, bytes=self._local.bytes)
+            with self._lock:
+                self._calls.write("{}, {}, {}, {}, {}, {:.1f}, {}\n".format(
+                    datetime.datetime.now().strftime("%H:%M:%S.%f"), threading.current_thread().name, phase,
+                    method, type(mo).__name__, latency * 1000, self._local.bytes))
+                self._calls.flush()
+
+    def _add(self, table, name, **values):
+        with self._lock:
+            row = table.setdefault(name, {'calls': 0, 'latency': 0.0, 'bytes': 0, 'wall': 0.0})
+            for key, value in values.items():
+                row[key] += value
+
+    def write(self):
+        sep = "="
+        with self._lock:
+            self._calls.close()
+            f = open(self.filename + ".txt", "w")
+            for title, table in (("Phase", self.phases), ("SOAP Method", self.methods)):
+                f.write("{0:50} {1:>8} {2:>14} {3:>14} {4:>12}\n".format(title, "Calls", "Latency (s)", "Bytes", "Wall (s)"))
+                f.write("{0:50} {1:>8} {2:>14} {3:>14} {4:>12}\n".format(sep * 50, sep * 8, sep * 14, sep * 14, sep * 12))
+                for name, row in table.items():
+                    f.write("{0:50} {1:>8} {2:>14.3f} {3:>14} {4:>12}\n".format(name, row['calls'], row['latency'], row['bytes'],
+                                                                          "{:.3f}".format(row['wall']) if row['wall'] else "-"))
+                f.write("\n")
+            f.close()
+        print("Profile written to {0}.txt and {0}.csv".format(self.filename))
+
+def profile_phase(name):
+    # Context manager naming the phase SOAP calls are attributed to with --profile
+    if profile is None:
+        return nullphase()
+    return profile.phase(name)
+
+def apply_updates(props, update):
+    # Applies a WaitForUpdatesEx() UpdateSet to props (moid -> {property: value})
+    # and returns the managed objects that changed, by moid.
+    changed = {}
+    for filterSet in update.filterSet or []:
+        for objUpdate in filterSet.objectSet or []:
+            moid = objUpdate.obj._moId
+            changed[moid] = objUpdate.obj
+            if objUpdate.kind == 'leave':
+                props.pop(moid, None)
+                continue
+            objProps = props.setdefault(moid, {'moref': objUpdate.obj})
+            for change in objUpdate.changeSet or []:
+                if change.op in ('remove', 'indirectRemove'):
+                    objProps.pop(change.name, None)
+                else:
+                    objProps[change.name] = change.val
+    return changed
+
+def watch_host(args, si, host, vmnames):
+    # Keeps a PropertyCollector filter on all hosts (with their storage
+    # devices, so a path policy change is seen), the allocation properties
+    # of all VMs and everything the checks read of the target VMs. Only the
+    # VMs whose properties (or whose host) changed are re-evaluated, and an
+    # event is printed for every check whose result flips.
+    content = si.RetrieveContent()
+    retProps = GetProperties(content, [vim.VirtualMachine], ['name', 'runtime.powerState'], vim.VirtualMachine)
+    index = vm_name_index(retProps)
+    targets = [x['moref'] for name in vmnames for x in index.get(name, []) if str(x['runtime.powerState']) == "poweredOn"]
+    if not targets:
+        print('No powered on vm of {} found on vmware host {}, nothing to watch'.format(",".join(vmnames), host))
+        logger.error('No powered on vm of {} found on vmware host {}, nothing to watch'.format(",".join(vmnames), host))
+        return -1
+    target_ids = set(x._moId for x in targets)
+
+    pc = content.propertyCollector.CreatePropertyCollector()
+    objView, allSpec = ViewFilterSpec(content, [vim.HostSystem, vim.ClusterComputeResource, vim.VirtualMachine],
+                                      [(vim.HostSystem, HOST_PROPS + HOST_STORAGE_PROPS),
+                                       (vim.ClusterComputeResource, ['name']),
+                                       (vim.VirtualMachine, VM_ALLOC_PROPS)])
+    vmSpec = vim.PropertyCollector.FilterSpec(
+        objectSet=[vim.PropertyCollector.ObjectSpec(obj=x, skip=False) for x in targets],
+        propSet=[vim.PropertyCollector.PropertySpec(all=False, pathSet=VM_PROPS, type=vim.VirtualMachine)],
+        reportMissingObjectsInResults=False)
+    filters = [pc.CreateFilter(allSpec, partialUpdates=False), pc.CreateFilter(vmSpec, partialUpdates=False)]
+
+    inventory = new_inventory(host, content)
+    props = {}
+    allocvms = OrderedDict()
+    clusters = {}
+    esxiinfo = None
+    state = {}
+    version = ''
+    waitOptions = vim.PropertyCollector.WaitOptions(maxWaitSeconds=WATCH_WAIT_SECONDS)
+    print("Watching {} on {} for changes, press Ctrl-C to stop".format(", ".join(sorted(vmnames)), host))
+    logger.info("Watching {} on {}".format(vmnames, host))
+    try:
+        while True:
+            update = pc.WaitForUpdatesEx(version, waitOptions)
+            if update is None:
+                continue
+            version = update.version
+            dirty = set()
+            # clusters first, so their hosts see the new names
+            changed = sorted(apply_updates(props, update).items(),
+                             key=lambda x: not isinstance(x[1], vim.ClusterComputeResource))
+            for moid, obj in changed:
+                objProps = props.get(moid)
+                if isinstance(obj, vim.ClusterComputeResource):
+                    if objProps:
+                        clusters[moid] = objProps.get('name')
+                    else:
+                        clusters.pop(moid, None)
+                    for hostid, hostProps in props.items():
+                        if hostid in inventory['hosts'] and hostProps.get('parent') == obj:
+                            inventory['hosts'][hostid] = host_facts(hostProps, clusters)
+                elif isinstance(obj, vim.HostSystem):
+                    if objProps:
+                        inventory['hosts'][moid] = host_facts(objProps, clusters)
+                        inventory['storage'][moid] = host_storage_facts(
+                            objProps.get('config.storageDevice.scsiLun', []),
+                            objProps.get('config.storageDevice.multipathInfo.lun', []))
+                    else:
+                        inventory['hosts'].pop(moid, None)
+                        inventory['storage'].pop(moid, None)
+                    dirty.update(x for x in target_ids if props.get(x, {}).get('runtime.host') == obj)
+                elif objProps:
+                    allocvms[moid] = vm_facts(objProps)
+                    if moid in target_ids:
+                        update_storage_facts(content, inventory, objProps, False)
+                        dirty.add(moid)
+                else:
+                    allocvms.pop(moid, None)
+                    if moid in target_ids:
+                        target_ids.discard(moid)
+                        print("{} vm {} is no longer on vmware host {}".format(watch_time(), moid, host))
+                        logger.warning("vm {} is no longer on vmware host {}".format(moid, host))
+
+            # Host rows use the allocation totals of the VMs on each host
+            newinfo = esxi_info(inventory['hosts'], list(allocvms.values()))
+            newinfo['esxi_version'] = inventory['about']['version']
+            newinfo['connected_host'] = host
+            if newinfo != esxiinfo:
+                esxiinfo = newinfo
+                dirty.update(target_ids)
+
+            for moid in sorted(dirty & target_ids):
+                vm = allocvms[moid]
+                if vm['host'] not in inventory['hosts']:
+                    continue
+                results, vm_row = vm_check_results(args, vm, inventory, esxiinfo, True)
+                for scope, scope_results in results.items():
+                    subject = inventory['hosts'][vm['host']]['name'] if scope == 'host' else vm_row['vm']
+                    for result in scope_results:
+                        key = (subject, result['rule'], result['label'])
+                        previous = state.get(key)
+                        state[key] = result['result']
+                        if previous is not None and previous != result['result']:
+                            label = "[" + subject + "] " + result['label'] if scope == 'host' else result['label']
+                            print("{} {} : {} -> {} (Current Value: {} | Recommended Value: {})".format(
+                                watch_time(), label, previous, result['result'], result['value'], result['recommended']))
+                            logger.warning("{} : {} -> {}".format(label, previous, result['result']))
+            report.flush()
+    except KeyboardInterrupt:
+        print("Stopped watching {}".format(host))
+    finally:
+        for f in filters:
+            f.Destroy()
+        pc.Destroy()
+        objView.Destroy()
+    return 0
+
+def watch_time():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def run_host(args, host, vmnames, password):
+    with profile_phase("connect"):
+        si = connect_host(args, host, password)
+    if not si:
+        return -1
+    sessions = []
+    try:
+        if args.capture:
+            with profile_phase("capture"):
+                return capture_host(args, si, host, args.capture)
+        with profile_phase("connect"):
+            for n in range(args.sessions - 1):
+                session = connect_host(args, host, password, quiet=True)
+                if session:
+                    sessions.append(session)
+        rc = check_host(args, si, host, vmnames, sessions)
+        if rc == 0 and args.watch:
+            with profile_phase("watch"):
+                rc = watch_host(args, si, host, vmnames)
+        return rc
+    except vmodl.MethodFault as e:
+        print('Caught vmodl fault: ' + e.msg)
+        logger.error("Caught vmodl fault : {}".format(e.msg))
+        return -1
+    except Exception as e:
+        print('Caught exception: ' + str(e))
+        logger.error("Caught exception: {}".format(e))
+        return -1
+    finally:
+        for session in sessions:
+            Disconnect(session)
+        Disconnect(si)
+
+def run_fleet_host(args, host, vmnames, password):
+    # Runs in a worker thread. Everything reported for this host is buffered and
+    # handed back so that each host's report is emitted as one block.
+    report.capture()
+    try:
+        print("")
+        print("#" * 160)
+        print("# Host : {}    Engines : {}".format(host, ",".join(vmnames)))
+        print("#" * 160)
+        rc = run_host(args, host, vmnames, password)
+    finally:
+        output = report.release()
+    return rc, output
+
+def run_fleet(args, inventory, password):
+    # One session per host, at most args.workers hosts checked at a time. The
+    # total runtime is therefore bounded by the slowest host rather than the
+    # sum of all of them.
+    results = OrderedDict()
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = dict((pool.submit(run_fleet_host, args, host, vmnames, password), host) for host, vmnames in inventory.items())
+        for future in as_completed(futures):
+            host = futures[future]
+            try:
+                rc, output = future.result()
+            except Exception as e:
+                rc, output = -1, [('text', 'Caught exception: {}\n'.format(e))]
+                logger.error("Caught exception for host {}: {}".format(host, e))
+            report.replay(output)
+            results[host] = rc
+
+    print("")
+    print("{0:50} {1:70} {2:30}".format("Host", "Engines", "Result"))
+    print("{0:50} {1:70} {2:30}".format("=" * 50, "=" * 70, "=" * 30))
+    for host, vmnames in inventory.items():
+        print("{0:50} {1:70} {2:30}".format(host, ",".join(vmnames), "Completed" if results.get(host) == 0 else "Failed"))
+    return 0 if all(rc == 0 for rc in results.values()) else -1
+
+def main():
     e = None
     
     try:
@@ -749,14 +2147,61 @@ def main():
         print(str(e))
         return -1
 
+    report_formats = [x.strip().lower() for x in args.report_format.split(",") if x.strip()]
+    for fmt in report_formats:
+        if fmt not in REPORT_FORMATS:
+            parser.error("--report_format must be a comma separated list of {}".format(", ".join(REPORT_FORMATS)))
+    args.report_format = report_formats
+
+    if args.replay:
+        if not args.vm:
+            parser.error("-e/--vm is required with --replay")
+    elif args.capture:
+        if not args.host or not args.user:
+            parser.error("-s/--host and -u/--user are required with --capture")
+    elif not args.user:
+        parser.error("-u/--user is required")
+    elif not args.inventory and not (args.host and args.vm):
+        parser.error("either -i/--inventory or both -s/--host and -e/--vm are required")
+    if args.capture and args.inventory:
+        # a capture is one vCenter / host per file
+        parser.error("--capture can not be combined with -i/--inventory")
+    if args.watch and (args.inventory or args.capture or args.replay or not args.host):
+        parser.error("--watch needs -s/--host and -e/--vm and can not be combined with -i, --capture or --replay")
+
+    setup_logs(args.debug)
+    global debug_capture
+    if args.debug:
+        debug_capture = debugcapture(debug_capture_output, args.debug_size * 1024 * 1024)
+        atexit.register(debug_capture.close)
+    sys.stdout = report
+    history = None
+    if args.history:
+        # only loaded for --history, like pyVmomi in load_sdk()
+        import sqlite3
+        import irr_history
+        try:
+            history = irr_history.historystore(args.history, 'chk_esxi_settings',
+                                               args.inventory or args.replay or args.host)
+        except sqlite3.Error as e:
+            print("Could not open history file {}".format(args.history))
+            print(str(e))
+            logger.error("Could not open history file {} : {}".format(args.history, e))
+            return -1
+    report.open(report_formats, history)
+    atexit.register(report.close)
+
+    print("Script Version : 3.0")
+    logger.info("Script Version : 3.0")
+    if not args.replay:
+        load_sdk()
+
     #set_log_level_from_verbose(args)
     
     try:
         #vmnames = args.vm
         #vmnames = args.vm.split(",")
-        vmnames = args.vm.lower().split(",")
         #vmnames = map(lambda x:x.lower(),vmnames)
-        si = None
         disk_types = ['ssd', 'non_ssd']
 
         if args.disk_type.lower() not in disk_types:
@@ -764,135 +2209,88 @@ def main():
             logger.error("Disk Type ( {} ) not valid!. Valid options are : ssd OR non-ssd".format(args.disk_type.lower()))
             return -1
         else:
-            disk_type = args.disk_type.lower()
+            args.disk_type = args.disk_type.lower()
+
+        global dx_rules
+        try:
+            dx_rules = ruleset(args.rules)
+        except (IOError, ValueError, configparser.Error) as e:
+            print("Could not load rules file {}".format(args.rules))
+            print(str(e))
+            logger.error("Could not load rules file {} : {}".format(args.rules, e))
+            return -1
+        logger.info("dx_settings: \n{}".format(dx_rules.settings))
+
+        global profile
+        if args.profile:
+            profile = profiler(profile_output)
+            atexit.register(profile.write)
+
+        if args.replay:
+            try:
+                rc = replay_snapshot(args, args.vm.lower().split(","))
+            except (IOError, ValueError) as e:
+                print("Could not read snapshot file {}".format(args.replay))
+                print(str(e))
+                logger.error("Could not read snapshot file {} : {}".format(args.replay, e))
+                return -1
+            return finish_run(args, rc)
+
+        if args.inventory:
+            try:
+                inventory = read_inventory(args.inventory)
+            except (IOError, ValueError) as e:
+                print("Could not read inventory file {}".format(args.inventory))
+                print(str(e))
+                logger.error("Could not read inventory file {} : {}".format(args.inventory, e))
+                return -1
+        else:
+            inventory = OrderedDict([(args.host, args.vm.lower().split(",") if args.vm else [])])
 
-        logger.info('vmnames : {}'.format(vmnames))
-        logger.info("disk_type : {}".format(disk_type))
+        logger.info('inventory : {}'.format(inventory))
+        logger.info("disk_type : {}".format(args.disk_type))
 
         if args.password:
             password = args.password
         else:
             try:
-                password = getpass.getpass(prompt="Enter password for host {} and user {}: ".format(args.host, args.user))
+                if args.inventory:
+                    password = getpass.getpass(prompt="Enter password for user {}: ".format(args.user))
+                else:
+                    password = getpass.getpass(prompt="Enter password for host {} and user {}: ".format(args.host, args.user))
             except Exception as e:
                 print ("Could not read password")
                 logger.error("Could not read password")
                 print(str(e))
                 return -1
 
-        try:
-            #logger.info("cert_check_skip : {}".format(args.cert_check_skip))
-            if args.cert_check_skip:
-                context = ssl._create_unverified_context()
-                logger.info("context :")
-                logger.info(context)
-                si = SmartConnect(host=args.host, user=args.user, pwd=password, port=int(args.port), sslContext=context)
-
-            else:
-                si = SmartConnect(host=args.host, user=args.user, pwd=password, port=int(args.port))
-
-            logger.info("si:")
-            logger.info(si)
-            si_attrs = si.__dict__
-            logger.info("si_attrs: {}".format(si_attrs))
-        except IOError as e:
-            print("IOError.")
-            print(str(e))
-            logger.error("IOError.")
-            logger.error(str(e))
-            return -1
-        except Exception as e:
-            e = sys.exc_info()
-            print(str(e))
-            print("Other Exceptions:")
-            logger.error(str(e))
-            return -1
-
-        if not si:
-            print('Could not connect to the specified host using specified username and password')
-            logger.error('Could not connect to the specified host using specified username and password')
-            return -1
+        if args.inventory:
+            rc = run_fleet(args, inventory, password)
         else:
-            print("Connected.")
-            logger.info("Connected.")
-
-        atexit.register(Disconnect, si)
-        content = si.RetrieveContent()
-        logger.info("content: {} \n".format(content))
-
-        # Get vCenter date and time for use as baseline when querying for counters
-        vchtime = si.CurrentTime()
-        logger.info("vchtime: {}".format(vchtime))
-
-        retESXIProps = esxi_info(content, [vim.HostSystem], ['hyperthreading'], vchtime)
-        logger.debug("retESXIProps: {}".format(retESXIProps))
-
-        #esx_global.csv
-        esxi_info_stat = 0
-        esxi_version   = content.about.version
-        esxi_build     = content.about.build
-        esxi_update    = "."
-        esxi_ht_bp     = "False"
-
-        f = open(esx_global_output, "a")
-        f.write("{}, {}, {}, {}, {}, {}, {}, {}, {}\n".format(esxi_version,esxi_build,esxi_update,retESXIProps['esxi_cpus'],retESXIProps['esxi_cores'],retESXIProps['esxi_threads'],retESXIProps['CPUhyperThreadingActive'],retESXIProps['CPUhyperThreadingConfig'],esxi_ht_bp))
-        f.close()
-
-        retProps = GetProperties(content, [vim.VirtualMachine], ['name', 'runtime.powerState'], vim.VirtualMachine)
-        logger.debug("retProps: {}".format(retProps))
-
-        # Find VM supplied as arg and use Managed Object Reference (moref) for the PrintVmInfo
-        vmcount = 0
-        allvmlist = []
-        for vm in retProps:
-            # retval = PrintVmInfotmp(vm['moref'], content, vchtime)
-            # print(retval)
-            # print("Total CPU Allocated : {0} , Memory Allocated : {1}".format(allocatedCPU, allocatedMEM))
-            allvmlist.append(vm['name'])
-            if (vm['name'].lower() in vmnames) and (vm['runtime.powerState'] == "poweredOn"):
-                logger.info ("VM {} found in {} and powered on".format(vm['name'],args.host ))
-                esxi_info_stat += 1
-                PrintVmInfo(args, vm['moref'], content, vchtime, retESXIProps)
-                vmcount = vmcount + 1
-                
-            elif (vm['name'].lower() in vmnames) and (vm['runtime.powerState'] != "poweredOn"):
-                print('ERROR: Problem connecting to Virtual Machine. {} is likely powered off or suspended'.format(vm['name']))
-                logger.error('ERROR: Problem connecting to Virtual Machine. {} is likely powered off or suspended'.format(vm['name']))
-                vmcount = vmcount + 1
-                logger ("VM {} found in {} and powered off".format(vm['name'],args.host ))
-                return -1
-        
-        allvmlist_lower = map(lambda x:x.lower(),allvmlist)
-        for currvm in vmnames:
-            if currvm.lower() not in allvmlist_lower:
-                logger.error('vm : {} not found on vmware host {}'.format(currvm,args.host))
-                print('vm : {} not found on vmware host {}'.format(currvm,args.host))
-                return -1
-        if vmcount == 0:
-            logger.error('vm : {} not found on vmware host {}. Please check vm name. VM Name is case sensitive'.format(currvm,args.host))
-            print('vm : {} not found on vmware host {}. Please check vm name. VM Name is case sensitive'.format(currvm,args.host))
-            return -1
-
-        Disconnect
-        print(' ')
-        print('Note : Please send following 3 files generated in current folder to delphix professional services team')
-        print('       1) logs/esx_global.csv' )
-        print('       2) logs/vm_stats.csv' )
-        print('       3) logs/chk_esxi_settings.txt' )
-        print(' ')
-        log_file_handler.close()
-        if not args.debug:
-            if path.exists(debug_logfile): os.remove(debug_logfile) 
+            rc = run_host(args, args.host, inventory[args.host], password)
+        if args.capture:
+            return rc
+        return finish_run(args, rc)
 
-    except vmodl.MethodFault as e:
-        print('Caught vmodl fault: ' + e.msg)
-        logger.error("Caught vmodl fault : {}".format(e.msg))
-        return -1
     except Exception as e:
         print('Caught exception: ' + str(e))
         logger.error("Caught exception: {}".format(e))
         return -1
 
+def finish_run(args, rc):
+    if rc != 0:
+        return rc
+
+    files = [x[0] for x in REPORT_TABLES.values()] + [report_output + REPORT_FORMATS[x] for x in args.report_format]
+    print(' ')
+    print('Note : Please send following {} files generated in current folder to delphix professional services team'.format(len(files)))
+    for n, filename in enumerate(files):
+        print('       {}) {}'.format(n + 1, filename))
+    print(' ')
+    if log_file_handler:
+        log_file_handler.close()
+    if not args.debug:
+        if path.exists(debug_logfile): os.remove(debug_logfile) 
     return 0
 
 # Start program
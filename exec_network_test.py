@@ -43,6 +43,14 @@ optional arguments:
   -t DLPX_TARGET_HOSTS, --tgtlist DLPX_TARGET_HOSTS         Comma seperated One or more Target Hosts to conduct network test
   -l LOGFILE, --logfile                                     Name of custom logfile
   -f , --force                                              Force to mark target host(s) healthy for test
+  --probe {icmp,tcp}                                        Reachability check of the target hosts (default icmp)
+  --probe_timeout SECONDS                                   Seconds to wait for each target host to answer (default 2)
+  --probe_workers N                                         Number of target hosts checked concurrently (default 32)
+  --latency_jobs N                                          Number of latency tests running on the engine at the same time (default 4)
+  --throughput_jobs N                                       Number of throughput tests running on the engine at the same time (default 2)
+  --link_prefix N                                           Target hosts in the same IPv4 /N subnet share a network path (default 24)
+  --link_tags FILE                                          File with <host name or address>,<link tag> lines
+  --result_workers N                                        With -t: number of engine sessions the test results are fetched over (default 8)
   -v , --verbose                                            Verbose execution
 
 
@@ -59,21 +67,38 @@ optional arguments:
 
 import argparse
 import getpass
+import ipaddress
 import os
 import time
 import signal
+import subprocess
 import sys
 import socket
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 #import getopt
 #import logging
 
+import irr_history
 
-from delphixpy.delphix_engine import DelphixEngine
-from delphixpy.web.network.test import latency, throughput
-from delphixpy.web import host
-from delphixpy import job_context
-from delphixpy.exceptions import HttpError, JobError
-from delphixpy.web.vo import NetworkLatencyTestParameters, NetworkThroughputTestParameters
+
+# delphixpy is imported by load_sdk() once the arguments are parsed, so
+# --help and usage errors return without loading it
+DelphixEngine = latency = throughput = host = job = job_context = delphix = None
+HttpError = JobError = RequestError = None
+NetworkLatencyTestParameters = NetworkThroughputTestParameters = None
+
+def load_sdk():
+    global DelphixEngine, latency, throughput, host, job, job_context, delphix, HttpError, JobError, RequestError
+    global NetworkLatencyTestParameters, NetworkThroughputTestParameters
+    from delphixpy.delphix_engine import DelphixEngine
+    from delphixpy.web.network.test import latency, throughput
+    from delphixpy.web import delphix, host, job
+    from delphixpy import job_context
+    from delphixpy.exceptions import HttpError, JobError, RequestError
+    from delphixpy.web.vo import NetworkLatencyTestParameters, NetworkThroughputTestParameters
 
 class dlpxSession:
 
@@ -89,6 +114,12 @@ class dlpxSession:
         self.mydict = {}
 
         self.engine = None
+        self.history = None
+        self.resultWorkers = 8
+        self.resultPool = None
+        self.resultSessions = threading.local()
+        self.resultEngines = []
+        self.resultLock = threading.Lock()
         try:
             self.engine = DelphixEngine(self.dlpxengine, self.dlpxuser, self.dlpxpwd, "DOMAIN")
         except IOError as e:
@@ -105,8 +136,33 @@ class dlpxSession:
         self.f = open(self.logfile,"w")
 
     def closeLogFile(self):
+        # Called from main()'s finally, so a failed run still commits the
+        # test results stored up to then
+        if self.resultPool:
+            self.resultPool.shutdown()
+            self.resultPool = None
+        # Log out the sessions the result pool opened
+        for engine in self.resultEngines:
+            try:
+                delphix.logout(engine)
+            except (HttpError, RequestError, IOError) as e:
+                self.printMsg ("Could not log out of the Delphix Engine : " + str(e),self.verbose,"L1","W","N")
+        self.resultEngines = []
+        if self.history:
+            history, self.history = self.history, None
+            try:
+                history.close()
+            except sqlite3.Error as e:
+                self.printMsg ("Could not write the test results to the history file : " + str(e),"True","L0","E","Y")
         self.f.close()
 
+    def saveResult(self, test, name, remote_address, direction, state, value, unit):
+        # Test results of this run go to the --history store if one is open
+        if self.history:
+            self.history.add_network({'engine': self.dlpxengine, 'test': test, 'name': name,
+                                      'remote_address': remote_address, 'direction': direction, 'state': state,
+                                      'value': value, 'unit': unit})
+
     def printMsg (self,print_obj, verboseoutput, level, msgtype, hidemsgtype ):
         if ( verboseoutput ):
             if (msgtype == "I"):
@@ -137,86 +193,120 @@ class dlpxSession:
             self.f.write(msghdr + indentparam + print_obj + "\n") 
             print (msghdr + indentparam + print_obj)
 
-    def check_ping(self,x):
+    def check_ping(self,x,timeout=2):
+        # One ICMP echo, the ping process is killed after timeout seconds
         hostname = x
         if (os.name == "posix"):
-            response = os.system("ping -c 1 " + hostname + " > /dev/null 2>&1" )
+            cmd = ["ping", "-c", "1", "-t" if sys.platform == "darwin" else "-W", str(timeout), hostname]
         elif (os.name == "nt"):
-            response = os.system('PING ' + hostname + ' -n 1 | FIND /I /V "unreachable" | FIND /I "Reply from"  > NUL' )
+            cmd = ["PING", hostname, "-n", "1", "-w", str(timeout * 1000)]
         else:
             print ("OS Not supported")
+            return "InActive"
+        try:
+            p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=timeout + 1)
+        except (OSError, subprocess.TimeoutExpired):
+            return "InActive"
         # and then check the response...
+        if os.name == "nt":
+            output = p.stdout.decode("ascii", "replace")
+            response = 0 if "Reply from" in output and "unreachable" not in output else 1
+        else:
+            response = p.returncode
         if response == 0:
             pingstatus = "Active"
         else:
             pingstatus = "InActive"
         return pingstatus
 
-    def genHostLists(self,tgthostlist=False,force=False):
+    def check_port(self,x,port,timeout=2):
+        # TCP connect to the SSH / connector port of the environment
+        try:
+            socket.create_connection((x, int(port)), timeout=timeout).close()
+            return "Active"
+        except (socket.error, TypeError, ValueError):
+            return "InActive"
+
+    def probeHost(self,obj,probe,timeout):
+        if probe == "tcp":
+            if obj.type == 'WindowsHost':
+                port = obj.connector_port
+                if not port:
+                    # no connector to connect to, ping it instead
+                    return self.check_ping(obj.address, timeout)
+            else:
+                port = getattr(obj, 'ssh_port', None) or 22
+            return self.check_port(obj.address, port, timeout)
+        return self.check_ping(obj.address, timeout)
+
+    def resolveHost(self,address):
+        # IP address of an environment for hostLink(), None if it does not resolve
+        try:
+            return str(ipaddress.ip_address(address))
+        except ValueError:
+            pass
+        try:
+            return socket.gethostbyname(address)
+        except socket.error:
+            return None
+
+    def genHostLists(self,tgthostlist=False,force=False,probe="icmp",timeout=2,workers=32):
         self.printMsg (" ","True","L0","I","Y")
         self.printMsg("Generating list of environments to conduct Network Tests. Please wait ...........",self.verbose,"L1","I","N")
         self.printMsg (" ","True","L0","I","Y")
 
+        hosts = [obj for obj in host.get_all(self.engine) if not tgthostlist or obj.name in tgthostlist]
+        # All environments are probed at the same time (at most workers at
+        # once), so dead hosts cost one timeout in total rather than each.
+        # Host names are resolved in the same pool.
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            addresses = pool.map(lambda obj: self.resolveHost(obj.address), hosts)
+            if force == True:
+                statuses = ["Active"] * len(hosts)
+            else:
+                statuses = list(pool.map(lambda obj: self.probeHost(obj, probe, timeout), hosts))
+            addresses = list(addresses)
+        if force != True:
+            self.printMsg("Probed {} environments ({}) in {:.1f} seconds".format(len(hosts), probe.upper(), time.time() - start),self.verbose,"L1","I","N")
+            self.printMsg (" ","True","L0","I","Y")
+
         self.printMsg ("{0:28} {1:20} {2:15} {3:6}".format("EnvironmentName", "EnvironmentReference", "IP Address", "Ping"),True,"L0","I","Y")
         self.printMsg ("{0:28} {1:20} {2:15} {3:6}".format("-"*28, "-"*20,"-"*15,"-"*6),True,"L0","I","Y")
-        for obj in host.get_all(self.engine):
-            if not tgthostlist:
-                if force == True:
-                    status = "Active"
+        for obj, status, ipaddr in zip(hosts, statuses, addresses):
+            if status == "Active":
+                if obj.type == 'WindowsHost':
+                    activehost = {'keyname': obj.name, 'keyreference': obj.reference, 'keyaddress': obj.address, 'keyhostype': obj.type, 'keyconnectorport': obj.connector_port or "0", 'keyip': ipaddr}
                 else:
-                    status = self.check_ping(obj.address)
-
-                sep = ","
-                if status == "Active":
-                    if obj.type == 'WindowsHost':
-                        activehost = {'keyname': obj.name, 'keyreference': obj.reference, 'keyaddress': obj.address, 'keyhostype': obj.type, 'keyconnectorport': obj.connector_port}
-                    else:
-                        activehost = {'keyname': obj.name, 'keyreference': obj.reference, 'keyaddress': obj.address, 'keyhostype': obj.type, 'keyconnectorport': "0"}
+                    activehost = {'keyname': obj.name, 'keyreference': obj.reference, 'keyaddress': obj.address, 'keyhostype': obj.type, 'keyconnectorport': "0", 'keyip': ipaddr}
 
-                    activehost_list.append(activehost)
-                    self.printMsg ("{0:28} {1:20} {2:15} {3:6}".format(obj.name, obj.reference, obj.address, "Force OK" if force else "OK"),True,"L0","I","Y")                       
-
-                else:
-                    inactivehost = {'keyname': obj.name, 'keyreference': obj.reference, 'keyaddress': obj.address}
-                    inactivehost_list.append(inactivehost)
-                    self.printMsg ("{0:28} {1:20} {2:15} {3:6}".format(obj.name, obj.reference, obj.address, "NOT OK"),True,"L0","I","Y")
+                activehost_list.append(activehost)
+                self.printMsg ("{0:28} {1:20} {2:15} {3:6}".format(obj.name, obj.reference, obj.address, "Force OK" if force else "OK"),True,"L0","I","Y")
 
             else:
-                if obj.name in tgthostlist:
-                    if force == True:
-                        status = "Active"
-                    else:
-                        status = self.check_ping(obj.address)
-
-                    sep = ","
-                    if status == "Active":
-                        if obj.type == 'WindowsHost':
-                            activehost = {'keyname': obj.name, 'keyreference': obj.reference, 'keyaddress': obj.address, 'keyhostype': obj.type, 'keyconnectorport': obj.connector_port}
-                        else:
-                            activehost = {'keyname': obj.name, 'keyreference': obj.reference, 'keyaddress': obj.address, 'keyhostype': obj.type, 'keyconnectorport': "0"}
-
-                        activehost_list.append(activehost)
-                        self.printMsg ("{0:28} {1:20} {2:15} {3:6}".format(obj.name, obj.reference, obj.address, "Force OK" if force else "OK"),True,"L0","I","Y")
-
-                    else:
-                        inactivehost = {'keyname': obj.name, 'keyreference': obj.reference, 'keyaddress': obj.address}
-                        inactivehost_list.append(inactivehost)
-                        self.printMsg ("{0:28} {1:20} {2:15} {3:6}".format(obj.name, obj.reference, obj.address, "NOT OK"),True,"L0","I","Y")
-
+                inactivehost = {'keyname': obj.name, 'keyreference': obj.reference, 'keyaddress': obj.address}
+                inactivehost_list.append(inactivehost)
+                self.printMsg ("{0:28} {1:20} {2:15} {3:6}".format(obj.name, obj.reference, obj.address, "NOT OK"),True,"L0","I","Y")
 
         self.printMsg (" ","True","L0","I","Y")
         self.printMsg("Environment list generated.",self.verbose,"L1","I","N")
         self.printMsg (" ","True","L0","I","Y")
 
-    def estimateTestDuration(self):
+    def estimateTestDuration(self,latency_jobs=1,throughput_jobs=1,links=None):
         #------------------------------------------------------------------------
         # Calculate counts and durations for the upcoming test jobs...
         #------------------------------------------------------------------------
         ahcount = len(activehost_list)
-        latencyTestTime = ahcount * 20
-        throughputTestTime = ahcount * 75 * 2
+        latencyTestTime = -(-ahcount // max(1, latency_jobs)) * 20
+        tcount = ahcount * 2
+        throughputTestTime = tcount * 75
+        if links is not None:
+            # only the hosts queued by throughputLinks(), the tests of one
+            # network path run one after the other
+            tcount = sum(len(x) for x in links.values())
+            throughputTestTime = max([-(-tcount // max(1, throughput_jobs))] + [len(x) for x in links.values()]) * 75
         totalTestTime = latencyTestTime + throughputTestTime
-        self.printMsg ("Running {} network latency tests, {} network throughput tests (in both directions)".format(ahcount, ahcount * 2 ),True,"L1","I","N")
+        self.printMsg ("Running {} network latency tests, {} network throughput tests (in both directions)".format(ahcount, tcount),True,"L1","I","N")
         self.printMsg ("Estimated duration to complete all tests is about {} seconds".format(totalTestTime),True,"L1","I","N")
         self.printMsg (" ","True","L0","I","Y")
 
@@ -242,52 +332,173 @@ class dlpxSession:
         inactivehost_list = []
 
 
-    def runNetworkLatencyTest(self):
-        if len(activehost_list) > 0:
-            for each_host in activehost_list:
-                self.printMsg ("Processing Network Latency Test for: " + each_host['keyname'] + "(" + each_host['keyaddress'] + ")" + ". Please wait ...........",self.verbose,"L1","I","N")
-                params = NetworkLatencyTestParameters()
-                params.type = "NetworkLatencyTestParameters"
-                params.remote_host = each_host['keyreference']
-
-                try:
-                    jobRef = latency.create(self.engine,params)
-                    jobRefDict = {'job_type':'Latency', 'job_ref':jobRef}
-                    jobRefList.append(jobRefDict)
-                    self.printMsg ("Successfully completed Network Latency Test for: " + each_host['keyname'] + "(" + each_host['keyaddress'] + ")" ,self.verbose,"L1","I","N")
-                    self.printMsg (" ","True","L0","I","Y")
-                except JobError as e:
-                    self.printMsg ("Failed Network Latency Test for: " + each_host['keyname'] + "(" + each_host['keyaddress'] + ")" ,self.verbose,"L1","E","N")
-                    self.printMsg (" ",self.verbose,"L0","I","Y")
-                    jobRefErrDict = {'job_type':'Latency', 'job_hostaddr':each_host['keyaddress'], 'job_hostname':each_host['keyname'], 'job_status' : 'Failed'}
-                    jobRefErrList.append(jobRefErrDict)
-
-    def runNetworkThroughputTest(self):
-        if len(activehost_list) > 0:
-            directions = ['TRANSMIT',  'RECEIVE']
-            for each_host in activehost_list:
-                for testdirection in directions:
-                    self.printMsg ("Processing Network Throughput " + testdirection + " Test for: " + each_host['keyname'] + "(" + each_host['keyaddress'] + ")" + ". Please wait ........... ",self.verbose,"L1","I","N")
-                    if each_host['keyhostype'] == "WindowsHost" and int(each_host['keyconnectorport']) == 0 :
-                            self.printMsg ("Network Throughput (TRANSMIT/RECEIVE) Test NOT SUPPORTED for Windows Source Environment: " + each_host['keyname'] + "(" + each_host['keyaddress'] + ")" ,self.verbose,"L1","W","N")
-                            jobRefErrDict = {'job_type':'Throughput', 'job_hostaddr':each_host['keyaddress'], 'job_hostname':each_host['keyname'], 'job_direction':'Throughput Test', 'job_status' : 'Not Supported'}
-                            jobRefErrList.append(jobRefErrDict)
+    def runEngineJobs(self,links,jobs,submit,done,poll=2,timeout=1800):
+        # Runs the tests queued per network path (links: path -> tests) as
+        # asynchronous engine jobs, at most jobs at a time and one per path.
+        # submit(test) returns the test reference, done(test, ref, state) is
+        # called as soon as its job finishes.
+        # asyncly() waits on exit for every job it registered, so each job is
+        # taken off its list and polled here instead. Any state but RUNNING
+        # ends a job (SUSPENDED too), as does running for timeout seconds.
+        # Engine errors fail the one test they hit. A job that timed out or
+        # could not be polled is cancelled, as is any job still running if
+        # the loop is left early.
+        running = {}
+        busy = set()
+        try:
+            with job_context.asyncly(self.engine):
+                while any(links.values()) or running:
+                    for link, tests in links.items():
+                        if len(running) >= max(1, jobs):
                             break
-                    else:
-                        params = NetworkThroughputTestParameters()
-                        params.type = "NetworkThroughputTestParameters"
-                        params.remote_host = each_host['keyreference']
-                        params.direction = testdirection
+                        if not tests or link in busy:
+                            continue
+                        test = tests.pop(0)
+                        lastJob = self.engine.last_job
                         try:
-                            jobRef = throughput.create(self.engine,params)
-                            jobRefDict = {'job_type' : 'Throughput' , 'job_ref' : jobRef , 'job_direction' : testdirection }
-                            jobRefList.append(jobRefDict)
-                            self.printMsg ("Successfully completed Network Throughput " + testdirection + " Test for: " + each_host['keyname'] + "(" + each_host['keyaddress'] + ")" ,self.verbose,"L1","I","N")
-                        except JobError as e:
-                            self.printMsg ("Failed Network Throughput " + testdirection + " Test for: " + each_host['keyname'] + "(" + each_host['keyaddress'] + ")",self.verbose,"L1","E","N")
-                            jobRefErrDict = {'job_type':'Throughput', 'job_hostaddr':each_host['keyaddress'], 'job_hostname':each_host['keyname'], 'job_direction':testdirection, 'job_status' : 'Failed'}
-                            jobRefErrList.append(jobRefErrDict)
-                self.printMsg (" ","True","L0","I","Y")
+                            jobRef = submit(test)
+                        except (HttpError, JobError, RequestError) as e:
+                            self.printMsg ("Could not start the test : " + str(e),self.verbose,"L1","E","N")
+                            done(test, None, "FAILED")
+                            continue
+                        # last_job is only set by calls that start a job
+                        engineJob = self.engine.last_job
+                        if not engineJob or engineJob == lastJob:
+                            done(test, jobRef, "COMPLETED")
+                            continue
+                        self.engine.clear_registered_job(engineJob)
+                        running[engineJob] = (link, test, jobRef, time.time())
+                        busy.add(link)
+
+                    if running:
+                        time.sleep(poll)
+                    for engineJob in list(running):
+                        link, test, jobRef, started = running[engineJob]
+                        try:
+                            state = job.get(self.engine, engineJob).job_state
+                        except (HttpError, RequestError) as e:
+                            self.printMsg ("Could not get the state of job " + engineJob + " : " + str(e),self.verbose,"L1","E","N")
+                            self.cancelEngineJob(engineJob)
+                            state = "FAILED"
+                        if state == "RUNNING":
+                            if time.time() - started < timeout:
+                                continue
+                            self.cancelEngineJob(engineJob)
+                            state = "TIMEDOUT"
+                        del running[engineJob]
+                        busy.discard(link)
+                        done(test, jobRef, state)
+        finally:
+            for engineJob in running:
+                self.cancelEngineJob(engineJob)
+
+    def cancelEngineJob(self,engineJob):
+        # Best effort, the job may have ended (or failed) in the meantime
+        try:
+            job.cancel(self.engine, engineJob)
+        except (HttpError, JobError, RequestError) as e:
+            self.printMsg ("Could not cancel job " + engineJob + " : " + str(e),self.verbose,"L1","W","N")
+
+    def runNetworkLatencyTest(self,latency_jobs=4):
+        # Latency tests are light, every host is a path of its own and only
+        # latency_jobs limits how many run at a time
+        links = OrderedDict((n, [each_host]) for n, each_host in enumerate(activehost_list))
+        self.runEngineJobs(links, latency_jobs, self.latencyTestSubmit, self.latencyTestDone)
+
+    def latencyTestSubmit(self,each_host):
+        self.printMsg ("Processing Network Latency Test for: " + each_host['keyname'] + "(" + each_host['keyaddress'] + ")" + ". Please wait ...........",self.verbose,"L1","I","N")
+        params = NetworkLatencyTestParameters()
+        params.type = "NetworkLatencyTestParameters"
+        params.remote_host = each_host['keyreference']
+        return latency.create(self.engine,params)
+
+    def latencyTestDone(self,each_host,jobRef,state):
+        if state == "COMPLETED":
+            jobRefDict = {'job_type':'Latency', 'job_ref':jobRef}
+            jobRefList.append(jobRefDict)
+            self.printMsg ("Successfully completed Network Latency Test for: " + each_host['keyname'] + "(" + each_host['keyaddress'] + ")" ,self.verbose,"L1","I","N")
+            self.printMsg (" ","True","L0","I","Y")
+        else:
+            self.printMsg ("Failed Network Latency Test for: " + each_host['keyname'] + "(" + each_host['keyaddress'] + ")" ,self.verbose,"L1","E","N")
+            self.printMsg (" ",self.verbose,"L0","I","Y")
+            jobRefErrDict = {'job_type':'Latency', 'job_hostaddr':each_host['keyaddress'], 'job_hostname':each_host['keyname'], 'job_status' : state.capitalize()}
+            jobRefErrList.append(jobRefErrDict)
+
+    def hostLink(self,each_host,prefix,tags):
+        # Network path of a host: its tag from --link_tags, else the subnet
+        # (/prefix for IPv4, /64 for IPv6) of its address, as resolved by
+        # genHostLists()
+        for key in (each_host['keyname'], each_host['keyaddress']):
+            if key in tags:
+                return tags[key]
+        if not each_host['keyip']:
+            return each_host['keyaddress']
+        address = ipaddress.ip_address(each_host['keyip'])
+        return str(ipaddress.ip_network("{}/{}".format(address, prefix if address.version == 4 else 64), strict=False))
+
+    def throughputLinks(self,prefix=24,tags={}):
+        # TRANSMIT and RECEIVE tests of every active host, queued per path
+        links = OrderedDict()
+        for each_host in activehost_list:
+            if each_host['keyhostype'] == "WindowsHost" and int(each_host['keyconnectorport']) == 0 :
+                self.printMsg ("Network Throughput (TRANSMIT/RECEIVE) Test NOT SUPPORTED for Windows Source Environment: " + each_host['keyname'] + "(" + each_host['keyaddress'] + ")" ,self.verbose,"L1","W","N")
+                jobRefErrDict = {'job_type':'Throughput', 'job_hostaddr':each_host['keyaddress'], 'job_hostname':each_host['keyname'], 'job_direction':'Throughput Test', 'job_status' : 'Not Supported'}
+                jobRefErrList.append(jobRefErrDict)
+                continue
+            tests = links.setdefault(self.hostLink(each_host, prefix, tags), [])
+            tests += [(each_host, 'TRANSMIT'), (each_host, 'RECEIVE')]
+        self.printMsg ("Throughput tests grouped into {} network path(s): {}".format(len(links), ", ".join("{} ({} tests)".format(k, len(v)) for k, v in links.items())),self.verbose,"L1","I","N")
+        self.printMsg (" ","True","L0","I","Y")
+        return links
+
+    def runNetworkThroughputTest(self,links,throughput_jobs=2):
+        # Tests of one path run one after the other so they do not share a
+        # bottleneck, at most throughput_jobs paths are tested at a time
+        self.runEngineJobs(links, throughput_jobs, self.throughputTestSubmit, self.throughputTestDone)
+
+    def throughputTestSubmit(self,test):
+        each_host, testdirection = test
+        self.printMsg ("Processing Network Throughput " + testdirection + " Test for: " + each_host['keyname'] + "(" + each_host['keyaddress'] + ")" + ". Please wait ........... ",self.verbose,"L1","I","N")
+        params = NetworkThroughputTestParameters()
+        params.type = "NetworkThroughputTestParameters"
+        params.remote_host = each_host['keyreference']
+        params.direction = testdirection
+        return throughput.create(self.engine,params)
+
+    def throughputTestDone(self,test,jobRef,state):
+        each_host, testdirection = test
+        if state == "COMPLETED":
+            jobRefDict = {'job_type' : 'Throughput' , 'job_ref' : jobRef , 'job_direction' : testdirection }
+            jobRefList.append(jobRefDict)
+            self.printMsg ("Successfully completed Network Throughput " + testdirection + " Test for: " + each_host['keyname'] + "(" + each_host['keyaddress'] + ")" ,self.verbose,"L1","I","N")
+        else:
+            self.printMsg ("Failed Network Throughput " + testdirection + " Test for: " + each_host['keyname'] + "(" + each_host['keyaddress'] + ")",self.verbose,"L1","E","N")
+            jobRefErrDict = {'job_type':'Throughput', 'job_hostaddr':each_host['keyaddress'], 'job_hostname':each_host['keyname'], 'job_direction':testdirection, 'job_status' : state.capitalize()}
+            jobRefErrList.append(jobRefErrDict)
+        self.printMsg (" ","True","L0","I","Y")
+
+    def getTests(self,api,refs):
+        # Test objects of refs (latency / throughput) in the order of refs,
+        # fetched resultWorkers at a time. The HTTP client of a DelphixEngine
+        # is not thread safe, so every pool thread logs in once with a
+        # session of its own and keeps it for the rest of the run, when
+        # closeLogFile() logs them out.
+        if self.resultWorkers <= 1 or len(refs) <= 1:
+            return [api.get(self.engine, x) for x in refs]
+        if not self.resultPool:
+            self.resultPool = ThreadPoolExecutor(max_workers=self.resultWorkers)
+        return list(self.resultPool.map(lambda ref: api.get(self.resultSession(), ref), refs))
+
+    def resultSession(self):
+        if not hasattr(self.resultSessions, 'engine'):
+            self.resultSessions.engine = DelphixEngine(self.dlpxengine, self.dlpxuser, self.dlpxpwd, "DOMAIN")
+            with self.resultLock:
+                self.resultEngines.append(self.resultSessions.engine)
+        return self.resultSessions.engine
+
+    def jobRefs(self,jobtype):
+        # References of the tests this run completed
+        return [x['job_ref'] for x in jobRefList if x['job_type'] == jobtype]
 
     def jobExecCount(self,jobtype):
         cr = 0
@@ -298,8 +509,6 @@ class dlpxSession:
 
     def genLatencyTestResults(self,tgtlist=False):
         if self.jobExecCount('Latency') > 0:
-            tmpDict={}
-            AllUnsortedLatencyTest=[]
             self.printMsg (" ","True","L0","I","Y")
             self.printMsg ("=======================================================================================================",self.verbose,"L0","I","Y")
             self.printMsg ("List of latest Network Latency Test Results <<<",self.verbose,"L0","I","Y")
@@ -308,60 +517,29 @@ class dlpxSession:
             self.printMsg ("{0:55} {1:15} {2:<15} {3:>13}".format("-"*55, "-"*15,"-"*15,"-"*13), "True","L0","I","Y")
 
             if tgtlist:
-                for jobRefRec in jobRefList:
-                    if jobRefRec['job_type'] == 'Latency':
-                        NetworkLatencyTest  = latency.get(self.engine,jobRefRec['job_ref'])
-                        if NetworkLatencyTest.average > 100:
-                            lunit="msec"
-                            avgLatency = "%.3f %s" % ((float(NetworkLatencyTest.average)/1000), lunit)
-                        else:
-                            lunit="usec"
-                            avgLatency = "%.3f %s" % ((float(NetworkLatencyTest.average)/1), lunit)
-                        self.printMsg ("{0:55} {1:15} {2:<15} {3:>13}".format(NetworkLatencyTest.name, NetworkLatencyTest.remote_address, NetworkLatencyTest.state,avgLatency), "True","L0","I","Y")
+                for NetworkLatencyTest in self.getTests(latency, self.jobRefs('Latency')):
+                    self.printMsg ("{0:55} {1:15} {2:<15} {3:>13}".format(NetworkLatencyTest.name, NetworkLatencyTest.remote_address, NetworkLatencyTest.state,format_latency(NetworkLatencyTest.average)), "True","L0","I","Y")
+                    self.saveResult('Latency', NetworkLatencyTest.name, NetworkLatencyTest.remote_address, None, NetworkLatencyTest.state, NetworkLatencyTest.average, 'usec')
                 for jobRefErrRec in jobRefErrList:
                     if jobRefErrRec['job_type'] == 'Latency':
                         self.printMsg ("{0:55} {1:15} {2:<15} {3:>13}".format(jobRefErrRec['job_hostname'] + "(" + jobRefErrRec['job_hostaddr'] + ")", jobRefErrRec['job_hostaddr'], jobRefErrRec['job_status'],"-"), "True","L0","I","Y")
+                        self.saveResult('Latency', jobRefErrRec['job_hostname'], jobRefErrRec['job_hostaddr'], None, jobRefErrRec['job_status'], None, None)
             else:
-                i = 1
-                LatencyTestResults = latency.get_all(self.engine)
-                for LTR in LatencyTestResults:
-                    tmpDict = { "name" : LTR.name , "remote_address" : LTR.remote_address , "state" : LTR.state, "end_time" : LTR.end_time, "average" : LTR.average }
-                    AllUnsortedLatencyTest.append(tmpDict)
-
-                AllNetworkLatencyTest = sorted(AllUnsortedLatencyTest, key=lambda k: (k['remote_address'],k['end_time']), reverse=True) 
-                for elem in AllNetworkLatencyTest:
-                    if (AllNetworkLatencyTest.index(elem))+1 <= len(AllNetworkLatencyTest):
-                        if ( i == 1):
-                            thiselem = elem
-                            prevelem = elem
-                            if thiselem['average'] > 100:
-                                lunit="msec"
-                                avgLatency = "%.3f %s" % ((float(thiselem['average'])/1000), lunit)
-                            else:
-                                lunit="usec"
-                                avgLatency = "%.3f %s" % ((float(thiselem['average'])/1), lunit)
-                            self.printMsg ("{0:55} {1:15} {2:<15} {3:>13}".format(thiselem['name'], thiselem['remote_address'], thiselem['state'], avgLatency), "True","L0","I","Y")
-                        else:
-                            thiselem = elem
-                            prevelem = AllNetworkLatencyTest[AllNetworkLatencyTest.index(elem)-1] 
-                            if ( thiselem['remote_address'] != prevelem['remote_address']):
-                                if thiselem['average'] > 100:
-                                    lunit="msec"
-                                    avgLatency = "%.3f %s" % ((float(thiselem['average'])/1000), lunit)
-                                else:
-                                    lunit="usec"
-                                    avgLatency = "%.3f %s" % ((float(thiselem['average'])/1), lunit)
-                                self.printMsg ("{0:55} {1:15} {2:<15} {3:>13}".format(thiselem['name'], thiselem['remote_address'], thiselem['state'], avgLatency), "True","L0","I","Y")                    
-                        i = i + 1
+                # latest test per remote address, in one pass over the engine's test history;
+                # only the tests of this run go to the history
+                runRefs = set(self.jobRefs('Latency'))
+                for LTR in latest_results(latency.get_all(self.engine), lambda x: x.remote_address):
+                    self.printMsg ("{0:55} {1:15} {2:<15} {3:>13}".format(LTR.name, LTR.remote_address, LTR.state, format_latency(LTR.average)), "True","L0","I","Y")
+                    if LTR.reference in runRefs:
+                        self.saveResult('Latency', LTR.name, LTR.remote_address, None, LTR.state, LTR.average, 'usec')
 
                 for jobRefErrRec in jobRefErrList:
                     if jobRefErrRec['job_type'] == 'Latency':
                         self.printMsg ("{0:55} {1:15} {2:<15} {3:>13}".format(jobRefErrRec['job_hostname'] + "(" + jobRefErrRec['job_hostaddr'] + ")", jobRefErrRec['job_hostaddr'], jobRefErrRec['job_status'],"-"), "True","L0","I","Y")  
+                        self.saveResult('Latency', jobRefErrRec['job_hostname'], jobRefErrRec['job_hostaddr'], None, jobRefErrRec['job_status'], None, None)
 
     def genThroughputTestResults(self,tgtlist):
         if self.jobExecCount('Throughput') > 0:
-            tmpDict={}
-            AllUnsortedThroughputTest=[]
             self.printMsg (" ","True","L0","I","Y")
             self.printMsg ("=======================================================================================================",self.verbose,"L0","I","Y")
             self.printMsg ("# >>> List of latest Network Throughput Test Results <<<",self.verbose,"L0","I","Y")
@@ -371,72 +549,27 @@ class dlpxSession:
             self.printMsg ("{0:55} {1:15} {2:<15} {3:>15}".format("-"*55, "-"*15,"-"*15,"-"*15),True,"L0","I","Y")
 
             if tgtlist:
-                for jobRefRec in jobRefList:
-                    if jobRefRec['job_type'] == 'Throughput':
-                        NetworkThroughputTest  = throughput.get(self.engine,jobRefRec['job_ref'])
-                        throughputval=NetworkThroughputTest.throughput
-                        if throughputval > 0:
-                            if (float(throughputval)/1073741824) > 0.975:
-                                tunit="Gbps"
-                                avgThroughput = "%.2f %s" % ((float(throughputval)/1073741824), tunit)
-                            else:
-                                tunit="Mbps"
-                                avgThroughput = "%.2f %s" % ((float(throughputval)/1048576), tunit)
-                        else:
-                            lunit=" bps"
-                            avgThroughput=str(throughputval) + " " + lunit
-                        self.printMsg ("{0:55} {1:15} {2:<15} {3:>15}".format(NetworkThroughputTest.name, NetworkThroughputTest.parameters.direction, NetworkThroughputTest.state,avgThroughput),True,"L0","I","Y")
+                for NetworkThroughputTest in self.getTests(throughput, self.jobRefs('Throughput')):
+                    throughputval=NetworkThroughputTest.throughput
+                    self.printMsg ("{0:55} {1:15} {2:<15} {3:>15}".format(NetworkThroughputTest.name, NetworkThroughputTest.parameters.direction, NetworkThroughputTest.state,format_throughput(throughputval)),True,"L0","I","Y")
+                    self.saveResult('Throughput', NetworkThroughputTest.name, NetworkThroughputTest.remote_address, NetworkThroughputTest.parameters.direction, NetworkThroughputTest.state, throughputval, 'bps')
                 for jobRefErrRec in jobRefErrList:
                     if jobRefErrRec['job_type'] == 'Throughput':
                         self.printMsg ("{0:55} {1:15} {2:<15} {3:>13}".format(jobRefErrRec['job_hostname'] + "(" + jobRefErrRec['job_hostaddr'] + ")", jobRefErrRec['job_direction'], jobRefErrRec['job_status'],"-"),True,"L0","I","Y")
+                        self.saveResult('Throughput', jobRefErrRec['job_hostname'], jobRefErrRec['job_hostaddr'], jobRefErrRec['job_direction'], jobRefErrRec['job_status'], None, None)
             else:
-                i = 1
-                ThroughputTestResults = throughput.get_all(self.engine)
-                for TTR in ThroughputTestResults:
-                    tmpDict = { "name" : TTR.name , "remote_address" : TTR.remote_address , "direction" : TTR.parameters.direction, "state" : TTR.state, "end_time" : TTR.end_time, "throughput" : TTR.throughput }
-                    AllUnsortedThroughputTest.append(tmpDict)
-
-                AllNetworkThroughputTest = sorted(AllUnsortedThroughputTest, key=lambda k: (k['remote_address'],k['direction'],k['end_time']), reverse=True) 
-                for elem in AllNetworkThroughputTest:
-                    if (AllNetworkThroughputTest.index(elem))+1 <= len(AllNetworkThroughputTest):
-                        if ( i == 1):
-                            thiselem = elem
-                            prevelem = elem
-                            throughputval = thiselem['throughput']
-
-                            if throughputval > 0:
-                                if (float(throughputval)/1073741824) > 0.975:
-                                    tunit="Gbps"
-                                    avgThroughput = "%.2f %s" % ((float(throughputval)/1073741824), tunit)
-                                else:
-                                    tunit="Mbps"
-                                    avgThroughput = "%.2f %s" % ((float(throughputval)/1048576), tunit)
-                            else:
-                                lunit=" bps"
-                                avgThroughput=str(throughputval) + " " + lunit
-                            self.printMsg ("{0:55} {1:15} {2:<15} {3:>13}".format(thiselem['name'], thiselem['direction'], thiselem['state'], avgThroughput),True,"L0","I","Y")
-                        
-                        else:
-                            thiselem = elem
-                            prevelem = AllNetworkThroughputTest[AllNetworkThroughputTest.index(elem)-1] 
-                            throughputval = thiselem['throughput']
-                            if  not ( thiselem['remote_address'] == prevelem['remote_address'] and thiselem['direction'] == prevelem['direction'] ):
-                                if throughputval > 0:
-                                    if (float(throughputval)/1073741824) > 0.975:
-                                        tunit="Gbps"
-                                        avgThroughput = "%.2f %s" % ((float(throughputval)/1073741824), tunit)
-                                    else:
-                                        tunit="Mbps"
-                                        avgThroughput = "%.2f %s" % ((float(throughputval)/1048576), tunit)
-                                else:
-                                    lunit=" bps"
-                                    avgThroughput=str(throughputval) + " " + lunit
-                                self.printMsg ("{0:55} {1:15} {2:<15} {3:>13}".format(thiselem['name'], thiselem['direction'], thiselem['state'], avgThroughput),True,"L0","I","Y")                                                                                                
-                        i = i + 1            
-                
+                # latest test per remote address and direction, in one pass over the engine's test history;
+                # only the tests of this run go to the history
+                runRefs = set(self.jobRefs('Throughput'))
+                for TTR in latest_results(throughput.get_all(self.engine), lambda x: (x.remote_address, x.parameters.direction)):
+                    self.printMsg ("{0:55} {1:15} {2:<15} {3:>13}".format(TTR.name, TTR.parameters.direction, TTR.state, format_throughput(TTR.throughput)),True,"L0","I","Y")
+                    if TTR.reference in runRefs:
+                        self.saveResult('Throughput', TTR.name, TTR.remote_address, TTR.parameters.direction, TTR.state, TTR.throughput, 'bps')
+
                 for jobRefErrRec in jobRefErrList:
                     if jobRefErrRec['job_type'] == 'Throughput':
                         self.printMsg ("{0:55} {1:15} {2:<15} {3:>13}".format(jobRefErrRec['job_hostname'] + "(" + jobRefErrRec['job_hostaddr'] + ")", jobRefErrRec['job_direction'], jobRefErrRec['job_status'],"-"),True,"L0","I","Y")     
+                        self.saveResult('Throughput', jobRefErrRec['job_hostname'], jobRefErrRec['job_hostaddr'], jobRefErrRec['job_direction'], jobRefErrRec['job_status'], None, None)
 
     def genHostNotPingedResults(self):
         if len(inactivehost_list) > 0:
@@ -468,6 +601,46 @@ def exit_gracefully(signum, frame):
 
     
 
+def format_latency(average):
+    # average is in usec
+    if average > 100:
+        return "%.3f %s" % ((float(average)/1000), "msec")
+    return "%.3f %s" % ((float(average)/1), "usec")
+
+def format_throughput(throughputval):
+    # throughputval is in bps
+    if throughputval > 0:
+        if (float(throughputval)/1073741824) > 0.975:
+            return "%.2f %s" % ((float(throughputval)/1073741824), "Gbps")
+        return "%.2f %s" % ((float(throughputval)/1048576), "Mbps")
+    return str(throughputval) + " " + " bps"
+
+def latest_results(results, key):
+    # Latest test (by end_time) per key(test), in the order of the keys
+    # (descending, as listed before). One pass over results, so it stays
+    # linear with years of test history on the engine.
+    latest = {}
+    for result in results:
+        k = key(result)
+        if k not in latest or (result.end_time or "") > (latest[k].end_time or ""):
+            latest[k] = result
+    return [latest[k] for k in sorted(latest, reverse=True)]
+
+def read_link_tags(filename):
+    # Lines are "<host name or address>,<link tag>"; blank lines and lines
+    # starting with '#' are ignored
+    tags = {}
+    with open(filename) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = [x.strip() for x in line.split(',')]
+            if len(fields) != 2 or not fields[0] or not fields[1]:
+                raise ValueError("{}:{}: expected '<host>,<link tag>' but got '{}'".format(filename, lineno, line))
+            tags[fields[0]] = fields[1]
+    return tags
+
 def GetArgs():
     """
     Supports the command-line arguments listed below.
@@ -479,16 +652,32 @@ def GetArgs():
     parser.add_argument('-p', '--dlpxpwd', required=False, action='store',help='Password to use when connecting to host')
     parser.add_argument('-t', '--tgtlist', required=False, action='store', help='Comma seperated One or more Target Hosts to conduct network test')
     parser.add_argument('-l', '--logfile', required=False, action='store', help='Name of custom logfile')
+    parser.add_argument('--history', required=False, action='store', help='Also store the test results of this run in this SQLite file (see irr_history.py)')
     parser.add_argument('-f', '--force', required=False, action='store_true', help='Force to mark target host(s) healthy for test')
+    parser.add_argument('--probe', default='icmp', choices=['icmp', 'tcp'], action='store', help='Reachability check of the target hosts: icmp (ping) or tcp (connect to the SSH / connector port) (default icmp)')
+    parser.add_argument('--probe_timeout', type=int, default=2, action='store', help='Seconds to wait for each target host to answer (default 2)')
+    parser.add_argument('--probe_workers', type=int, default=32, action='store', help='Number of target hosts checked concurrently (default 32)')
+    parser.add_argument('--latency_jobs', type=int, default=4, action='store', help='Number of network latency tests running on the engine at the same time (default 4)')
+    parser.add_argument('--result_workers', type=int, default=8, action='store', help='With -t: number of engine sessions the test results are fetched over (default 8)')
+    parser.add_argument('--throughput_jobs', type=int, default=2, action='store', help='Number of network throughput tests running on the engine at the same time, each on a different network path (default 2)')
+    parser.add_argument('--link_prefix', type=int, default=24, action='store', help='Target hosts in the same IPv4 /LINK_PREFIX subnet share a network path (default 24)')
+    parser.add_argument('--link_tags', required=False, action='store', help='File with one <host name or address>,<link tag> per line; hosts with the same tag share a network path')
     parser.add_argument('-v', '--verbose', required=False, action='store_true', help='Verbose Mode of execution')
     args = parser.parse_args()
     return args
 
 def main():
     print("Script Version : 3.0")
+    args = GetArgs()
+    # HttpError / JobError below only exist once delphixpy is loaded
+    try:
+        load_sdk()
+    except ImportError as e:
+        print("Could not load the Delphix SDK (delphixpy) : {}".format(e))
+        sys.exit(1)
+    dlpxSess = None
     try:
         tgthostlist = []
-        args = GetArgs()
         logfile = ''
 
         dlpxengine = args.dlpxengine
@@ -505,28 +694,40 @@ def main():
         if args.logfile:
             logfile = args.logfile
 
+        linktags = {}
+        if args.link_tags:
+            try:
+                linktags = read_link_tags(args.link_tags)
+            except (IOError, ValueError) as e:
+                print("Could not read link tags file {}".format(args.link_tags))
+                print(str(e))
+                sys.exit(1)
+
         verbose = args.verbose
         verbose = True
         force = args.force
 
         dlpxSess = dlpxSession(dlpxengine,dlpxuser,dlpxpwd,verbose,logfile)
+        dlpxSess.resultWorkers = args.result_workers
+        if args.history:
+            dlpxSess.history = irr_history.historystore(args.history, 'exec_network_test', dlpxengine)
 
         dlpxSess.printMsg (" ","True","L0","I","Y")
         dlpxSess.printMsg ("INFRASTRUCTURE READINESS REPORT (IRR) - Network Tests",verbose,"L0","I","Y")
         dlpxSess.printMsg ("=====================================================",verbose,"L0","I","Y")
         dlpxSess.printMsg (time.strftime("%a %b %d %H:%M:%S %Z %Y") + " : Start Time",verbose,"L0","I","Y")
         dlpxSess.defineGlobals()
-        dlpxSess.genHostLists(tgthostlist=tgthostlist,force=force)
-        dlpxSess.estimateTestDuration()
-        dlpxSess.runNetworkLatencyTest()
-        dlpxSess.runNetworkThroughputTest()
+        dlpxSess.genHostLists(tgthostlist=tgthostlist,force=force,probe=args.probe,timeout=args.probe_timeout,workers=args.probe_workers)
+        links = dlpxSess.throughputLinks(prefix=args.link_prefix,tags=linktags)
+        dlpxSess.estimateTestDuration(latency_jobs=args.latency_jobs,throughput_jobs=args.throughput_jobs,links=links)
+        dlpxSess.runNetworkLatencyTest(latency_jobs=args.latency_jobs)
+        dlpxSess.runNetworkThroughputTest(links,throughput_jobs=args.throughput_jobs)
         dlpxSess.genLatencyTestResults(tgtlist=tgthostlist)
         dlpxSess.genThroughputTestResults(tgtlist=tgthostlist)
         dlpxSess.genHostNotPingedResults()
         dlpxSess.printMsg (time.strftime("%a %b %d %H:%M:%S %Z %Y") + " : End Time",verbose,"L0","I","Y")
         dlpxSess.printMsg (" ","True","L0","I","Y")
         dlpxSess.printMsg ("Logfile : " + dlpxSess.logfile + " generated for this run",True,"L0","I","Y")
-        dlpxSess.closeLogFile ()
 
     except SystemExit as e:
         """
@@ -562,6 +763,9 @@ def main():
         """
     except socket.error:
         dlpxSess.printMsg ("Connection to Delphix Engine (" + dlpxengine + ") Failed","True","L0","E","Y")
+    except sqlite3.Error as e:
+        dlpxSess.printMsg ("Could not write the test results to the history file " + args.history,"True","L0","E","Y")
+        dlpxSess.printMsg (str(e),"True","L0","E","Y")
     except:
         """
         All other exceptions are handled here
@@ -572,6 +776,9 @@ def main():
         #elapsed_minutes = time_elapsed()
         #dlpxSess.printMsg (basename(__file__) + " took " + str(elapsed_minutes) + " minutes to get this far.","True","L1","E","N")
         #sys.exit(1)
+    finally:
+        if dlpxSess:
+            dlpxSess.closeLogFile ()
 
 # Start program
 if __name__ == "__main__":
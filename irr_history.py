@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+"""
+#
+# Copyright (c) 2017, 2018, 2019 by Delphix. All rights reserved.
+#
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Program Name : irr_history.py
+# Description  : SQLite history of chk_esxi_settings and exec_network_test runs
+#
+Code    : irr_history
+Syntax  :
+Usage   : irr_history [-h] -f FILE {runs,trend,drift,network} ...
+
+  runs    [--last N]                                      runs stored in FILE
+  trend   (--vm VM | --host HOST) [--rule RULE] [--last N]  check values and results per run
+  drift   (--vm VM | --host HOST) [--last N]               checks whose value or result changed
+  network [--engine ENGINE] [--remote ADDRESS] [--last N]  latency / throughput results per run
+
+Both scripts write to the store when run with --history FILE:
+
+    chk_esxi_settings -s vcenter01 -u admin -e engine1 --history irr_history.db
+    exec_network_test -e engine1 -u admin --history irr_history.db
+    irr_history -f irr_history.db drift --vm engine1
+"""
+
+import argparse
+import datetime
+import sqlite3
+import sys
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    script TEXT NOT NULL,
+    target TEXT,
+    started TEXT NOT NULL,
+    finished TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    host TEXT,
+    vm TEXT,
+    scope TEXT,
+    rule TEXT,
+    label TEXT,
+    value TEXT,
+    recommended TEXT,
+    result TEXT
+);
+CREATE TABLE IF NOT EXISTS network (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    engine TEXT,
+    test TEXT,
+    name TEXT,
+    remote_address TEXT,
+    direction TEXT,
+    state TEXT,
+    value REAL,
+    unit TEXT
+);
+CREATE INDEX IF NOT EXISTS results_vm ON results (vm, rule, run_id);
+CREATE INDEX IF NOT EXISTS results_host ON results (host, rule, run_id);
+CREATE INDEX IF NOT EXISTS network_engine ON network (engine, remote_address, test, run_id);
+CREATE INDEX IF NOT EXISTS runs_script ON runs (script, id);
+"""
+
+RESULT_FIELDS = ['host', 'vm', 'scope', 'rule', 'label', 'value', 'recommended', 'result']
+NETWORK_FIELDS = ['engine', 'test', 'name', 'remote_address', 'direction', 'state', 'value', 'unit']
+
+def now():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def connect(filename):
+    db = sqlite3.connect(filename, check_same_thread=False)
+    db.executescript(SCHEMA)
+    return db
+
+class historystore(object):
+    # One run of a script. Rows are inserted as they are reported and
+    # committed by flush() / close(), so a run costs one transaction.
+    def __init__(self, filename, script, target=None):
+        self.db = connect(filename)
+        self.run_id = self.db.execute("INSERT INTO runs (script, target, started) VALUES (?, ?, ?)",
+                                      (script, target, now())).lastrowid
+
+    def add_result(self, record):
+        self.db.execute("INSERT INTO results (run_id, {}) VALUES (?, {})".format(
+            ", ".join(RESULT_FIELDS), ", ".join("?" * len(RESULT_FIELDS))),
+            [self.run_id] + [None if record.get(x) is None else str(record.get(x)) for x in RESULT_FIELDS])
+
+    def add_network(self, record):
+        self.db.execute("INSERT INTO network (run_id, {}) VALUES (?, {})".format(
+            ", ".join(NETWORK_FIELDS), ", ".join("?" * len(NETWORK_FIELDS))),
+            [self.run_id] + [record.get(x) for x in NETWORK_FIELDS])
+
+    def flush(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.execute("UPDATE runs SET finished = ? WHERE id = ?", (now(), self.run_id))
+        self.db.commit()
+        self.db.close()
+
+def last_runs(table, where, params, last):
+    # Restricts a query on table to the last N runs that have rows matching
+    # where, so other VMs, hosts or engines (and the runs of the other
+    # script, which write to the other table) do not count. The subquery is
+    # a backwards scan of the (subject, ..., run_id) index.
+    if not last:
+        return "", []
+    return (" AND {0}.run_id >= (SELECT MIN(run_id) FROM (SELECT DISTINCT run_id FROM {0} WHERE {1}"
+            " ORDER BY run_id DESC LIMIT ?))".format(table, where), params + [last])
+
+def subject(args):
+    if args.vm:
+        return "vm = ?", [args.vm.lower()]
+    return "host = ?", [args.host]
+
+def print_table(header, widths, rows):
+    sep = "="
+    print(" ".join("{:{}}".format(h, w) for h, w in zip(header, widths)))
+    print(" ".join(sep * w for w in widths))
+    for row in rows:
+        print(" ".join("{:{}}".format("" if x is None else str(x), w) for x, w in zip(row, widths)))
+
+def cmd_runs(db, args):
+    rows = db.execute("SELECT id, script, target, started, finished FROM runs ORDER BY id DESC LIMIT ?",
+                      [args.last or -1]).fetchall()
+    print_table(["Run", "Script", "Target", "Started", "Finished"], [6, 20, 40, 19, 19], rows)
+
+def cmd_trend(db, args):
+    where, params = subject(args)
+    if args.rule:
+        where += " AND rule = ?"
+        params.append(args.rule)
+    runs, runparams = last_runs('results', where, params, args.last)
+    rows = db.execute("SELECT results.run_id, runs.started, label, value, result FROM results JOIN runs"
+                      " ON runs.id = results.run_id WHERE " + where + runs +
+                      " ORDER BY rule, label, results.run_id, results.rowid", params + runparams).fetchall()
+    print_table(["Run", "Started", "Settings/Parameters/Version", "Current Value", "Result"], [6, 19, 50, 70, 10],
+                rows)
+
+def cmd_drift(db, args):
+    # Walks the values of each check in run order (index order) and prints
+    # every change of value or result against the previous run
+    where, params = subject(args)
+    runs, runparams = last_runs('results', where, params, args.last)
+    rows = db.execute("SELECT results.run_id, runs.started, rule, label, value, result FROM results JOIN runs"
+                      " ON runs.id = results.run_id WHERE " + where + runs +
+                      " ORDER BY rule, label, results.run_id, results.rowid", params + runparams).fetchall()
+    previous = {}
+    seen = {}
+    changes = []
+    for run_id, started, rule, label, value, result in rows:
+        # a label can repeat within a run (one row per controller / path),
+        # the n-th row of a run is compared with the n-th of the previous
+        n = seen[(rule, label, run_id)] = seen.get((rule, label, run_id), -1) + 1
+        key = (rule, label, n)
+        if key in previous and previous[key] != (value, result):
+            changes.append((run_id, started, label, "{} ({})".format(previous[key][0], previous[key][1]),
+                            "{} ({})".format(value, result)))
+        previous[key] = (value, result)
+    changes.sort()
+    print_table(["Run", "Started", "Settings/Parameters/Version", "Previous Value", "Current Value"],
+                [6, 19, 50, 50, 50], changes)
+
+def cmd_network(db, args):
+    where = "1 = 1"
+    params = []
+    if args.engine:
+        where += " AND engine = ?"
+        params.append(args.engine)
+    if args.remote:
+        where += " AND remote_address = ?"
+        params.append(args.remote)
+    runs, runparams = last_runs('network', where, params, args.last)
+    rows = db.execute("SELECT network.run_id, runs.started, engine, remote_address, test, direction, state, value, unit"
+                      " FROM network JOIN runs ON runs.id = network.run_id WHERE " + where + runs +
+                      " ORDER BY engine, remote_address, test, direction, network.run_id", params + runparams).fetchall()
+    print_table(["Run", "Started", "Engine", "Remote Address", "Test", "Direction", "Status", "Value", "Unit"],
+                [6, 19, 30, 15, 10, 10, 15, 15, 5], rows)
+
+def main():
+    parser = argparse.ArgumentParser(description='Trends and drift of the checks stored with --history')
+    parser.add_argument('-f', '--file', required=True, action='store', help='History database written with --history')
+    commands = parser.add_subparsers(dest='command')
+    runs = commands.add_parser('runs', help='Runs stored in the database')
+    runs.add_argument('--last', type=int, action='store', help='Only the last N runs')
+    for name, helptext in [('trend', 'Check values and results per run'),
+                           ('drift', 'Checks whose value or result changed between runs')]:
+        sub = commands.add_parser(name, help=helptext)
+        target = sub.add_mutually_exclusive_group(required=True)
+        target.add_argument('--vm', action='store', help='Delphix engine (VM name)')
+        target.add_argument('--host', action='store', help='ESXi host')
+        if name == 'trend':
+            sub.add_argument('--rule', action='store', help='Only this rule (see DEFAULT_RULES)')
+        sub.add_argument('--last', type=int, action='store', help='Only the last N runs')
+    network = commands.add_parser('network', help='Network latency and throughput results per run')
+    network.add_argument('--engine', action='store', help='Delphix engine (-e of exec_network_test)')
+    network.add_argument('--remote', action='store', help='Remote address of the tests')
+    network.add_argument('--last', type=int, action='store', help='Only the last N runs')
+    args = parser.parse_args()
+    if not args.command:
+        parser.error("one of runs, trend, drift, network is required")
+
+    db = connect(args.file)
+    try:
+        {'runs': cmd_runs, 'trend': cmd_trend, 'drift': cmd_drift, 'network': cmd_network}[args.command](db, args)
+    finally:
+        db.close()
+    return 0
+
+# Start program
+if __name__ == "__main__":
+    sys.exit(main())
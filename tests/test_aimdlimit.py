@@ -0,0 +1,141 @@
+# In-flight limit of the vCenter requests (aimdlimit) and the busy fault
+# retries of vsphereclient
+
+import threading
+
+import pytest
+
+import chk_esxi_settings as chk
+
+@pytest.fixture(autouse=True)
+def sdk(monkeypatch):
+    chk.load_sdk()
+    monkeypatch.setattr(chk, 'BUSY_BACKOFF', 0)
+
+def released(limit, *releases):
+    # acquire / release once per (samples, busy), limit afterwards
+    async def run():
+        for samples, busy in releases:
+            await limit.acquire()
+            await limit.release(samples, busy)
+    chk.asyncio.run(run())
+    return limit.limit
+
+def test_limit_bounds():
+    assert chk.aimdlimit(4, 16).limit == 4
+    assert chk.aimdlimit(32, 16).limit == 16
+    assert chk.aimdlimit(0, 16).limit == 1
+    assert chk.aimdlimit(4, 0).cap == 1
+
+def test_additive_increase():
+    # + 1 / limit per round trip within LATENCY_FACTOR of the fastest one
+    expected = 4.0
+    for n in range(4):
+        expected += 1 / expected
+    limit = chk.aimdlimit(4, 16)
+    assert released(limit, *[([('get', 0.1)], False)] * 4) == pytest.approx(expected)
+    assert limit.peak == limit.limit
+
+def test_increase_stops_at_cap():
+    limit = chk.aimdlimit(4, 5)
+    assert released(limit, *[([('get', 0.1)], False)] * 20) == 5
+
+def test_slow_round_trips_decrease_once_per_limit():
+    limit = chk.aimdlimit(4, 16)
+    released(limit, ([('get', 0.1)], False))
+    start = limit.limit
+    # only every limit-th slow round trip shrinks the limit by a quarter
+    released(limit, *[([('get', 1.0)], False)] * 3)
+    assert limit.limit == start
+    released(limit, ([('get', 1.0)], False))
+    assert limit.limit == pytest.approx(start * 0.75)
+
+def test_baseline_per_kind():
+    # a slower kind of request is not compared with a faster one
+    limit = chk.aimdlimit(4, 16)
+    released(limit, ([('get', 0.1)], False), ([('perf', 1.0)], False))
+    assert limit.baseline == {'get': 0.1, 'perf': 1.0}
+    assert limit.limit > 4
+
+def test_busy_halves():
+    limit = chk.aimdlimit(8, 16)
+    assert released(limit, ((), True)) == 4
+    assert released(limit, ((), True), ((), True), ((), True)) == 1
+    assert limit.peak == 8
+
+def test_acquire_waits_for_release():
+    limit = chk.aimdlimit(2, 2)
+    order = []
+
+    async def run():
+        await limit.acquire()
+        await limit.acquire()
+        waiter = chk.asyncio.ensure_future(limit.acquire())
+        await chk.asyncio.sleep(0)
+        order.append(('waiting', waiter.done(), limit.inflight))
+        await limit.release()
+        await waiter
+        order.append(('acquired', waiter.done(), limit.inflight))
+    chk.asyncio.run(run())
+    assert order == [('waiting', False, 2), ('acquired', True, 2)]
+
+def test_busy_fault():
+    vim, vmodl = chk.vim, chk.vmodl
+    assert chk.busy_fault(vmodl.fault.RequestCanceled())
+    assert chk.busy_fault(vim.fault.Timedout())
+    assert chk.busy_fault(vmodl.fault.SystemError())
+    # subclasses of HostCommunication too
+    assert chk.busy_fault(vmodl.fault.HostNotReachable())
+    assert not chk.busy_fault(vim.fault.InvalidLogin())
+    assert not chk.busy_fault(vmodl.fault.ManagedObjectNotFound())
+    assert not chk.busy_fault(ValueError())
+
+def test_client_retries_busy_faults():
+    calls = []
+    lock = threading.Lock()
+
+    def get(content, n):
+        with lock:
+            calls.append(n)
+            first = calls.count(n) == 1
+        if first and n % 2:
+            raise chk.vmodl.fault.RequestCanceled()
+        return chk.roundtrip('get', lambda n: (content, n), n=n)
+    client = chk.vsphereclient(['a', 'b'], 4, 8)
+    try:
+        assert [n for content, n in client.run([(None, get, n) for n in range(10)])] == list(range(10))
+    finally:
+        client.close()
+    assert sorted(calls) == sorted(list(range(10)) + [1, 3, 5, 7, 9])
+    assert client.limit.inflight == 0
+
+def test_client_gives_up():
+    attempts = []
+
+    def get(content):
+        attempts.append(content)
+        raise chk.vim.fault.Timedout()
+    client = chk.vsphereclient(['a', 'b'], 4, 8)
+    try:
+        with pytest.raises(chk.vim.fault.Timedout):
+            client.run([(None, get)])
+    finally:
+        client.close()
+    # round robin over the sessions, BUSY_RETRIES retries
+    assert attempts == ['a', 'b', 'a', 'b'][:chk.BUSY_RETRIES + 1]
+    assert client.limit.limit == 1
+
+def test_client_raises_other_faults_at_once():
+    attempts = []
+
+    def get(content):
+        attempts.append(content)
+        raise chk.vim.fault.InvalidLogin()
+    client = chk.vsphereclient(['a'], 4, 8)
+    try:
+        with pytest.raises(chk.vim.fault.InvalidLogin):
+            client.run([(None, get)])
+    finally:
+        client.close()
+    assert attempts == ['a']
+    assert client.limit.limit == 4
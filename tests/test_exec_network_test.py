@@ -0,0 +1,203 @@
+# Scheduling helpers of exec_network_test that need no Delphix Engine
+
+import io
+from types import SimpleNamespace as test
+
+import pytest
+
+import exec_network_test as net
+
+@pytest.fixture
+def session():
+    # A dlpxSession without an engine connection, logging to memory
+    session = object.__new__(net.dlpxSession)
+    session.verbose = False
+    session.f = io.StringIO()
+    session.defineGlobals()
+    return session
+
+def active_host(name, address, ip=None, hostype='UnixHost', port='0'):
+    host = {'keyname': name, 'keyaddress': address, 'keyip': ip or address, 'keyhostype': hostype,
+            'keyconnectorport': port, 'keyreference': 'HOST-' + name}
+    net.activehost_list.append(host)
+    return host
+
+def test_resolve_host(session, monkeypatch):
+    def gethostbyname(name):
+        if name == 'db1.example.com':
+            return '192.168.7.9'
+        raise net.socket.gaierror("unknown host")
+    monkeypatch.setattr(net.socket, 'gethostbyname', gethostbyname)
+    assert session.resolveHost('10.0.1.17') == '10.0.1.17'
+    assert session.resolveHost('FD00:0001::17') == 'fd00:1::17'
+    assert session.resolveHost('db1.example.com') == '192.168.7.9'
+    assert session.resolveHost('gone.example.com') is None
+
+def test_host_link_subnet(session):
+    assert session.hostLink(active_host('h1', '10.0.1.17'), 24, {}) == '10.0.1.0/24'
+    assert session.hostLink(active_host('h2', '10.0.1.17'), 16, {}) == '10.0.0.0/16'
+    assert session.hostLink(active_host('h3', 'fd00:1:2:3::17'), 24, {}) == 'fd00:1:2:3::/64'
+
+def test_host_link_resolved_name(session):
+    assert session.hostLink(active_host('h1', 'db1.example.com', '192.168.7.9'), 24, {}) == '192.168.7.0/24'
+
+def test_host_link_unresolved(session):
+    host = active_host('h1', 'gone.example.com')
+    host['keyip'] = None
+    assert session.hostLink(host, 24, {}) == 'gone.example.com'
+
+def test_host_link_tags(session):
+    tags = {'h1': 'wan', '10.0.2.5': 'dr'}
+    assert session.hostLink(active_host('h1', '10.0.1.17'), 24, tags) == 'wan'
+    assert session.hostLink(active_host('h2', '10.0.2.5'), 24, tags) == 'dr'
+    assert session.hostLink(active_host('h3', '10.0.2.6'), 24, tags) == '10.0.2.0/24'
+
+def test_throughput_links(session):
+    h1 = active_host('h1', '10.0.1.1')
+    h2 = active_host('h2', '10.0.2.2')
+    h3 = active_host('h3', '10.0.1.3')
+    h4 = active_host('h4', '10.0.3.4', hostype='WindowsHost', port='0')
+    h5 = active_host('h5', '10.0.3.5', hostype='WindowsHost', port='9100')
+    links = session.throughputLinks(prefix=24, tags={'h2': 'wan'})
+    assert list(links) == ['10.0.1.0/24', 'wan', '10.0.3.0/24']
+    assert links['10.0.1.0/24'] == [(h1, 'TRANSMIT'), (h1, 'RECEIVE'), (h3, 'TRANSMIT'), (h3, 'RECEIVE')]
+    assert links['wan'] == [(h2, 'TRANSMIT'), (h2, 'RECEIVE')]
+    assert links['10.0.3.0/24'] == [(h5, 'TRANSMIT'), (h5, 'RECEIVE')]
+    # a Windows source without a connector cannot run throughput tests
+    assert [(x['job_hostname'], x['job_status']) for x in net.jobRefErrList] == [('h4', 'Not Supported')]
+
+def test_estimate_uses_the_longest_link(session, capsys):
+    for n in range(4):
+        active_host('h{}'.format(n), '10.0.1.{}'.format(n))
+    active_host('h9', '10.0.9.9')
+    links = session.throughputLinks(prefix=24, tags={})
+    capsys.readouterr()
+    session.estimateTestDuration(latency_jobs=4, throughput_jobs=4, links=links)
+    out = capsys.readouterr().out
+    # 5 latency tests 4 at a time, then the 8 tests of 10.0.1.0/24 in turn
+    assert "Running 5 network latency tests, 10 network throughput tests" in out
+    assert "about {} seconds".format(2 * 20 + 8 * 75) in out
+
+def test_read_link_tags(tmp_path):
+    filename = tmp_path / "links.txt"
+    filename.write_text("# DR site\n\ndr-oracle-01, dr-wan\n10.0.0.5,dr-wan\n")
+    assert net.read_link_tags(str(filename)) == {'dr-oracle-01': 'dr-wan', '10.0.0.5': 'dr-wan'}
+
+@pytest.mark.parametrize('line', ["dr-oracle-01", "dr-oracle-01,", ",dr-wan", "a,b,c"])
+def test_read_link_tags_rejects(tmp_path, line):
+    filename = tmp_path / "links.txt"
+    filename.write_text("ok,wan\n" + line + "\n")
+    with pytest.raises(ValueError, match=":2: expected"):
+        net.read_link_tags(str(filename))
+
+def test_latest_results():
+    results = [test(name='NLT-1', remote_address='10.0.0.1', end_time='2019-01-01T10:00:00'),
+               test(name='NLT-2', remote_address='10.0.0.2', end_time='2019-01-01T10:00:00'),
+               test(name='NLT-3', remote_address='10.0.0.1', end_time='2024-05-01T10:00:00'),
+               test(name='NLT-4', remote_address='10.0.0.1', end_time=None),
+               test(name='NLT-5', remote_address='10.0.0.9', end_time=None)]
+    latest = net.latest_results(results, lambda x: x.remote_address)
+    # one per key, keys descending; a test still running has no end_time
+    assert [x.name for x in latest] == ['NLT-5', 'NLT-2', 'NLT-3']
+
+def test_latest_results_per_direction():
+    results = [test(name='NTT-{}'.format(n), remote_address='10.0.0.1', end_time='2024-05-0{}'.format(n),
+                    parameters=test(direction=direction))
+               for n, direction in enumerate(['TRANSMIT', 'RECEIVE', 'RECEIVE', 'TRANSMIT'], 1)]
+    latest = net.latest_results(results, lambda x: (x.remote_address, x.parameters.direction))
+    assert [x.name for x in latest] == ['NTT-4', 'NTT-3']
+    assert net.latest_results([], lambda x: x.remote_address) == []
+
+class fakeengine(object):
+    # The job bookkeeping of a DelphixEngine (see job_context) and its jobs,
+    # each one RUNNING for a number of polls
+    def __init__(self, states):
+        self.address = 'engine'
+        self.job_contexts = []
+        self.last_job = None
+        self.states = states
+        self.jobs = {}
+        self.cancelled = []
+        self.running = 0
+        self.peak = 0
+
+    def clear_registered_job(self, ref):
+        self.job_contexts[-1][1].remove(ref)
+
+    def submit(self, test):
+        # test is (link, name), its state comes from states[name]
+        if self.states[test[1]] == 'REFUSED':
+            raise net.RequestError({'details': 'refused'})
+        if self.states[test[1]] == 'NOJOB':
+            return 'TEST-' + test[1]
+        ref = 'JOB-{}'.format(len(self.jobs))
+        self.jobs[ref] = [test[1], 0]
+        self.job_contexts[-1][1].append(ref)
+        self.last_job = ref
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        return 'TEST-' + test[1]
+
+    def get(self, engine, ref):
+        name, polls = self.jobs[ref]
+        self.jobs[ref][1] += 1
+        state = self.states[name]
+        if state == 'UNREACHABLE':
+            raise net.HttpError('unreachable')
+        if state != 'HANG' and polls >= 1:
+            self.running -= 1
+            return test(job_state=state)
+        return test(job_state='RUNNING')
+
+    def cancel(self, engine, ref):
+        self.cancelled.append(self.jobs[ref][0])
+        self.running -= 1
+
+@pytest.fixture
+def engine(session, monkeypatch):
+    net.load_sdk()
+    engine = fakeengine({})
+    session.engine = engine
+    monkeypatch.setattr(net, 'job', test(get=engine.get, cancel=engine.cancel))
+    return engine
+
+def run_jobs(session, engine, links, jobs=4, timeout=60, done=None):
+    reported = []
+    def record(test, ref, state):
+        reported.append((test[1], ref, state))
+        if done:
+            done(test)
+    tests = dict((link, [(link, x) for x in names]) for link, names in links.items())
+    session.runEngineJobs(tests, jobs, engine.submit, record, poll=0, timeout=timeout)
+    return reported
+
+def test_run_engine_jobs_one_per_link(session, engine):
+    engine.states.update(dict(('t{}'.format(n), 'COMPLETED') for n in range(8)))
+    reported = run_jobs(session, engine, {'a': ['t0', 't1', 't2'], 'b': ['t3', 't4'], 'c': ['t5'], 'd': ['t6', 't7']},
+                        jobs=2)
+    assert sorted(reported) == sorted(('t{}'.format(n), 'TEST-t{}'.format(n), 'COMPLETED') for n in range(8))
+    assert engine.peak == 2
+    # the tests of a link run in turn
+    names = [x[0] for x in reported]
+    assert names.index('t0') < names.index('t1') < names.index('t2')
+    assert engine.job_contexts == []
+
+def test_run_engine_jobs_failures(session, engine):
+    engine.states.update({'ok': 'COMPLETED', 'failed': 'FAILED', 'suspended': 'SUSPENDED', 'refused': 'REFUSED',
+                          'nojob': 'NOJOB', 'unreachable': 'UNREACHABLE', 'hang': 'HANG'})
+    reported = run_jobs(session, engine, {'a': ['refused', 'ok'], 'b': ['failed', 'nojob'], 'c': ['suspended'],
+                                          'd': ['unreachable'], 'e': ['hang']}, timeout=0.2)
+    assert sorted(reported) == [('failed', 'TEST-failed', 'FAILED'), ('hang', 'TEST-hang', 'TIMEDOUT'),
+                                ('nojob', 'TEST-nojob', 'COMPLETED'), ('ok', 'TEST-ok', 'COMPLETED'),
+                                ('refused', None, 'FAILED'), ('suspended', 'TEST-suspended', 'SUSPENDED'),
+                                ('unreachable', 'TEST-unreachable', 'FAILED')]
+    # only the jobs that could not be polled or timed out are cancelled
+    assert sorted(engine.cancelled) == ['hang', 'unreachable']
+
+def test_run_engine_jobs_cancels_on_exit(session, engine):
+    engine.states.update({'ok': 'COMPLETED', 'hang1': 'HANG', 'hang2': 'HANG'})
+    def done(test):
+        raise KeyboardInterrupt()
+    with pytest.raises(KeyboardInterrupt):
+        run_jobs(session, engine, {'a': ['ok'], 'b': ['hang1'], 'c': ['hang2']}, done=done)
+    assert sorted(engine.cancelled) == ['hang1', 'hang2']
@@ -0,0 +1,111 @@
+# History store of --history and the trend / drift / network queries of
+# irr_history
+
+import argparse
+import sqlite3
+
+import pytest
+
+import irr_history
+
+def result(vm, rule, label, value, outcome, host='esx1'):
+    return {'host': host, 'vm': vm, 'scope': 'cpu', 'rule': rule, 'label': label, 'value': value,
+            'recommended': '8', 'result': outcome}
+
+@pytest.fixture
+def db(tmp_path):
+    # engine1 over four runs, engine2 in runs 2 and 4 only. Run 3 is checked
+    # against a new engine1 vCPU count and has two SCSI controller rows.
+    filename = str(tmp_path / "history.db")
+    runs = [
+        [result('engine1', 'vm_cpu', '[engine1] Total vCPUs', 8, 'Pass'),
+         result('engine1', 'vm_scsi', '[engine1] SCSI', 'pvscsi', 'Pass')],
+        [result('engine1', 'vm_cpu', '[engine1] Total vCPUs', 8, 'Pass'),
+         result('engine2', 'vm_cpu', '[engine2] Total vCPUs', 4, 'Fail', 'esx2')],
+        [result('engine1', 'vm_cpu', '[engine1] Total vCPUs', 4, 'Fail'),
+         result('engine1', 'vm_scsi', '[engine1] SCSI', 'pvscsi', 'Pass'),
+         result('engine1', 'vm_scsi', '[engine1] SCSI', 'lsilogic', 'Fail')],
+        [result('engine1', 'vm_cpu', '[engine1] Total vCPUs', 4, 'Fail'),
+         result('engine2', 'vm_cpu', '[engine2] Total vCPUs', 8, 'Pass', 'esx2')],
+    ]
+    for records in runs:
+        store = irr_history.historystore(filename, 'chk_esxi_settings', 'vc1')
+        for record in records:
+            store.add_result(record)
+        store.close()
+    for n, value in enumerate([150.0, 300.0]):
+        store = irr_history.historystore(filename, 'exec_network_test', 'engine1')
+        store.add_network({'engine': 'engine1', 'test': 'Latency', 'name': 'NLT-{}'.format(n),
+                           'remote_address': '10.0.0.1', 'direction': None, 'state': 'COMPLETED',
+                           'value': value, 'unit': 'usec'})
+        store.close()
+    db = irr_history.connect(filename)
+    yield db
+    db.close()
+
+def query(db, capsys, command, **kwargs):
+    args = argparse.Namespace(**dict({'vm': None, 'host': None, 'rule': None, 'last': None, 'engine': None,
+                                      'remote': None}, **kwargs))
+    command(db, args)
+    lines = capsys.readouterr().out.splitlines()
+    # header and separator lines first
+    return [line.split() for line in lines[2:]]
+
+def test_store_run(db):
+    assert db.execute("SELECT script, target FROM runs ORDER BY id").fetchall() == [
+        ('chk_esxi_settings', 'vc1')] * 4 + [('exec_network_test', 'engine1')] * 2
+    assert db.execute("SELECT COUNT(*) FROM runs WHERE finished IS NULL").fetchone() == (0,)
+    # values are stored as reported text
+    assert db.execute("SELECT value FROM results WHERE run_id = 1 AND rule = 'vm_cpu'").fetchone() == ('8',)
+
+def test_store_rolls_back_uncommitted(tmp_path):
+    filename = str(tmp_path / "history.db")
+    store = irr_history.historystore(filename, 'chk_esxi_settings')
+    store.add_result(result('engine1', 'vm_cpu', '[engine1] Total vCPUs', 8, 'Pass'))
+    store.db.rollback()
+    store.close()
+    assert irr_history.connect(filename).execute("SELECT COUNT(*) FROM results").fetchone() == (0,)
+
+def test_trend(db, capsys):
+    rows = query(db, capsys, irr_history.cmd_trend, vm='ENGINE1', rule='vm_cpu')
+    assert [(x[0], x[-2], x[-1]) for x in rows] == [('1', '8', 'Pass'), ('2', '8', 'Pass'), ('3', '4', 'Fail'),
+                                                    ('4', '4', 'Fail')]
+
+def test_trend_last_counts_runs_of_the_subject(db, capsys):
+    # runs 2 and 4 are the last two of engine2, though engine1 ran in between
+    rows = query(db, capsys, irr_history.cmd_trend, vm='engine2', last=2)
+    assert [(x[0], x[-2]) for x in rows] == [('2', '4'), ('4', '8')]
+    rows = query(db, capsys, irr_history.cmd_trend, vm='engine2', last=1)
+    assert [(x[0], x[-2]) for x in rows] == [('4', '8')]
+    rows = query(db, capsys, irr_history.cmd_trend, host='esx1', rule='vm_cpu', last=2)
+    assert [x[0] for x in rows] == ['3', '4']
+
+def test_drift(db, capsys):
+    rows = query(db, capsys, irr_history.cmd_drift, vm='engine1')
+    # vm_cpu changed in run 3; the first SCSI row is unchanged, the second
+    # one is new in run 3 and has nothing to compare with
+    assert [(x[0], x[-4], x[-3], x[-2], x[-1]) for x in rows] == [('3', '8', '(Pass)', '4', '(Fail)')]
+
+def test_drift_last(db, capsys):
+    assert query(db, capsys, irr_history.cmd_drift, vm='engine1', last=2) == []
+    rows = query(db, capsys, irr_history.cmd_drift, vm='engine2', last=2)
+    assert [(x[0], x[-3], x[-1]) for x in rows] == [('4', '(Fail)', '(Pass)')]
+
+def test_network(db, capsys):
+    rows = query(db, capsys, irr_history.cmd_network, engine='engine1')
+    assert [(x[0], x[-3], x[-2]) for x in rows] == [('5', 'COMPLETED', '150.0'), ('6', 'COMPLETED', '300.0')]
+    rows = query(db, capsys, irr_history.cmd_network, engine='engine1', last=1)
+    assert [x[0] for x in rows] == ['6']
+    assert query(db, capsys, irr_history.cmd_network, remote='10.9.9.9') == []
+
+def test_last_runs():
+    assert irr_history.last_runs('results', "vm = ?", ['engine1'], None) == ("", [])
+    where, params = irr_history.last_runs('results', "vm = ?", ['engine1'], 3)
+    assert "FROM results WHERE vm = ?" in where
+    assert params == ['engine1', 3]
+
+def test_connect_rejects_other_files(tmp_path):
+    filename = tmp_path / "history.db"
+    filename.write_text("not a database " * 100)
+    with pytest.raises(sqlite3.DatabaseError):
+        irr_history.connect(str(filename))
@@ -0,0 +1,142 @@
+# Rules of chk_esxi_settings (see ruleset): a --rules file is compiled once
+# and its expressions may only use the whitelisted nodes, names and methods.
+
+import pytest
+
+import chk_esxi_settings as chk
+
+def load_rules(tmp_path, text):
+    filename = tmp_path / "rules.ini"
+    filename.write_text(text)
+    return chk.ruleset(str(filename))
+
+def nic_rule(tmp_path, **keys):
+    keys.setdefault('label', '[{vm}] NIC')
+    keys.setdefault('value', 'nic')
+    return load_rules(tmp_path, "[test_rule]\nscope = nic\n" +
+                      "".join("{} = {}\n".format(k, v) for k, v in keys.items()))
+
+def results(rules, scope, rows, name='test_rule'):
+    return [x for x in rules.evaluate(scope, rows) if x['rule'] == name]
+
+def test_default_rules_compile():
+    rules = chk.ruleset()
+    assert set(rules.rules) == set(chk.RULE_SCOPES)
+    assert rules.settings['minimum_cpu'] == '8'
+
+@pytest.mark.parametrize('expression, error', [
+    ("__import__('os')", "unknown name __import__"),
+    ("__import__('os').system('id')", ".system is not allowed"),
+    ("open('/etc/passwd')", "unknown name open"),
+    ("eval('1')", "unknown name eval"),
+    ("numCpu", "unknown name numCpu"),
+    ("nic.__class__", ".__class__ is not allowed"),
+    ("nic.format(nic)", ".format is not allowed"),
+    ("nic[0]", "Subscript is not allowed"),
+    ("[x for x in nic]", "ListComp is not allowed"),
+    ("(lambda: nic)()", "Lambda is not allowed"),
+    ("(nic, nic)", "Tuple is not allowed"),
+    ("nic ** 2", "Pow is not allowed"),
+    ("nic +", "invalid syntax"),
+])
+def test_compile_rejects(tmp_path, expression, error):
+    with pytest.raises(ValueError) as e:
+        nic_rule(tmp_path, value=expression)
+    assert "rule [test_rule] value" in str(e.value)
+    assert error in str(e.value)
+
+def test_compile_checks_recommended_and_check(tmp_path):
+    with pytest.raises(ValueError, match=r"rule \[test_rule\] recommended: unknown name os"):
+        nic_rule(tmp_path, recommended='os')
+    with pytest.raises(ValueError, match=r"rule \[test_rule\] check: \.__dict__ is not allowed"):
+        nic_rule(tmp_path, check='nic.__dict__')
+
+def test_compile_allows_settings_functions_and_methods(tmp_path):
+    rules = nic_rule(tmp_path, value="nic.lower().strip()", recommended="setting('vnic') + str(len(nic))",
+                     check="vnic in nic.lower() and not nic.startswith('e1000')")
+    result, = results(rules, 'nic', [{'vm': 'engine1', 'nic': 'VMXNET3 '}])
+    assert result['value'] == 'vmxnet3'
+    assert result['recommended'] == 'vmxnet38'
+    assert result['result'] == 'Pass'
+
+@pytest.mark.parametrize('section, error', [
+    ("[test_rule]\nscope = nope\nlabel = x\nvalue = 1\n", "scope must be one of"),
+    ("[test_rule]\nscope = nic\nvalue = 1\n", "label and value are required"),
+    ("[test_rule]\nscope = nic\nlabel = x\n", "label and value are required"),
+])
+def test_rule_sections(tmp_path, section, error):
+    with pytest.raises(ValueError, match=error):
+        load_rules(tmp_path, section)
+
+def test_disabled_rule_is_not_compiled(tmp_path):
+    rules = nic_rule(tmp_path, value='os.system', enabled='false')
+    assert results(rules, 'nic', [{'vm': 'engine1', 'nic': 'vmxnet3'}]) == []
+
+@pytest.mark.parametrize('label, error', [
+    ("[{numCpu}] NIC", "unknown fact {numCpu}"),
+    ("[{0}] NIC", "unknown fact {0}"),
+    ("[{}] NIC", "unknown fact {}"),
+    ("[{vm.__class__}] NIC", "unknown fact {vm.__class__}"),
+    ("[{vm[0]}] NIC", "unknown fact {vm[0]}"),
+    ("[{vm:{nic}}] NIC", "nested fields are not allowed in {vm}"),
+    ("[{vm] NIC", "rule [test_rule] label:"),
+])
+def test_label_rejects(tmp_path, label, error):
+    with pytest.raises(ValueError) as e:
+        nic_rule(tmp_path, label=label)
+    assert error in str(e.value)
+
+def test_label_format_spec(tmp_path):
+    rules = nic_rule(tmp_path, label="[{vm:>8}] {{NIC}}")
+    result, = results(rules, 'nic', [{'vm': 'engine1', 'nic': 'vmxnet3'}])
+    assert result['label'] == "[ engine1] {NIC}"
+
+def test_evaluate_results(tmp_path):
+    rules = load_rules(tmp_path, """
+[pass_fail]
+scope = nic
+label = [{vm}] NIC
+value = nic
+recommended = vnic
+check = vnic in nic.lower()
+
+[no_check]
+scope = nic
+label = [{vm}] NIC
+value = nic
+
+[not_applicable]
+scope = nic
+label = [{vm}] NIC
+value = nic
+check = None if nic == 'none' else True
+
+[error]
+scope = nic
+label = [{vm}] NIC
+value = nic
+check = float(nic) > 1
+""")
+    rows = [{'vm': 'engine1', 'nic': 'VMXNET3'}, {'vm': 'engine2', 'nic': 'none'}]
+    found = dict(((x['rule'], x['label']), x) for x in rules.evaluate('nic', rows))
+    assert found[('pass_fail', '[engine1] NIC')]['result'] == 'Pass'
+    assert found[('pass_fail', '[engine2] NIC')]['result'] == 'Fail'
+    assert found[('pass_fail', '[engine2] NIC')]['recommended'] == 'vmxnet3'
+    assert found[('no_check', '[engine1] NIC')]['result'] == 'N/A'
+    assert found[('no_check', '[engine1] NIC')]['recommended'] == 'N/A'
+    assert found[('not_applicable', '[engine1] NIC')]['result'] == 'Pass'
+    assert found[('not_applicable', '[engine2] NIC')]['result'] == 'N/A'
+    assert found[('error', '[engine1] NIC')]['result'] == 'Error'
+    assert found[('error', '[engine1] NIC')]['value'] == 'VMXNET3'
+
+def test_evaluate_rows_first(tmp_path):
+    rules = load_rules(tmp_path, "[first]\nscope = nic\nlabel = {vm}\nvalue = 1\n"
+                                 "[second]\nscope = nic\nlabel = {vm}\nvalue = 2\n")
+    rows = [{'vm': 'engine1', 'nic': 'a'}, {'vm': 'engine2', 'nic': 'b'}]
+    found = [(x['label'], x['rule']) for x in rules.evaluate('nic', rows) if x['rule'] in ('first', 'second')]
+    assert found == [('engine1', 'first'), ('engine1', 'second'), ('engine2', 'first'), ('engine2', 'second')]
+
+def test_evaluate_has_no_builtins(tmp_path):
+    # str() is whitelisted, but a rule still cannot reach builtins through it
+    rules = nic_rule(tmp_path, value="str(nic)")
+    assert rules._globals['__builtins__'] == {}
@@ -0,0 +1,80 @@
+# --capture / --replay of chk_esxi_settings against the vSphere stand-in of
+# bench_chk_esxi_settings: a replayed snapshot gives the same check results
+# as the live run it was captured from.
+
+import collections
+import gzip
+import json
+import sys
+
+import pytest
+
+import bench_chk_esxi_settings as bench
+import chk_esxi_settings as chk
+
+VMNAMES = ['engine1', 'engine6']
+
+@pytest.fixture
+def args():
+    chk.load_sdk()
+    chk.dx_rules = chk.ruleset()
+    chk.host_storage_cache.clear()
+    chk.datastore_cache.clear()
+    args = chk.parser.parse_args(['-s', 'bench', '-u', 'bench', '-e', ','.join(VMNAMES)])
+    args.disk_type = 'non_ssd'
+    return args
+
+def run(func):
+    # rc of func and the check results it reported
+    stdout = sys.stdout
+    sys.stdout = chk.report
+    chk.report.capture()
+    try:
+        rc = func()
+    finally:
+        records = chk.report.release()
+        sys.stdout = stdout
+    return rc, [data for kind, data in records if kind == 'result']
+
+def checks(results):
+    # The replay has no performance counters, so no contention / storage I/O
+    return [(x['host'], x['vm'], x['rule'], x['label'], str(x['value']), x['result']) for x in results
+            if x['scope'] not in ('contention', 'storage_io')]
+
+def test_replay_matches_live_run(tmp_path, args):
+    si = bench.make_service_instance(vms=10)
+    filename = str(tmp_path / "snapshot.json.gz")
+    rc, live = run(lambda: chk.check_host(args, si, 'bench', VMNAMES))
+    assert rc == 0
+    assert run(lambda: chk.capture_host(args, si, 'bench', filename))[0] == 0
+
+    snapshot = chk.read_snapshot(filename)
+    assert len(snapshot['hosts']) == 4
+    assert len(snapshot['vms']) == 10
+    assert set(snapshot['storage']) == set(snapshot['hosts'])
+
+    args.replay = filename
+    rc, replayed = run(lambda: chk.replay_snapshot(args, VMNAMES))
+    assert rc == 0
+    assert checks(replayed) == checks(live)
+    scopes = collections.Counter(x['scope'] for x in replayed)
+    assert scopes['host'] and scopes['disk'] and scopes['path']
+
+def test_snapshot_round_trip(tmp_path):
+    filename = str(tmp_path / "snapshot.json.gz")
+    snapshot = collections.OrderedDict([('format', 'chk_esxi_settings-snapshot'), ('version', chk.SNAPSHOT_VERSION),
+                                        ('hosts', {'host-2': {'name': 'esx1', 'memoryGB': 512.0}}),
+                                        ('vms', [{'name': 'engine1', 'disks': [1, 2]}])])
+    chk.write_snapshot(filename, snapshot)
+    read = chk.read_snapshot(filename)
+    assert read == snapshot
+    assert list(read) == list(snapshot)
+
+@pytest.mark.parametrize('header', [{'format': 'other', 'version': 1},
+                                    {'format': 'chk_esxi_settings-snapshot', 'version': 0}])
+def test_read_snapshot_rejects(tmp_path, header):
+    filename = str(tmp_path / "snapshot.json.gz")
+    with gzip.open(filename, 'wt') as f:
+        json.dump(header, f)
+    with pytest.raises(ValueError, match="is not a chk_esxi_settings snapshot"):
+        chk.read_snapshot(filename)